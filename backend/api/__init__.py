@@ -3,11 +3,12 @@ Hospital-MS API module. Uses FastAPI.
 """
 
 import os
-import time
+import asyncio
+import logging
 from pathlib import Path
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, Response, Path as FPath
-from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hospital_ms.settings")
@@ -16,17 +17,76 @@ import django
 django.setup()
 
 from api.v1 import router as v1_router
+from api.v1.cache import response_cache
+from api.metrics import RequestMetrics, current_metrics, log_request
+from api.v1.pagination import next_cursor_header
+from api.static import (
+    PrecompressedStaticFiles,
+    SPAShell,
+    serve_thumbnail,
+    thumbnails,
+)
+from staffing.availability import availability_index
+from external.models import News
+from external.counters import news_views
+from external.mailing import dispatch_all
+from finance.mpesa import payment_push_worker
 from hospital_ms.settings import (
     STATIC_URL,
     MEDIA_URL,
     STATIC_ROOT,
     MEDIA_ROOT,
     FRONTEND_DIR,
+    NEWS_VIEWS_FLUSH_INTERVAL,
+    EMAIL_DISPATCH_INTERVAL,
+    SERVER_TIMING,
 )
 
 api_module_path = Path(__file__).parent
 api_prefix = "/api"
 
+logger = logging.getLogger(__name__)
+
+
+async def flush_news_views():
+    if await asyncio.to_thread(news_views.flush):
+        response_cache.invalidate(News)
+
+
+async def flush_news_views_periodically():
+    while True:
+        await asyncio.sleep(NEWS_VIEWS_FLUSH_INTERVAL)
+        try:
+            await flush_news_views()
+        except Exception:
+            logger.exception("Failed to flush news views")
+
+
+async def dispatch_emails_periodically():
+    while True:
+        try:
+            await asyncio.to_thread(dispatch_all)
+        except Exception:
+            logger.exception("Failed to dispatch emails")
+        await asyncio.sleep(EMAIL_DISPATCH_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm in-memory indexes before serving
+    await asyncio.to_thread(availability_index.rebuild)
+    flusher = asyncio.create_task(flush_news_views_periodically())
+    payment_pusher = asyncio.create_task(payment_push_worker.run())
+    mailer = asyncio.create_task(dispatch_emails_periodically())
+    yield
+    flusher.cancel()
+    payment_pusher.cancel()
+    mailer.cancel()
+    await flush_news_views()
+    await payment_push_worker.aclose()
+    thumbnails.shutdown()
+
+
 app = FastAPI(
     title="Hospital-Management-System API",
     version=api_module_path.joinpath("VERSION").read_text().strip(),
@@ -38,15 +98,23 @@ app = FastAPI(
     docs_url="/api/docs",
     redoc_url="/api/redoc",
     openapi_url="/api/openapi.json",
+    lifespan=lifespan,
 )
 
 
 @app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response: Response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
+async def instrument_request(request: Request, call_next):
+    metrics = RequestMetrics()
+    token = current_metrics.set(metrics)
+    try:
+        response: Response = await call_next(request)
+    finally:
+        current_metrics.reset(token)
+    total_time = metrics.total_time
+    response.headers["X-Process-Time"] = str(total_time)
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(total_time)
+    log_request(request, response, metrics, total_time)
     return response
 
 
@@ -56,11 +124,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PATCH", "DELETE"],
     allow_headers=["*"],
+    expose_headers=[next_cursor_header, "ETag", "Server-Timing"],
 )
 
 # Mount static & media files
-app.mount(STATIC_URL[:-1], StaticFiles(directory=STATIC_ROOT), name="static")
-app.mount(MEDIA_URL[:-1], StaticFiles(directory=MEDIA_ROOT), name="media")
+app.mount(
+    STATIC_URL[:-1], PrecompressedStaticFiles(directory=STATIC_ROOT), name="static"
+)
+# Ahead of the media mount which would otherwise match it
+app.add_api_route(
+    f"{MEDIA_URL}thumb/{{width:int}}x{{height:int}}/{{path:path}}",
+    serve_thumbnail,
+    name="thumbnail",
+    include_in_schema=False,
+)
+app.mount(MEDIA_URL[:-1], PrecompressedStaticFiles(directory=MEDIA_ROOT), name="media")
 
 from django.core.handlers.wsgi import WSGIHandler
 
@@ -73,11 +151,15 @@ app.mount("/d", app=WSGIMiddleware(WSGIHandler()), name="django")
 
 if FRONTEND_DIR:
 
-    @app.get("/{path}", name="React request hits here", include_in_schema=False)
-    def serve_react_app(path: str):
-        file_path = FRONTEND_DIR / "index.html"
-        if file_path.exists():
-            return Response(content=file_path.read_text(), media_type="text/html")
-        return Response(content="index.html not found", status_code=404)
+    spa_shell = SPAShell(FRONTEND_DIR / "index.html")
 
-    app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="frontend")
+    @app.get("/", include_in_schema=False)
+    @app.get("/{path}", name="React request hits here", include_in_schema=False)
+    async def serve_react_app(request: Request, path: str = ""):
+        return spa_shell.response(request)
+
+    app.mount(
+        "/",
+        PrecompressedStaticFiles(directory=FRONTEND_DIR, html=True),
+        name="frontend",
+    )
@@ -0,0 +1,173 @@
+"""Per request performance metrics
+
+`RequestMetrics` of the request being served are kept in a context variable
+so that they follow it into the threads its database queries run in. They
+record the queries made and their time, through a wrapper installed on every
+database connection, and the time taken to serialize the response, through
+`InstrumentedRoute`. `instrument_request` in `api` reports them as
+`Server-Timing` headers and log lines.
+"""
+
+import asyncio
+import logging
+import functools
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+from django.db.backends.signals import connection_created
+from hospital_ms.settings import REQUEST_QUERIES_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started_at = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.returned_at: float | None = None
+        # Queries of a request may run in several threads
+        self._lock = threading.Lock()
+
+    def add_query(self, duration: float):
+        with self._lock:
+            self.queries += 1
+            self.db_time += duration
+
+    def add_serialization(self, duration: float):
+        with self._lock:
+            self.serialization_time += duration
+
+    @property
+    def total_time(self) -> float:
+        return perf_counter() - self.started_at
+
+    def server_timing(self, total_time: float) -> str:
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries", '
+            f"serialize;dur={self.serialization_time * 1000:.2f}, "
+            f"total;dur={total_time * 1000:.2f}"
+        )
+
+
+current_metrics: ContextVar[RequestMetrics | None] = ContextVar(
+    "current_metrics", default=None
+)
+"""Metrics of the request being served"""
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(perf_counter() - start)
+
+
+def instrument_connection(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(instrument_connection)
+
+
+@contextmanager
+def measure_serialization():
+    """Adds the time taken by the block to the request's serialization time"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_metrics.get()
+        if metrics is not None:
+            metrics.add_serialization(perf_counter() - start)
+
+
+def mark_returned(call: Callable) -> Callable:
+    """Wraps endpoint `call` to note when it returns"""
+
+    def mark():
+        metrics = current_metrics.get()
+        if metrics is not None:
+            metrics.returned_at = perf_counter()
+
+    if asyncio.iscoroutinefunction(call):
+
+        @functools.wraps(call)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                mark()
+
+    else:
+
+        @functools.wraps(call)
+        def wrapper(*args, **kwargs):
+            try:
+                return call(*args, **kwargs)
+            finally:
+                mark()
+
+    return wrapper
+
+
+class InstrumentedRoute(APIRoute):
+    """`APIRoute` timing the serialization of its responses i.e from its
+    endpoint returning to the response being ready"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Once set up so that the endpoint itself is introspected
+        self.dependant.call = mark_returned(self.dependant.call)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def instrumented_handler(request: Request) -> Response:
+            response = await handler(request)
+            metrics = current_metrics.get()
+            if metrics is not None and metrics.returned_at is not None:
+                metrics.add_serialization(perf_counter() - metrics.returned_at)
+            return response
+
+        return instrumented_handler
+
+
+def route_name(request: Request) -> str:
+    """Path template of the route that served `request`, or its path"""
+    route = request.scope.get("route")
+    return getattr(route, "path_format", None) or request.url.path
+
+
+def log_request(
+    request: Request, response: Response, metrics: RequestMetrics, total_time: float
+):
+    """Logs a line of `key=value` pairs. Requests making more than
+    `REQUEST_QUERIES_THRESHOLD` queries are logged as warnings."""
+    fields = {
+        "method": request.method,
+        "route": route_name(request),
+        "status": response.status_code,
+        "duration_ms": round(total_time * 1000, 2),
+        "queries": metrics.queries,
+        "db_ms": round(metrics.db_time * 1000, 2),
+        "serialize_ms": round(metrics.serialization_time * 1000, 2),
+    }
+    excessive = metrics.queries > REQUEST_QUERIES_THRESHOLD
+    if excessive:
+        fields["excessive_queries"] = "true"
+    logger.log(
+        logging.WARNING if excessive else logging.INFO,
+        " ".join(f"{key}={value}" for key, value in fields.items()),
+        extra={"request_metrics": fields},
+    )
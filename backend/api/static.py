@@ -0,0 +1,274 @@
+"""Static files serving
+
+`PrecompressedStaticFiles` serves the `.br`/`.gz` variants written by
+`manage.py compress_assets` to clients that accept them, and lets browsers
+keep fingerprinted assets for good. `SPAShell` serves the frontend's
+`index.html` from memory and `serve_thumbnail` resized media images.
+"""
+
+import os
+import re
+import gzip
+import time
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import django
+from concurrent.futures import ProcessPoolExecutor
+from mimetypes import guess_type
+from pathlib import Path
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from starlette.types import Scope
+from fastapi import HTTPException, status
+from PIL import Image
+from api.v1.cache import etag_matches
+from hospital_ms.utils.compress import is_compressible, brotli
+from hospital_ms.utils import images
+from hospital_ms.settings import (
+    STATIC_MAX_AGE,
+    IMMUTABLE_ASSETS_PATTERN,
+    THUMBNAIL_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+content_encodings = {"br": ".br", "gzip": ".gz"}
+"""Content encoding of each precompressed variant, in order of preference"""
+
+immutable_assets = re.compile(IMMUTABLE_ASSETS_PATTERN)
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    """Content codings a client accepts going by its `Accept-Encoding`"""
+    encodings = set()
+    for value in accept_encoding.split(","):
+        coding, _, parameters = value.strip().partition(";")
+        quality = parameters.strip().removeprefix("q=")
+        try:
+            if parameters and float(quality) <= 0:
+                continue
+        except ValueError:
+            continue
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+def cache_control(path: str, full_path: str) -> str:
+    """Cache-Control of the file at `full_path` requested as `path`"""
+    if full_path.endswith(".html"):
+        # Pages name the current assets so they are always revalidated
+        return "no-cache"
+    if immutable_assets.search(path):
+        # The name changes with the content
+        return "public, max-age=31536000, immutable"
+    return f"public, max-age={STATIC_MAX_AGE}"
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """`StaticFiles` that prefers precompressed variants of files"""
+
+    def precompressed(
+        self, full_path: str, stat_result: os.stat_result, headers: Headers
+    ) -> tuple[str, str, os.stat_result] | None:
+        """(encoding, path, stat) of the variant of `full_path` to serve"""
+        # Ranges are of the file itself
+        if "range" in headers:
+            return None
+        accepted = accepted_encodings(headers.get("accept-encoding", ""))
+        for encoding, extension in content_encodings.items():
+            if encoding not in accepted:
+                continue
+            variant = f"{full_path}{extension}"
+            try:
+                variant_stat = os.stat(variant)
+            except OSError:
+                continue
+            if variant_stat.st_mtime >= stat_result.st_mtime:
+                return encoding, variant, variant_stat
+        return None
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        compressible = is_compressible(Path(full_path))
+        found = (
+            self.precompressed(full_path, stat_result, request_headers)
+            if compressible
+            else None
+        )
+        if found is None:
+            response = FileResponse(
+                full_path, status_code=status_code, stat_result=stat_result
+            )
+        else:
+            encoding, variant, variant_stat = found
+            response = FileResponse(
+                variant,
+                status_code=status_code,
+                stat_result=variant_stat,
+                media_type=guess_type(full_path)[0] or "text/plain",
+                headers={"Content-Encoding": encoding},
+            )
+        if compressible:
+            response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = cache_control(
+            self.get_path(scope), full_path
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+class SPAShell:
+    """`index.html` of the frontend kept in memory, compressed and with an
+    ETag. The file is reloaded when its modification time changes, checked at
+    most once every `check_interval` seconds."""
+
+    def __init__(self, path: Path, check_interval: float = 2):
+        self.path = path
+        self.check_interval = check_interval
+        self.etag = None
+        self._variants: dict[str, bytes] = {}
+        self._mtime = None
+        self._checked_at = None
+
+    def load(self, mtime: float):
+        content = self.path.read_bytes()
+        variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants["br"] = brotli.compress(content, quality=11)
+        self._variants = {"identity": content, **variants}
+        self.etag = f'"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+        self._mtime = mtime
+
+    def refresh(self) -> bool:
+        """Reloads the file if it has changed. Returns whether it exists."""
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                mtime = self.path.stat().st_mtime
+            except OSError:
+                self._variants = {}
+                self._mtime = None
+                return False
+            if mtime != self._mtime:
+                self.load(mtime)
+        return bool(self._variants)
+
+    def response(self, request: Request) -> Response:
+        if not self.refresh():
+            return Response(content="index.html not found", status_code=404)
+        headers = {
+            # Weak as it is shared by the compressed variants
+            "ETag": f"W/{self.etag}",
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=304, headers=headers)
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        for encoding in content_encodings:
+            if encoding in accepted and encoding in self._variants:
+                return Response(
+                    content=self._variants[encoding],
+                    media_type="text/html",
+                    headers={**headers, "Content-Encoding": encoding},
+                )
+        return Response(
+            content=self._variants["identity"], media_type="text/html", headers=headers
+        )
+
+
+class Thumbnails:
+    """Generates thumbnails in a pool of processes, once per thumbnail however
+    many requests ask for it at the same time"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending: dict[Path, asyncio.Future] = {}
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # Forking a process running an event loop and threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                # `hospital_ms.utils` imports models
+                initializer=django.setup,
+            )
+        return self._pool
+
+    async def get(self, source: Path, width: int, height: int, format: str) -> Path:
+        """Path of the thumbnail, generated if it is not cached yet"""
+        destination = await asyncio.to_thread(
+            images.thumbnail_path, source, width, height, format
+        )
+        if destination.exists():
+            return destination
+        future = self._pending.get(destination)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.pool,
+                images.make_thumbnail,
+                str(source),
+                str(destination),
+                width,
+                height,
+                format,
+            )
+            self._pending[destination] = future
+            future.add_done_callback(
+                lambda future: self._pending.pop(destination, None)
+            )
+        # A client going away should not cancel it for the others
+        await asyncio.shield(future)
+        return destination
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+thumbnails = Thumbnails(THUMBNAIL_WORKERS)
+
+
+async def serve_thumbnail(request: Request, width: int, height: int, path: str):
+    """`width`x`height` thumbnail of the media image at `path`, as WebP for
+    clients accepting it. Either dimension may be 0 to keep the aspect ratio."""
+    source = images.media_path(path)
+    if source is None or not images.is_allowed_size(width, height):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    format = images.thumbnail_format(source, request.headers.get("accept", ""))
+    try:
+        thumbnail = await thumbnails.get(source, width, height, format)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Failed to make thumbnail of {source}: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Image could not be processed",
+        )
+    response = FileResponse(
+        thumbnail,
+        stat_result=await asyncio.to_thread(os.stat, thumbnail),
+        media_type=f"image/{format}",
+        headers={
+            "Cache-Control": f"public, max-age={STATIC_MAX_AGE}",
+            "Vary": "Accept",
+        },
+    )
+    if etag_matches(request.headers.get("if-none-match"), response.headers["etag"]):
+        return NotModifiedResponse(response.headers)
+    return response
@@ -0,0 +1,385 @@
+"""Caches for v1
+"""
+
+import copy
+import time
+import inspect
+import hashlib
+import threading
+import functools
+from collections import OrderedDict
+from typing import Callable
+from fastapi import Request, Response, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Model
+from django.db.models.signals import pre_save, post_save, post_delete
+from users.models import CustomUser
+from hospital.models import Patient
+from hospital_ms import settings
+from hospital_ms.utils.renditions import renditions_recorded
+from hospital_ms.utils.versions import SharedVersions
+from api.metrics import measure_serialization
+
+
+class TokenCache:
+    """Bounded LRU cache mapping api tokens to resolved patients.
+
+    Entries hold the `Patient` together with its `CustomUser` (and therefore
+    the account id). The account row itself is never cached so balances are
+    always read fresh. Each entry is checked against the shared version of
+    its user, bumped whenever the user changes, so that a rotated or revoked
+    token stops working in every process at once.
+    """
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: float = 300, alias: str = "default"
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.versions = SharedVersions("v1-token", alias)
+        self._entries: OrderedDict[str, tuple[float, Patient, int]] = OrderedDict()
+        self._tokens_by_user: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    async def aget(self, token: str) -> Patient | None:
+        """`get` for the event loop. The shared version, a network round trip
+        with some cache backends, is read in the threadpool and only for
+        tokens cached here."""
+        if token not in self._entries:
+            with self._lock:
+                self.misses += 1
+            return None
+        return await run_in_threadpool(self.get, token)
+
+    def get(self, token: str) -> Patient | None:
+        entry = self._entries.get(token)
+        # Read outside the lock, it may be a network round trip
+        version = None if entry is None else self.versions.get(str(entry[1].user_id))
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] < time.monotonic() or entry[2] != version:
+                if entry is not None:
+                    self._discard(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            patient = entry[1]
+        # Each request gets its own instance to mutate
+        return copy.deepcopy(patient)
+
+    def set(self, token: str, patient: Patient):
+        patient = copy.deepcopy(patient)
+        # Keep the finance account out of the cache
+        patient.user._state.fields_cache.pop("account", None)
+        version = self.versions.get(str(patient.user_id))
+        with self._lock:
+            self._discard(token)
+            self._discard(self._tokens_by_user.get(patient.user_id))
+            self._entries[token] = (time.monotonic() + self.ttl, patient, version)
+            self._tokens_by_user[patient.user_id] = token
+            while len(self._entries) > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._discard(token)
+
+    def invalidate_user(self, user_id: int):
+        """Drops the user's token here and in every other process"""
+        self.versions.bump(str(user_id))
+        with self._lock:
+            self._discard(self._tokens_by_user.get(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits=self.hits, misses=self.misses, size=len(self._entries)
+        )
+
+    def _discard(self, token: str | None):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            self._tokens_by_user.pop(entry[1].user_id, None)
+
+
+token_cache = TokenCache(
+    maxsize=settings.TOKEN_CACHE_SIZE,
+    ttl=settings.TOKEN_CACHE_TTL,
+    alias=settings.TOKEN_CACHE_ALIAS,
+)
+"""Token to patient cache used by `get_patient`"""
+
+
+def _invalidate_on_commit(user_id: int):
+    # Other processes would otherwise fetch the user again before the change
+    # is visible to them and cache it as current
+    transaction.on_commit(lambda: token_cache.invalidate_user(user_id))
+
+
+def _invalidate_user_token(sender, instance: CustomUser, **kwargs):
+    _invalidate_on_commit(instance.pk)
+
+
+def _invalidate_patient_token(sender, instance: Patient, **kwargs):
+    _invalidate_on_commit(instance.user_id)
+
+
+post_save.connect(_invalidate_user_token, sender=CustomUser)
+post_delete.connect(_invalidate_user_token, sender=CustomUser)
+renditions_recorded.connect(_invalidate_user_token, sender=CustomUser)
+post_delete.connect(_invalidate_patient_token, sender=Patient)
+
+
+CachedResponse = tuple[str, bytes, dict[str, str]]
+"""ETag, encoded body and extra headers of a response"""
+
+
+class LocMemResponseBackend:
+    """Bounded LRU of encoded responses in the process. Versions are shared
+    across processes through a Django cache so that a change made in any of
+    them invalidates the entries of all."""
+
+    def __init__(self, maxsize: int = 256, alias: str = "default"):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._versions = SharedVersions("v1-response", alias)
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> CachedResponse | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    async def set(self, key: str, entry: CachedResponse):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    async def versions(self, groups: tuple[str, ...]) -> tuple[int, ...]:
+        return self._versions.get_many(groups)
+
+    def bump(self, group: str):
+        self._versions.bump(group)
+
+
+class DjangoResponseBackend:
+    """Encoded responses and versions kept in a Django cache so that they are
+    shared across processes"""
+
+    key_prefix = "v1-response"
+
+    def __init__(self, alias: str = "default"):
+        self.alias = alias
+        self._versions = SharedVersions(self.key_prefix, alias)
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    async def get(self, key: str) -> CachedResponse | None:
+        return await self.cache.aget(f"{self.key_prefix}:{key}")
+
+    async def set(self, key: str, entry: CachedResponse):
+        # Stale entries are never read again once versions move on
+        await self.cache.aset(f"{self.key_prefix}:{key}", entry, timeout=None)
+
+    async def versions(self, groups: tuple[str, ...]) -> tuple[int, ...]:
+        return self._versions.get_many(groups)
+
+    def bump(self, group: str):
+        self._versions.bump(group)
+
+
+class ResponseCache:
+    """Caches JSON encoded responses of anonymous endpoints.
+
+    An entry is keyed by the endpoint, its query string and the versions of
+    the models it is built from. Saving or deleting any of those models bumps
+    its version so that the entry is rebuilt on the next request.
+    """
+
+    def __init__(self, backend: LocMemResponseBackend | DjangoResponseBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._groups: set[str] = set()
+
+    @staticmethod
+    def group(model: type[Model], fields: tuple[str, ...] = None) -> str:
+        label = model._meta.label
+        return f"{label}:{','.join(sorted(fields))}" if fields else label
+
+    def watch(self, model: type[Model], fields: tuple[str, ...] = None):
+        """Bumps version of `model` whenever its rows change, or only when
+        they are added, deleted or saved with changes to `fields`"""
+        group = self.group(model, fields)
+        if group in self._groups:
+            return
+        self._groups.add(group)
+
+        def bump_version(sender, **kwargs):
+            transaction.on_commit(lambda: self.backend.bump(group))
+
+        post_delete.connect(bump_version, sender=model, weak=False)
+        if not fields:
+            post_save.connect(bump_version, sender=model, weak=False)
+            renditions_recorded.connect(bump_version, sender=model, weak=False)
+            return
+
+        model_fields = [model._meta.get_field(name) for name in fields]
+
+        def values(instance: Model) -> list:
+            return [
+                field.get_prep_value(field.value_from_object(instance))
+                for field in model_fields
+            ]
+
+        def check_fields(sender, instance: Model, update_fields=None, **kwargs):
+            if update_fields is not None and not set(fields) & set(update_fields):
+                # e.g `last_login` saved on login
+                changed = False
+            elif instance._state.adding:
+                changed = True
+            else:
+                stored = (
+                    sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+                )
+                changed = stored is None or list(stored) != values(instance)
+            instance.__dict__.setdefault("_changed_groups", set())
+            if changed:
+                instance._changed_groups.add(group)
+            else:
+                instance._changed_groups.discard(group)
+
+        def bump_changed(sender, instance: Model, **kwargs):
+            if group in getattr(instance, "_changed_groups", ()):
+                bump_version(sender)
+
+        pre_save.connect(check_fields, sender=model, weak=False)
+        post_save.connect(bump_changed, sender=model, weak=False)
+
+    def cached(
+        self,
+        *models: type[Model],
+        fields: dict[type[Model], tuple[str, ...]] = None,
+    ) -> Callable:
+        """Serves the decorated async endpoint from cache.
+
+        The endpoint's return annotation is used to encode its result, just as
+        FastAPI would, and the response carries an ETag so that clients can
+        revalidate with `If-None-Match`. Entries of models given `fields` are
+        only invalidated by changes to those, e.g the columns of a related
+        model that the response renders.
+        """
+        fields = fields or {}
+        for model in models:
+            self.watch(model, fields.get(model))
+        groups = tuple(sorted(self.group(model, fields.get(model)) for model in models))
+
+        def decorator(func: Callable) -> Callable:
+            signature = inspect.signature(func)
+            adapter = TypeAdapter(signature.return_annotation)
+            name = f"{func.__module__}.{func.__qualname__}"
+
+            @functools.wraps(func)
+            async def wrapper(*args, _request: Request, **kwargs) -> Response:
+                versions = await self.backend.versions(groups)
+                query = "&".join(
+                    f"{key}={value}"
+                    for key, value in sorted(_request.query_params.multi_items())
+                )
+                key = f"{name}:{'.'.join(map(str, versions))}:{query}"
+                entry = await self.backend.get(key)
+                if entry is None:
+                    self.misses += 1
+                    content = await func(*args, **kwargs)
+                    with measure_serialization():
+                        body = adapter.dump_json(
+                            adapter.validate_python(content), by_alias=True
+                        )
+                    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+                    # Headers set by the endpoint e.g pagination cursors
+                    extra_headers = {
+                        name: value
+                        for argument in kwargs.values()
+                        if isinstance(argument, Response)
+                        for name, value in argument.headers.items()
+                    }
+                    entry = (etag, body, extra_headers)
+                    await self.backend.set(key, entry)
+                else:
+                    self.hits += 1
+                etag, body, extra_headers = entry
+                headers = {
+                    **extra_headers,
+                    "ETag": etag,
+                    "Cache-Control": "no-cache",
+                }
+                if etag_matches(_request.headers.get("if-none-match"), etag):
+                    return Response(
+                        status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+                    )
+                return Response(
+                    content=body, media_type="application/json", headers=headers
+                )
+
+            wrapper.__signature__ = signature.replace(
+                parameters=[
+                    *signature.parameters.values(),
+                    inspect.Parameter(
+                        "_request", inspect.Parameter.KEYWORD_ONLY, annotation=Request
+                    ),
+                ]
+            )
+            return wrapper
+
+        return decorator
+
+    def invalidate(self, model: type[Model]):
+        """Invalidates entries built from `model` rows"""
+        label = model._meta.label
+        for group in self._groups:
+            if group == label or group.startswith(f"{label}:"):
+                self.backend.bump(group)
+
+    def clear(self):
+        """Invalidates every entry"""
+        for group in self._groups:
+            self.backend.bump(group)
+
+    def stats(self) -> dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (
+        candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")
+    )
+
+
+response_cache = ResponseCache(
+    DjangoResponseBackend(settings.RESPONSE_CACHE_ALIAS)
+    if settings.RESPONSE_CACHE_BACKEND == "django"
+    else LocMemResponseBackend(
+        settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_ALIAS
+    )
+)
+"""Encoded responses cache of public content endpoints"""
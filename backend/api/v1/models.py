@@ -1,7 +1,15 @@
-from pydantic import BaseModel, Field, field_validator, FutureDatetime, Field, HttpUrl
+from pydantic import (
+    BaseModel,
+    Field,
+    field_validator,
+    computed_field,
+    FutureDatetime,
+    HttpUrl,
+)
 from typing import Optional, Any
 from datetime import datetime, date
 from hospital_ms.settings import MEDIA_URL
+from hospital_ms.utils.images import srcset
 from users.models import CustomUser
 from hospital.models import (
     Treatment,
@@ -333,6 +341,9 @@ class AvailableDoctor(BaseModel):
     profile: Optional[str] = None
     working_days: list[WorkingDay.DaysOfWeek]
     department_name: str
+    renditions: Optional[dict] = Field(
+        None, exclude=True, description="Renditions recorded of the profile"
+    )
 
     @field_validator("profile")
     def validate_file(value):
@@ -340,6 +351,12 @@ class AvailableDoctor(BaseModel):
             return path.join(MEDIA_URL, value)
         return value
 
+    @computed_field
+    @property
+    def profile_srcset(self) -> Optional[str]:
+        """Thumbnails of the profile for `<img srcset>`"""
+        return srcset(self.profile, self.renditions)
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -399,6 +416,25 @@ class DoctorDetails(BaseModel):
         }
 
 
+class DoctorDayAvailability(BaseModel):
+    date: date
+    is_working_day: bool
+    appointments_limit: int
+    booked: int
+    available: int
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "date": "2023-01-02",
+                "is_working_day": True,
+                "appointments_limit": 20,
+                "booked": 7,
+                "available": 13,
+            }
+        }
+
+
 class NewAppointmentWithDoctor(BaseModel):
     doctor_id: int
     appointment_datetime: FutureDatetime
@@ -499,6 +535,9 @@ class DepartmentInfo(BaseModel):
     specialities: list[SpecialityInfo]
     profile: Optional[str] = None
     created_at: datetime
+    renditions: Optional[dict] = Field(
+        None, exclude=True, description="Renditions recorded of the profile"
+    )
 
     @field_validator("profile")
     def validate_file(value):
@@ -506,6 +545,12 @@ class DepartmentInfo(BaseModel):
             return path.join(MEDIA_URL, value)
         return value
 
+    @computed_field
+    @property
+    def profile_srcset(self) -> Optional[str]:
+        """Thumbnails of the profile for `<img srcset>`"""
+        return srcset(self.profile, self.renditions)
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -551,6 +596,43 @@ class SendMPESAPopupTo(BaseModel):
         }
 
 
+class STKCallback(BaseModel):
+    MerchantRequestID: Optional[str] = None
+    CheckoutRequestID: Optional[str] = None
+    ResultCode: int
+    ResultDesc: Optional[str] = ""
+    CallbackMetadata: Optional[dict] = None
+
+
+class STKCallbackBody(BaseModel):
+    stkCallback: STKCallback
+
+
+class MpesaCallback(BaseModel):
+    Body: STKCallbackBody
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "Body": {
+                    "stkCallback": {
+                        "MerchantRequestID": "29115-34620561-1",
+                        "CheckoutRequestID": "ws_CO_191220191020363925",
+                        "ResultCode": 0,
+                        "ResultDesc": "The service request is processed successfully.",
+                        "CallbackMetadata": {
+                            "Item": [
+                                {"Name": "Amount", "Value": 100},
+                                {"Name": "MpesaReceiptNumber", "Value": "NLJ7RT61SV"},
+                                {"Name": "PhoneNumber", "Value": 254708374149},
+                            ]
+                        },
+                    }
+                }
+            }
+        }
+
+
 class HospitalGallery(BaseModel):
     title: str
     details: str
@@ -558,6 +640,9 @@ class HospitalGallery(BaseModel):
     video_link: Optional[HttpUrl] = Field(None, description="Youtube video link")
     picture: Optional[str] = None
     date: date
+    renditions: Optional[dict] = Field(
+        None, exclude=True, description="Renditions recorded of the picture"
+    )
 
     @field_validator("picture")
     def validate_file(value):
@@ -565,6 +650,12 @@ class HospitalGallery(BaseModel):
             return path.join(MEDIA_URL, value)
         return value
 
+    @computed_field
+    @property
+    def picture_srcset(self) -> Optional[str]:
+        """Thumbnails of the picture for `<img srcset>`"""
+        return srcset(self.picture, self.renditions)
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -641,6 +732,9 @@ class ShallowHospitalNews(BaseModel):
     cover_photo: Optional[str]
     created_at: datetime
     views: int
+    renditions: Optional[dict] = Field(
+        None, exclude=True, description="Renditions recorded of the cover photo"
+    )
 
     @field_validator("cover_photo")
     def validate_cover_photo(value):
@@ -648,6 +742,12 @@ class ShallowHospitalNews(BaseModel):
             return path.join(MEDIA_URL, value)
         return value
 
+    @computed_field
+    @property
+    def cover_photo_srcset(self) -> Optional[str]:
+        """Thumbnails of the cover photo for `<img srcset>`"""
+        return srcset(self.cover_photo, self.renditions)
+
     class Config:
         json_schema_extra = {
             "example": {
@@ -0,0 +1,97 @@
+"""Keyset pagination for v1 list endpoints
+
+Rows are ordered newest first by (created_at, id) and a page starts right
+after the (created_at, id) of the last row of the previous page. The pair is
+handed to clients as an opaque cursor, so that every page costs one index
+range scan no matter how deep it is.
+"""
+
+import json
+import base64
+import binascii
+from datetime import datetime
+from typing import Annotated, Iterable, TypeVar, Callable
+from fastapi import Query, Response, HTTPException, status
+from django.db.models import Q, QuerySet
+
+T = TypeVar("T")
+
+ordering = ("-created_at", "-id")
+"""Ordering every paginated queryset is given"""
+
+next_cursor_header = "X-Next-Cursor"
+"""Response header carrying cursor of the next page"""
+
+CursorQuery = Annotated[
+    str,
+    Query(
+        description=f"Cursor of the page to return. Taken from the "
+        f"`{next_cursor_header}` header of the previous page."
+    ),
+]
+
+Cursor = tuple[datetime, int]
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    return (
+        base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), id]).encode())
+        .decode()
+        .rstrip("=")
+    )
+
+
+def decode_cursor(cursor: str | None) -> Cursor | None:
+    """Decodes a cursor given by a client. Raises 400 if it is malformed."""
+    if not cursor:
+        return None
+    try:
+        created_at, id = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor.",
+        )
+
+
+def paginate(queryset: QuerySet, cursor: str | None, limit: int) -> QuerySet:
+    """Orders and slices `queryset` to the page following `cursor`.
+
+    One row more than `limit` is fetched so that `page` can tell whether
+    there is a next page.
+    """
+    position = decode_cursor(cursor)
+    if position:
+        created_at, id = position
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=id)
+        )
+    return queryset.order_by(*ordering)[: limit + 1]
+
+
+def paginate_items(
+    items: Iterable[T], cursor: str | None, limit: int
+) -> list[T]:
+    """`paginate` for in-memory items having `created_at` and `id`"""
+    position = decode_cursor(cursor)
+    items = sorted(items, key=lambda item: (item.created_at, item.id), reverse=True)
+    if position:
+        items = [item for item in items if (item.created_at, item.id) < position]
+    return items[: limit + 1]
+
+
+def page(
+    rows: list[T],
+    limit: int,
+    response: Response,
+    key: Callable[[T], Cursor] = lambda row: (row.created_at, row.id),
+) -> list[T]:
+    """Trims the extra row fetched by `paginate` and sets the next cursor
+    header when there are more rows"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[next_cursor_header] = encode_cursor(*key(rows[-1]))
+    return rows
@@ -1,22 +1,45 @@
-from fastapi import APIRouter, status, HTTPException, Depends, Query, Path, Form
+from fastapi import (
+    APIRouter,
+    status,
+    HTTPException,
+    Depends,
+    Query,
+    Path,
+    Form,
+    Response,
+)
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security.oauth2 import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from users.models import CustomUser
 from hospital.models import (
     Patient,
     Treatment,
+    TreatmentMedicine,
     Appointment,
 )
-from staffing.models import Doctor, Speciality, Department
-from finance.models import Account
+from staffing.models import Doctor, Speciality, Department, WorkingDay
+from staffing.availability import availability_index
+from finance.models import Account, LedgerEntry, PaymentPushJob
+from finance.mpesa import normalize_phone_number, reconcile
+from finance.exceptions import PaymentAmountMismatchError
 
 from external.models import Gallery, About, News, Subscriber, ServiceFeedback
+from external.counters import news_views
+from external.mailing import queue_subscription_confirmation
 
-from hospital.utils import send_payment_push
+from hospital.capacity import capacity_calendar
+from hospital.exceptions import AppointmentLimitReachedError
 
 # from django.contrib.auth.hashers import check_password
 from django.db import IntegrityError
-from api.v1.utils import token_id, generate_token, get_day_and_shift
+from django.db.models import Prefetch, Count, F
+from django.utils import timezone
+from api.v1.utils import token_id, generate_token, run_in_thread
+from api.v1.cache import token_cache, response_cache
+from api.metrics import InstrumentedRoute
+from api.v1.pagination import CursorQuery, paginate, paginate_items, page
+from hospital_ms.utils import export
 from api.v1.models import (
     TokenAuth,
     Profile,
@@ -26,6 +49,7 @@ from api.v1.models import (
     EditablePersonalData,
     AvailableDoctor,
     DoctorDetails,
+    DoctorDayAvailability,
     NewAppointmentWithDoctor,
     UpdateAppointmentWithDoctor,
     AvailableAppointmentWithDoctor,
@@ -33,6 +57,7 @@ from api.v1.models import (
     SpecialityInfo,
     PaymentAccountDetails,
     SendMPESAPopupTo,
+    MpesaCallback,
     HospitalGallery,
     HospitalAbout,
     ShallowHospitalNews,
@@ -43,13 +68,12 @@ from api.v1.models import (
     CompleteFeedbackInfo,
 )
 from pydantic import PositiveInt, EmailStr
-from uuid import uuid4
+from uuid import uuid4, UUID
 
-import asyncio
-from typing import Annotated
-from datetime import datetime
+from typing import Annotated, Literal
+from datetime import datetime, date, timedelta
 
-router = APIRouter(prefix="/v1", tags=["v1"])
+router = APIRouter(prefix="/v1", tags=["v1"], route_class=InstrumentedRoute)
 
 
 v1_auth_scheme = OAuth2PasswordBearer(
@@ -64,16 +88,24 @@ async def get_patient(token: Annotated[str, Depends(v1_auth_scheme)]) -> Patient
         try:
             if token.startswith(token_id):
 
+                patient = await token_cache.aget(token)
+                if patient is not None:
+                    return patient
+
                 def fetch_user(token) -> Patient:
-                    user = CustomUser.objects.get(token=token)
                     try:
-                        return user.patient
-                    except CustomUser.patient.RelatedObjectDoesNotExist:
-                        new_patient = Patient.objects.create(user=user)
-                        new_patient.save()
-                        return new_patient
-
-                return await asyncio.to_thread(fetch_user, token)
+                        patient = Patient.objects.select_related("user").get(
+                            user__token=token
+                        )
+                    except Patient.DoesNotExist:
+                        user = CustomUser.objects.get(token=token)
+                        patient = Patient.objects.create(user=user)
+                        patient.save()
+                    # Also reads the shared version
+                    token_cache.set(token, patient)
+                    return patient
+
+                return await run_in_thread(fetch_user, token)
 
         except CustomUser.DoesNotExist:
             pass
@@ -85,6 +117,19 @@ async def get_patient(token: Annotated[str, Depends(v1_auth_scheme)]) -> Patient
     )
 
 
+async def get_staff_user(
+    token: Annotated[str, Depends(v1_auth_scheme)]
+) -> CustomUser:
+    """Ensures token passed belongs to a staff member"""
+    try:
+        return await run_in_thread(CustomUser.objects.get, token=token, is_staff=True)
+    except CustomUser.DoesNotExist:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Staff token required",
+        )
+
+
 @router.post("/token", name="User token")
 def fetch_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
@@ -118,6 +163,7 @@ def fetch_token(
 
 @router.patch("/token", name="Generate new token")
 def generate_new_token(patient: Annotated[Patient, Depends(get_patient)]) -> TokenAuth:
+    token_cache.invalidate(patient.user.token)
     patient.user.token = generate_token()
     patient.user.save()
     return TokenAuth(access_token=patient.user.token)
@@ -167,52 +213,70 @@ def update_personal_info(
 
 
 @router.get("/user/exists", name="Check if username exists")
-def check_if_username_exists(
+async def check_if_username_exists(
     username: Annotated[str, Query(description="Username to check against")]
 ) -> Feedback:
     """Checks if account with a particular username exists
     - Useful when setting username at account creation
     """
-    try:
-        CustomUser.objects.get(username=username)
-        return Feedback(detail=True)
-    except CustomUser.DoesNotExist:
-        return Feedback(detail=False)
+    return Feedback(
+        detail=await run_in_thread(CustomUser.objects.filter(username=username).exists)
+    )
 
 
 @router.get("/about", name="Details about hospital")
-def get_hospital_details() -> HospitalAbout:
-    return HospitalAbout(**jsonable_encoder(About.objects.all().first()))
+@response_cache.cached(About)
+async def get_hospital_details() -> HospitalAbout:
+    return HospitalAbout(
+        **jsonable_encoder(await run_in_thread(About.objects.all().first))
+    )
 
 
 @router.get("/galleries", name="Hospital galleries")
-def get_hospital_galleries() -> list[HospitalGallery]:
+@response_cache.cached(Gallery)
+async def get_hospital_galleries(
+    response: Response,
+    limit: Annotated[
+        PositiveInt, Query(description="Galleries amount not to exceed", gt=0, le=100)
+    ] = 30,
+    cursor: CursorQuery = None,
+) -> list[HospitalGallery]:
+    galleries = await run_in_thread(
+        list, paginate(Gallery.objects.filter(show_in_index=True), cursor, limit)
+    )
     return [
         HospitalGallery(**jsonable_encoder(gallery))
-        for gallery in Gallery.objects.filter(show_in_index=True)
-        .all()
-        .order_by("-created_at")[:30]
+        for gallery in page(galleries, limit, response)
     ]
 
 
 @router.get("/news", name="News published")
-def get_published_news() -> list[ShallowHospitalNews]:
+@response_cache.cached(News)
+async def get_published_news(
+    response: Response,
+    limit: Annotated[
+        PositiveInt, Query(description="News amount not to exceed", gt=0, le=100)
+    ] = 100,
+    cursor: CursorQuery = None,
+) -> list[ShallowHospitalNews]:
+    news_list = await run_in_thread(
+        list, paginate(News.objects.filter(is_published=True), cursor, limit)
+    )
     return [
         HospitalNews(**jsonable_encoder(news))
-        for news in News.objects.filter(is_published=True).order_by("-created_at")
+        for news in page(news_list, limit, response)
     ]
 
 
 @router.get("/news/{id}", name="News in detail")
-def get_published_news_details(
+async def get_published_news_details(
     id: Annotated[int, Path(description="News ID")]
 ) -> HospitalNews:
     try:
-        target_news = News.objects.get(pk=id, is_published=True)
+        target_news = await run_in_thread(News.objects.get, pk=id, is_published=True)
         target_news_dict = jsonable_encoder(target_news)
-        target_news.views += 1
-        target_news_dict["views"] += 1
-        target_news.save()
+        # Views are written behind in bulk, see `external.counters`
+        target_news_dict["views"] += news_views.increment(target_news.id)
         return HospitalNews(**target_news_dict)
     except News.DoesNotExist:
         raise HTTPException(
@@ -231,7 +295,7 @@ def add_subscription(
             token=uuid4(),
         )
         new_subscriber.save()
-        # TODO: Send confirmation link to email
+        queue_subscription_confirmation(new_subscriber)
         return Feedback(detail="Check your email inbox to confirm subscription.")
     except IntegrityError:
         raise HTTPException(
@@ -240,27 +304,83 @@ def add_subscription(
         )
 
 
+@router.get("/subscription/{token}/confirm", name="Confirm subscription")
+def confirm_subscription(
+    token: Annotated[UUID, Path(description="Subscription confirmation token")]
+) -> Feedback:
+    if not Subscriber.objects.filter(token=token).update(is_verified=True):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Subscription does not exist.",
+        )
+    return Feedback(detail="Subscription confirmed successfully.")
+
+
+@router.get("/subscription/{token}/cancel", name="Cancel subscription")
+def cancel_subscription(
+    token: Annotated[UUID, Path(description="Subscription confirmation token")]
+) -> Feedback:
+    if not Subscriber.objects.filter(token=token).delete()[0]:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Subscription does not exist.",
+        )
+    return Feedback(detail="Unsubscribed successfully.")
+
+
 @router.get("/feedbacks", name="Get user's feedbacks")
-def get_users_feedbacks() -> list[UserFeedback]:
+@response_cache.cached(
+    ServiceFeedback,
+    CustomUser,
+    # Of senders, as rendered by `UserFeedback.UserInfo`
+    fields={CustomUser: ("username", "first_name", "last_name", "role", "profile")},
+)
+async def get_users_feedbacks(
+    response: Response,
+    limit: Annotated[
+        PositiveInt, Query(description="Feedbacks amount not to exceed", gt=0, le=100)
+    ] = 100,
+    cursor: CursorQuery = None,
+) -> list[UserFeedback]:
+    feedbacks = await run_in_thread(
+        list,
+        paginate(
+            ServiceFeedback.objects.filter(show_in_index=True).select_related(
+                "sender"
+            ),
+            cursor,
+            limit,
+        ),
+    )
     feedback_list = []
-    for feedback in (
-        ServiceFeedback.objects.filter(show_in_index=True).all().order_by("-created_at")
-    ):
-        user_feedback = jsonable_encoder(feedback)
+    for feedback in page(feedbacks, limit, response):
+        # sender is in the state cache, keep it out of the feedback itself
+        user_feedback = jsonable_encoder(feedback, exclude={"_state"})
         user_feedback["user"] = jsonable_encoder(feedback.sender)
         feedback_list.append(user_feedback)
     return feedback_list
 
 
 @router.get("/specialities", name="Specialities available")
-def get_available_specialities() -> list[str]:
-    return [speciality.name for speciality in Speciality.objects.all()]
+@response_cache.cached(Speciality)
+async def get_available_specialities() -> list[str]:
+    return await run_in_thread(list, Speciality.objects.values_list("name", flat=True))
 
 
 @router.get("/departments", name="Departments available")
-def get_available_departments() -> list[DepartmentInfo]:
+@response_cache.cached(Department, Speciality, Doctor)
+async def get_available_departments() -> list[DepartmentInfo]:
+    departments = await run_in_thread(
+        list,
+        Department.objects.prefetch_related(
+            Prefetch(
+                "specialities",
+                queryset=Speciality.objects.annotate(total_doctors=Count("doctors")),
+            )
+        ).order_by("-created_at"),
+    )
     department_list = []
-    for department in Department.objects.all().order_by("-created_at"):
+    for department in departments:
         department_list.append(
             DepartmentInfo(
                 name=department.name,
@@ -269,11 +389,12 @@ def get_available_departments() -> list[DepartmentInfo]:
                     SpecialityInfo(
                         name=speciality.name,
                         details=speciality.details,
-                        total_doctors=speciality.doctors.count(),
+                        total_doctors=speciality.total_doctors,
                     )
                     for speciality in department.specialities.all()
                 ],
                 profile=department.profile.name,
+                renditions=department.renditions,
                 created_at=department.created_at,
             )
         )
@@ -281,58 +402,49 @@ def get_available_departments() -> list[DepartmentInfo]:
 
 
 @router.get("/doctors", name="Doctors available")
-def get_doctors_available(
+async def get_doctors_available(
+    response: Response,
     at: Annotated[datetime, Query(description="Particular time filter")] = None,
     speciality_name: Annotated[str, Query(description="Doctor speciality name")] = None,
     limit: Annotated[
         PositiveInt, Query(description="Doctors amount not to exceed", gt=0, le=100)
     ] = 100,
-    offset: Annotated[
-        int, Query(description="Return doctors whose IDs are greater than this")
-    ] = -1,
+    cursor: CursorQuery = None,
 ) -> list[AvailableDoctor]:
-    if at:
-        day_of_week, work_shift = get_day_and_shift(at)
-        doctors = Doctor.objects.filter(
-            working_days__name=day_of_week,
-            shift=work_shift,
-            id__gt=offset,
-            speciality__isnull=False,
-        )
-    else:
-        doctors = Doctor.objects.filter(
-            id__gt=offset,
-            speciality__isnull=False,
-        )
-    if speciality_name:
-        doctors = doctors.filter(
-            speciality__name=speciality_name,
-            speciality__isnull=False,
-        )
-    available_doctors_list: list[AvailableDoctor] = []
-    for doctor in doctors[:limit]:
-        available_doctors_list.append(
-            AvailableDoctor(
-                id=doctor.id,
-                fullname=doctor.user.get_full_name(),
-                speciality=doctor.speciality.name,
-                profile=doctor.user.profile.name,
-                working_days=[
-                    day.name
-                    for day in doctor.working_days.all().order_by("-created_at")
-                ],
-                department_name=doctor.speciality.department.name,
-            )
+    # Served from the in-memory availability index
+    await run_in_thread(availability_index.ensure_built)
+    doctors = paginate_items(
+        availability_index.find(at, speciality_name), cursor, limit
+    )
+    return [
+        AvailableDoctor(
+            id=doctor.id,
+            fullname=doctor.fullname,
+            speciality=doctor.speciality,
+            profile=doctor.profile,
+            renditions=doctor.renditions,
+            working_days=doctor.working_days,
+            department_name=doctor.department_name,
         )
-    return available_doctors_list
+        for doctor in page(doctors, limit, response)
+    ]
 
 
 @router.get("/doctor/{id}", name="Details of specific doctor")
-def get_specific_doctor_details(
+async def get_specific_doctor_details(
     id: Annotated[int, Path(description="Doctor ID")]
 ) -> DoctorDetails:
     try:
-        target_doctor = Doctor.objects.get(id=id)
+        target_doctor = await run_in_thread(
+            Doctor.objects.select_related("user", "speciality__department")
+            .prefetch_related(
+                Prefetch(
+                    "working_days", queryset=WorkingDay.objects.order_by("-created_at")
+                )
+            )
+            .get,
+            id=id,
+        )
         user = target_doctor.user
         speciality = target_doctor.speciality
         return DoctorDetails(
@@ -341,10 +453,7 @@ def get_specific_doctor_details(
             last_name=user.last_name,
             email=user.email,
             phone_number=user.phone_number,
-            working_days=[
-                day.name
-                for day in target_doctor.working_days.all().order_by("-created_at")
-            ],
+            working_days=[day.name for day in target_doctor.working_days.all()],
             shift=target_doctor.shift,
             speciality=DoctorDetails.Speciality(
                 name=speciality.name,
@@ -356,13 +465,58 @@ def get_specific_doctor_details(
     except Doctor.DoesNotExist:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            details=f"Doctor with id {id} does not exist.",
+            detail=f"Doctor with id {id} does not exist.",
         )
 
 
+@router.get("/doctor/{id}/availability", name="Appointments capacity of a doctor")
+async def get_doctor_availability(
+    id: Annotated[int, Path(description="Doctor ID")],
+    from_: Annotated[
+        date, Query(alias="from", description="First date. Defaults to today.")
+    ] = None,
+    to: Annotated[
+        date, Query(description="Last date. Defaults to two weeks from first date.")
+    ] = None,
+) -> list[DoctorDayAvailability]:
+    """Appointments booked against the daily limit for each day in range
+    - Range can span at most 92 days.
+    """
+    from_ = from_ or timezone.localdate()
+    to = to or from_ + timedelta(days=13)
+    if to < from_ or (to - from_).days >= 92:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Date range must be ascending and span at most 92 days.",
+        )
+    try:
+        target_doctor = await run_in_thread(
+            Doctor.objects.select_related("speciality")
+            .prefetch_related("working_days")
+            .get,
+            pk=id,
+        )
+    except Doctor.DoesNotExist:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Doctor with id {id} does not exist.",
+        )
+    return [
+        DoctorDayAvailability(
+            date=day.date,
+            is_working_day=day.is_working_day,
+            appointments_limit=day.appointments_limit,
+            booked=day.booked,
+            available=day.available,
+        )
+        for day in await run_in_thread(capacity_calendar, target_doctor, from_, to)
+    ]
+
+
 @router.get("/treatments", name="Treatments ever administered")
 def get_treatments_ever_administered(
     patient: Annotated[Patient, Depends(get_patient)],
+    response: Response,
     treatment_status: Annotated[
         Treatment.TreatmentStatus, Query(description="Treatment status")
     ] = None,
@@ -372,24 +526,35 @@ def get_treatments_ever_administered(
     limit: Annotated[
         PositiveInt, Query(description="Treatments amount not to exceed", gt=0, le=100)
     ] = 100,
-    offset: Annotated[
-        int, Query(description="Return treatments whose IDs are greater than this")
-    ] = -1,
+    cursor: CursorQuery = None,
 ) -> list[ShallowPatientTreatment]:
 
-    treatment_list = []
-    query_filter = dict(patient=patient, id__gt=offset)
+    query_filter = dict(patient_id=patient.id)
     if treatment_status:
         query_filter["treatment_status"] = treatment_status.value
     if patient_type:
         query_filter["patient_type"] = patient_type.value
-    for treatment in (
-        Treatment.objects.filter(**query_filter).all().order_by("-created_at")[:limit]
-    ):
-        treatment_dict = jsonable_encoder(treatment)
-        treatment_dict["total_bill"] = treatment.total_bill
-        treatment_list.append(ShallowPatientTreatment(**treatment_dict))
-    return treatment_list
+    columns = [
+        name for name in ShallowPatientTreatment.model_fields if name != "total_bill"
+    ]
+    treatment_rows = list(
+        paginate(
+            Treatment.objects.filter(**query_filter).values(
+                *columns, total_bill=F("grand_total")
+            ),
+            cursor,
+            limit,
+        )
+    )
+    return [
+        ShallowPatientTreatment(**row)
+        for row in page(
+            treatment_rows,
+            limit,
+            response,
+            key=lambda row: (row["created_at"], row["id"]),
+        )
+    ]
 
 
 @router.get("/treatment/{id}", name="Get specific treatment details")
@@ -398,15 +563,40 @@ def get_specific_treatment_details(
     id: Annotated[int, Path(description="Treatment ID")],
 ) -> PatientTreatment:
     try:
-        treatment = Treatment.objects.get(pk=id)
-        if treatment.patient == patient:
-            treatment_dict: dict = jsonable_encoder(treatment)
-            treatment_dict.update(
-                dict(
-                    total_medicine_bill=treatment.total_medicine_bill,
-                    total_treatment_bill=treatment.total_treatment_bill,
-                    total_bill=treatment.total_bill,
-                )
+        # Rows of the itemised medicines, doctors, fees and feedbacks lists
+        treatment = Treatment.objects.prefetch_related(
+            Prefetch(
+                "medicines",
+                queryset=TreatmentMedicine.objects.select_related(
+                    "medicine"
+                ).order_by("-created_at"),
+            ),
+            Prefetch(
+                "doctors",
+                queryset=Doctor.objects.select_related(
+                    "user", "speciality__department"
+                ).order_by("-created_at"),
+            ),
+            "extra_fees",
+            Prefetch(
+                "feedbacks",
+                queryset=ServiceFeedback.objects.order_by("-created_at"),
+            ),
+        ).get(pk=id)
+        if treatment.patient_id == patient.id:
+            # Totals as persisted on the treatment, see `Treatment.recompute_bills`
+            bill = treatment.bill
+            treatment_dict = dict(
+                id=treatment.id,
+                patient_type=treatment.patient_type,
+                diagnosis=treatment.diagnosis,
+                details=treatment.details,
+                treatment_status=treatment.treatment_status,
+                created_at=treatment.created_at,
+                updated_at=treatment.updated_at,
+                total_medicine_bill=bill.medicine,
+                total_treatment_bill=bill.treatment,
+                total_bill=bill.total,
             )
             treatment_dict["medicines_given"] = [
                 PatientTreatment.TreatmentMedicine(
@@ -416,9 +606,7 @@ def get_specific_treatment_details(
                     price_per_medicine=treatment_medicine.medicine.price,
                     medicine_bill=treatment_medicine.bill,
                 )
-                for treatment_medicine in treatment.medicines.all().order_by(
-                    "-created_at"
-                )
+                for treatment_medicine in treatment.medicines.all()
             ]
 
             treatment_dict["doctors_involved"] = [
@@ -429,7 +617,7 @@ def get_specific_treatment_details(
                     speciality_treatment_charges=doctor.speciality.treatment_charges,
                     speciality_department_name=doctor.speciality.department.name,
                 )
-                for doctor in treatment.doctors.all().order_by("-created_at")
+                for doctor in treatment.doctors.all()
             ]
             treatment_dict["extra_fees"] = [
                 PatientTreatment.ExtraFees(
@@ -439,7 +627,7 @@ def get_specific_treatment_details(
             ]
             treatment_dict["feedbacks"] = [
                 CompleteFeedbackInfo(**jsonable_encoder(feedback))
-                for feedback in treatment.feedbacks.all().order_by("-created_at")
+                for feedback in treatment.feedbacks.all()
             ]
             return PatientTreatment(**treatment_dict)
         else:
@@ -516,6 +704,7 @@ def delete_service_feedbak(
 @router.get("/appointments", name="Get appointments ever set")
 def get_appointments_ever_set(
     patient: Annotated[Patient, Depends(get_patient)],
+    response: Response,
     status: Annotated[
         Appointment.AppointmentStatus, Query(description="Appointment status")
     ] = None,
@@ -523,17 +712,13 @@ def get_appointments_ever_set(
         PositiveInt,
         Query(description="Appointments amount not to exceed", gt=0, le=100),
     ] = 100,
-    offset: Annotated[
-        int, Query(description="Return appointments whose IDs are greater than this")
-    ] = -1,
+    cursor: CursorQuery = None,
 ) -> list[AvailableAppointmentWithDoctor]:
-    query_filters: dict[str, str] = dict(patient=patient, id__gt=offset)
+    query_filters: dict[str, str] = dict(patient=patient)
     if status:
         query_filters["status"] = status.value
-    appointments = (
-        Appointment.objects.filter(**query_filters)
-        .all()
-        .order_by("-created_at")[:limit]
+    appointments = list(
+        paginate(Appointment.objects.filter(**query_filters), cursor, limit)
     )
     return [
         AvailableAppointmentWithDoctor(
@@ -550,7 +735,7 @@ def get_appointments_ever_set(
                 for feedback in appointment.feedbacks.all()
             ],
         )
-        for appointment in appointments
+        for appointment in page(appointments, limit, response)
     ]
 
 
@@ -560,19 +745,21 @@ def set_new_appointment(
     new_appointment: NewAppointmentWithDoctor,
 ) -> AvailableAppointmentWithDoctor:
     try:
-        target_doctor = Doctor.objects.get(pk=new_appointment.doctor_id)
+        target_doctor = Doctor.objects.select_related("speciality").get(
+            pk=new_appointment.doctor_id
+        )
         if target_doctor.is_working_time(new_appointment.appointment_datetime):
-            if target_doctor.accepts_appointment_on(
-                new_appointment.appointment_datetime
-            ):
-
+            try:
+                # Capacity is reserved atomically within the save
                 appointment = Appointment.objects.create(
                     patient=patient,
                     doctor=target_doctor,
                     appointment_datetime=new_appointment.appointment_datetime,
                     reason=new_appointment.reason,
                 )
-                appointment.save()
+            except AppointmentLimitReachedError:
+                appointment = None
+            if appointment is not None:
                 return AvailableAppointmentWithDoctor(
                     doctor_id=appointment.doctor.id,
                     appointment_datetime=appointment.appointment_datetime,
@@ -617,8 +804,8 @@ def update_existing_appointment(
 ) -> AvailableAppointmentWithDoctor:
     try:
         appointment = Appointment.objects.get(pk=id, patient=patient)
-        target_doctor = Doctor.objects.get(
-            pk=(updated_appointment.doctor_id or appointment.doctor.id)
+        target_doctor = Doctor.objects.select_related("speciality").get(
+            pk=(updated_appointment.doctor_id or appointment.doctor_id)
         )
         if updated_appointment.appointment_datetime:
             if not target_doctor.is_working_time(
@@ -630,23 +817,23 @@ def update_existing_appointment(
                         "Doctor is not available at the given time. " "Try other times."
                     ),
                 )
-            if not target_doctor.accepts_appointment_on(
-                updated_appointment.appointment_datetime
-            ):
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail=(
-                        "Doctor has reached the maximum number of appointments for the given date. "
-                        "Try other dates."
-                    ),
-                )
         appointment.doctor = target_doctor
         appointment.appointment_datetime = (
             updated_appointment.appointment_datetime or appointment.appointment_datetime
         )
         appointment.reason = updated_appointment.reason or appointment.reason
         appointment.status = updated_appointment.status or appointment.status
-        appointment.save()
+        try:
+            # Capacity on the new date is reserved atomically within the save
+            appointment.save()
+        except AppointmentLimitReachedError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=(
+                    "Doctor has reached the maximum number of appointments for the given date. "
+                    "Try other dates."
+                ),
+            )
         return AvailableAppointmentWithDoctor(
             doctor_id=appointment.doctor.id,
             appointment_datetime=appointment.appointment_datetime,
@@ -738,29 +925,81 @@ def get_payment_account_details(
     ]
 
 
-@router.post("/send-mpesa-payment-popup", name="Send mpesa payment popup")
+@router.post(
+    "/send-mpesa-payment-popup",
+    name="Send mpesa payment popup",
+    status_code=status.HTTP_202_ACCEPTED,
+)
 def send_mpesa_popup_to(
     patient: Annotated[Patient, Depends(get_patient)], popup_to: SendMPESAPopupTo
 ) -> Feedback:
-    def send_popup(phone_number, amount):
-        """TODO: Request payment using Daraja API"""
-        mpesa_details = Account.objects.filter(name__icontains="m-pesa").first()
-        assert mpesa_details is not None, "M-PESA account details not found"
-        account_number = mpesa_details.account_number % dict(
+    mpesa_details = Account.objects.filter(name__icontains="m-pesa").first()
+    if mpesa_details is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="M-PESA account details not found",
+        )
+    try:
+        phone_number = normalize_phone_number(popup_to.phone_number)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    # Sent by `payment_push_worker`, the account is credited on confirmation
+    PaymentPushJob.objects.create(
+        user_id=patient.user.id,
+        phone_number=phone_number,
+        amount=popup_to.amount,
+        account_reference=mpesa_details.account_number
+        % dict(
             id=patient.user.id,
             username=patient.user.username,
             phone_number=patient.user.phone_number,
             email=patient.user.email,
-        )
-        send_payment_push(
-            phone_number=popup_to.phone_number,
-            amount=popup_to.amount,
-            account_reference=account_number,
-        )
-        # Push send successfully let's SIMULATE account debitting
-        # TODO: Implement a real account debition.
-        patient.user.account.balance += amount
-        patient.user.account.save()
+        ),
+    )
+    return Feedback(detail="M-pesa popup will be sent shortly.")
+
 
-    send_popup(popup_to.phone_number, popup_to.amount)
-    return Feedback(detail="M-pesa popup sent successfully.")
+@router.post("/mpesa/callback", name="M-PESA payment callback")
+def mpesa_callback(
+    job: Annotated[UUID, Query(description="Idempotency key of the payment push")],
+    token: Annotated[str, Query(description="Callback token of the payment push")],
+    callback: MpesaCallback,
+) -> dict:
+    if not PaymentPushJob.authenticate(job, token):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid callback token"
+        )
+    try:
+        reconcile(job, callback.Body.stkCallback.model_dump(exclude_none=True))
+    except PaymentAmountMismatchError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    # Anything else makes M-PESA resend the callback
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+@router.get("/export/{dataset}", name="Export dataset")
+async def export_dataset(
+    staff: Annotated[CustomUser, Depends(get_staff_user)],
+    dataset: Annotated[
+        Literal["treatments", "appointments", "payments", "patients"],
+        Path(description="Dataset to export"),
+    ],
+    format: Annotated[
+        Literal["csv", "ndjson"], Query(description="Export format")
+    ] = "csv",
+    since: Annotated[date, Query(description="Entries created on or after")] = None,
+    until: Annotated[date, Query(description="Entries created on or before")] = None,
+) -> StreamingResponse:
+    """Streams a whole dataset. Available to staff only."""
+    target_dataset = export.datasets[dataset]
+    target_format = export.formats[format]
+    filename = export.filename(target_dataset, target_format)
+    return StreamingResponse(
+        export.astream(
+            target_dataset,
+            target_format,
+            export.rows(target_dataset, since=since, until=until),
+        ),
+        media_type=target_format.content_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -4,7 +4,11 @@
 import uuid
 import random
 from string import ascii_lowercase
-from datetime import datetime
+from typing import Callable, TypeVar
+from fastapi.concurrency import run_in_threadpool
+from django.db import close_old_connections
+
+T = TypeVar("T")
 
 token_id = "pms_"
 
@@ -14,7 +18,20 @@ def generate_token() -> str:
     return token_id + str(uuid.uuid4()).replace("-", random.choice(ascii_lowercase))
 
 
-def get_day_and_shift(time: datetime) -> tuple[str]:
-    day_of_week: str = time.strftime("%A")
-    work_shift: str = "Day" if 6 <= time.hour < 18 else "Night"
-    return day_of_week, work_shift
+async def run_in_thread(func: Callable[..., T], *args, **kwargs) -> T:
+    """Runs `func` e.g database queries in the threadpool of sync endpoints.
+
+    Django's async ORM sends the queries of every request to one shared
+    thread, these run side by side instead. Connections that are past
+    `CONN_MAX_AGE` or broken are closed before and after, as Django does
+    around requests.
+    """
+
+    def call():
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return await run_in_threadpool(call)
@@ -1,5 +1,12 @@
 from django.contrib import admin
-from external.models import About, ServiceFeedback, Gallery, News, Subscriber
+from external.models import (
+    About,
+    ServiceFeedback,
+    Gallery,
+    News,
+    Subscriber,
+    EmailOutbox,
+)
 from django.utils.translation import gettext_lazy as _
 from hospital_ms.utils.admin import DevelopmentImportExportModelAdmin
 
@@ -107,3 +114,24 @@ class SubscriberAdmin(DevelopmentImportExportModelAdmin):
     )
     list_filter = ("is_verified", "updated_at", "created_at")
     search_fields = ("email",)
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = (
+        "recipient",
+        "subject",
+        "status",
+        "attempts",
+        "sent_at",
+        "created_at",
+    )
+    search_fields = ("recipient", "subject")
+    list_filter = ("status", "created_at")
+    ordering = ("-id",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=...):
+        return False
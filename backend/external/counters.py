@@ -0,0 +1,67 @@
+"""Write-behind counters
+
+Increments are buffered in memory and written periodically as a single
+`UPDATE ... SET field = field + n` so that popular rows are not rewritten
+on every read. Each process keeps its own buffer; the additive update keeps
+concurrent flushes from several processes correct.
+"""
+
+import threading
+from collections import Counter
+from django.db.models import F, Case, When, Value, Model
+from external.models import News
+
+
+class ViewCounter:
+    """In-memory buffer of increments to an integer field.
+
+    Increments come from the event loop and flushes from a worker thread,
+    one lock guards the buffer between them.
+    """
+
+    def __init__(self, model: type[Model], field: str):
+        self.model = model
+        self.field = field
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def increment(self, pk: int, amount: int = 1) -> int:
+        """Buffers `amount` and returns increments pending for `pk`"""
+        with self._lock:
+            self._counts[pk] += amount
+            return self._counts[pk]
+
+    def pending(self, pk: int) -> int:
+        """Increments not yet written to the database"""
+        with self._lock:
+            return self._counts.get(pk, 0)
+
+    def _drain(self) -> Counter:
+        with self._lock:
+            drained, self._counts = self._counts, Counter()
+        return drained
+
+    def flush(self) -> int:
+        """Writes buffered increments in one update. Returns rows updated."""
+        drained = self._drain()
+        if not drained:
+            return 0
+        try:
+            return self.model.objects.filter(pk__in=drained).update(
+                **{
+                    self.field: F(self.field)
+                    + Case(
+                        *[When(pk=pk, then=Value(n)) for pk, n in drained.items()],
+                        default=Value(0),
+                    )
+                }
+            )
+        except Exception:
+            # Keep the increments for the next flush
+            with self._lock:
+                self._counts.update(drained)
+            raise
+
+
+news_views = ViewCounter(News, "views")
+"""Buffered `News.views` increments"""
@@ -0,0 +1,223 @@
+"""Email outbox
+
+Emails are queued as `EmailOutbox` rows and delivered in batches by
+`dispatch`. A batch is sent over a single connection of the email backend
+at no more than `EMAIL_RATE_LIMIT` messages a second. Failed messages are
+retried with exponential backoff.
+"""
+
+import time
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from itertools import islice
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from external.models import EmailOutbox, News, Subscriber
+from hospital_ms import settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+"""Subscribers queued at a time when fanning out"""
+
+
+def queue_email(
+    subject: str,
+    message: str,
+    recipient: str,
+    html_message: str = None,
+    key: str = None,
+):
+    """Queues an email. One with the `key` of a queued email is ignored."""
+    EmailOutbox.objects.bulk_create(
+        [
+            EmailOutbox(
+                recipient=recipient,
+                subject=subject,
+                message=message,
+                html_message=html_message,
+                key=key,
+            )
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def subscription_link(subscriber_token, action: str) -> str:
+    return f"{settings.SITE_URL}/api/v1/subscription/{subscriber_token}/{action}"
+
+
+def queue_subscription_confirmation(subscriber: Subscriber):
+    queue_email(
+        subject=f"Confirm your subscription to {settings.SITE_NAME}",
+        message=(
+            f"Follow the link below to start receiving news from "
+            f"{settings.SITE_NAME}.\n\n"
+            f"{subscription_link(subscriber.token, 'confirm')}"
+        ),
+        recipient=subscriber.email,
+        key=f"subscription:{subscriber.token}",
+    )
+
+
+def news_key(news: News, email: str) -> str:
+    """Outbox key of `news` mailed to `email`. The email is hashed as
+    addresses can be longer than the key."""
+    return f"news:{news.id}:{hashlib.sha256(email.encode()).hexdigest()}"
+
+
+def fan_out_news(news: News, chunk_size: int = CHUNK_SIZE) -> int:
+    """Queues `news` to every verified subscriber, a chunk at a time.
+
+    Each email is keyed by the news and the subscriber so fanning out the
+    same news again queues only those that were missed.
+    """
+    subscribers = (
+        Subscriber.objects.filter(is_verified=True)
+        .order_by("id")
+        .values_list("email", "token")
+        .iterator(chunk_size=chunk_size)
+    )
+    message = f"{news.summary}\n\nRead more at {settings.SITE_URL}/news/{news.id}"
+    total = 0
+    while chunk := list(islice(subscribers, chunk_size)):
+        EmailOutbox.objects.bulk_create(
+            [
+                EmailOutbox(
+                    recipient=email,
+                    subject=news.title,
+                    message=(
+                        f"{message}\n\nUnsubscribe: "
+                        f"{subscription_link(token, 'cancel')}"
+                    ),
+                    key=news_key(news, email),
+                )
+                for email, token in chunk
+            ],
+            ignore_conflicts=True,
+        )
+        total += len(chunk)
+    return total
+
+
+def fan_out_pending_news() -> int:
+    """Queues news published since the last fan out"""
+    total = 0
+    for news in News.objects.filter(mailing_pending=True).order_by("id"):
+        total += fan_out_news(news)
+        News.objects.filter(pk=news.pk).update(mailing_pending=False)
+    return total
+
+
+class RateLimiter:
+    """Spaces calls to `wait` at least 1/rate seconds apart"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+rate_limiter = RateLimiter(settings.EMAIL_RATE_LIMIT)
+"""Limits emails sent by this process"""
+
+
+def claim_due(limit: int, lease: float) -> list[EmailOutbox]:
+    """Pending emails that are due, claimed by this worker for `lease` seconds.
+    An email whose worker dies is picked up again once its lease ends."""
+    now = timezone.now()
+    with transaction.atomic():
+        due = EmailOutbox.objects.filter(
+            status=EmailOutbox.MailStatus.PENDING.value, next_attempt_at__lte=now
+        ).order_by("next_attempt_at")
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        emails = list(due[:limit])
+        EmailOutbox.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=lease),
+            attempts=F("attempts") + 1,
+        )
+    for email in emails:
+        email.attempts += 1
+    return emails
+
+
+def as_message(email: EmailOutbox) -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(
+        subject=email.subject,
+        body=email.message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[email.recipient],
+    )
+    if email.html_message:
+        message.attach_alternative(email.html_message, "text/html")
+    return message
+
+
+def record_failures(failures: list[tuple[EmailOutbox, str]]):
+    now = timezone.now()
+    for email, error in failures:
+        if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+            fields = dict(status=EmailOutbox.MailStatus.FAILED.value)
+        else:
+            delay = settings.EMAIL_BACKOFF * 2 ** (email.attempts - 1)
+            fields = dict(next_attempt_at=now + timedelta(seconds=delay))
+        EmailOutbox.objects.filter(pk=email.pk).update(last_error=error, **fields)
+
+
+def dispatch(batch_size: int = None) -> int:
+    """Sends a batch of due emails. Returns how many were attempted."""
+    emails = claim_due(batch_size or settings.EMAIL_BATCH_SIZE, settings.EMAIL_LEASE)
+    if not emails:
+        return 0
+    sent = []
+    failures = []
+    try:
+        with get_connection() as mail_connection:
+            for email in emails:
+                rate_limiter.wait()
+                try:
+                    mail_connection.send_messages([as_message(email)])
+                except Exception as e:
+                    failures.append((email, f"{type(e).__name__}: {e}"))
+                else:
+                    sent.append(email.pk)
+    except Exception as e:
+        # Opening or closing the connection failed
+        logger.exception("Failed to connect to the email backend")
+        attempted = set(sent) | {email.pk for email, error in failures}
+        failures += [
+            (email, f"{type(e).__name__}: {e}")
+            for email in emails
+            if email.pk not in attempted
+        ]
+    EmailOutbox.objects.filter(pk__in=sent).update(
+        status=EmailOutbox.MailStatus.SENT.value,
+        sent_at=timezone.now(),
+        last_error="",
+    )
+    record_failures(failures)
+    if failures:
+        logger.warning(f"{len(failures)} of {len(emails)} email(s) not sent")
+    return len(emails)
+
+
+def dispatch_all() -> int:
+    """Fans out pending news then sends every due email"""
+    fan_out_pending_news()
+    total = 0
+    while attempted := dispatch():
+        total += attempted
+    return total
@@ -0,0 +1,37 @@
+from pathlib import Path
+from django.core.management.base import BaseCommand
+from hospital_ms.utils.compress import compress_directory, encoders
+from hospital_ms.settings import STATIC_ROOT, FRONTEND_DIR
+
+
+class Command(BaseCommand):
+    help = "Writes precompressed variants of static and frontend assets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "directories",
+            nargs="*",
+            type=Path,
+            help="Directories to compress. Defaults to STATIC_ROOT and FRONTEND_DIR",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Compress files whose variants are up to date too",
+        )
+
+    def handle(self, *args, **options):
+        directories = options["directories"] or [
+            directory for directory in (STATIC_ROOT, FRONTEND_DIR) if directory
+        ]
+        for directory in directories:
+            if not directory.is_dir():
+                self.stdout.write(self.style.WARNING(f"Skipping missing {directory}"))
+                continue
+            files, saved = compress_directory(directory, options["force"])
+            self.stdout.write(
+                f"{directory}: compressed {files} file(s) saving {saved / 1024:.0f}KiB"
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Variants written: {', '.join(sorted(encoders))}")
+        )
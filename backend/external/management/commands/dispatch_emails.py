@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from external.mailing import fan_out_pending_news, dispatch
+
+
+class Command(BaseCommand):
+    help = "Mails pending news to subscribers and sends every due email"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="Emails sent per connection. Defaults to EMAIL_BATCH_SIZE",
+        )
+
+    def handle(self, *args, **options):
+        queued = fan_out_pending_news()
+        if queued:
+            self.stdout.write(f"Queued news to {queued} subscriber(s)")
+        total = 0
+        while attempted := dispatch(options["batch_size"]):
+            total += attempted
+        self.stdout.write(self.style.SUCCESS(f"Attempted {total} email(s)"))
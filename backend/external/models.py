@@ -165,6 +165,16 @@ class ServiceFeedback(models.Model):
         verbose_name=_("Created At"),
     )
 
+    class Meta:
+        indexes = [
+            # Only rows listed publicly are indexed
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="feedback_shown_recent_idx",
+                condition=models.Q(show_in_index=True),
+            ),
+        ]
+
     def __str__(self):
         return f"{self.rate} feedback from {self.sender}"
 
@@ -180,6 +190,12 @@ class Gallery(models.Model):
         upload_to=generate_document_filepath,
         default="default/surgery-1822458_1920.jpg",
     )
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text=_("Resized copies of the photograph"),
+    )
     video_link = models.URLField(
         max_length=100, help_text=_("YouTube video link"), null=True, blank=True
     )
@@ -203,6 +219,14 @@ class Gallery(models.Model):
 
     class Meta:
         verbose_name_plural = _("Galleries")
+        indexes = [
+            # Only rows listed publicly are indexed
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="gallery_shown_recent_idx",
+                condition=models.Q(show_in_index=True),
+            ),
+        ]
 
 
 class News(models.Model):
@@ -230,6 +254,12 @@ class News(models.Model):
         upload_to=generate_document_filepath,
         default="default/news-3584901_66059.jpg",
     )
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text=_("Resized copies of the cover photo"),
+    )
     document = models.FileField(
         help_text=_("Any relevant file attached to the news"),
         upload_to=generate_document_filepath,
@@ -246,6 +276,11 @@ class News(models.Model):
     views = models.IntegerField(
         default=0, help_text=_("Number of times the news has been requested.")
     )
+    mailing_pending = models.BooleanField(
+        default=False,
+        editable=False,
+        help_text=_("Subscribers are yet to be mailed this news."),
+    )
     updated_at = models.DateTimeField(
         auto_now=True,
         verbose_name=_("Updated At"),
@@ -259,14 +294,25 @@ class News(models.Model):
 
     class Meta:
         verbose_name_plural = _("News")
+        indexes = [
+            # Only rows listed publicly are indexed
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="news_published_recent_idx",
+                condition=models.Q(is_published=True),
+            ),
+        ]
 
     def __str__(self):
         return f"'{self.title}' on {self.created_at.strftime('%d-%b-%Y %H:%M:%S')}"
 
     def save(self, *args, **kwargs):
-        if not self.id:  # new entry
-            # Consider mailing subscribers
-            pass
+        if self.is_published and (
+            not self.id
+            or not News.objects.filter(pk=self.id, is_published=True).exists()
+        ):
+            # Subscribers are mailed by `external.mailing.dispatch`
+            self.mailing_pending = True
         super().save(*args, **kwargs)
 
 
@@ -288,3 +334,65 @@ class Subscriber(models.Model):
 
     def __str__(self):
         return self.email
+
+
+class EmailOutbox(models.Model):
+    """Email awaiting delivery by `external.mailing.dispatch`"""
+
+    class MailStatus(Enum):
+        PENDING = "Pending"
+        SENT = "Sent"
+        FAILED = "Failed"
+
+        @classmethod
+        def choices(cls):
+            return [(key.value, key.name) for key in cls]
+
+    recipient = models.EmailField(help_text=_("Email address"))
+    subject = models.CharField(max_length=200, help_text=_("Email subject"))
+    message = models.TextField(help_text=_("Plain text body"))
+    html_message = models.TextField(
+        null=True, blank=True, help_text=_("HTML body, if any")
+    )
+    key = models.CharField(
+        max_length=100,
+        null=True,
+        blank=True,
+        unique=True,
+        help_text=_("Identifies the email so that it is only queued once"),
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=MailStatus.choices(),
+        default=MailStatus.PENDING.value,
+        help_text=_("Delivery status"),
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0, help_text=_("Times delivery has been attempted")
+    )
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now, help_text=_("When delivery is due to be attempted")
+    )
+    last_error = models.TextField(
+        blank=True, default="", help_text=_("Last delivery error")
+    )
+    sent_at = models.DateTimeField(
+        null=True, blank=True, help_text=_("When the email was delivered")
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_("Created At"),
+    )
+
+    class Meta:
+        verbose_name_plural = _("Email Outbox")
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status="Pending"),
+                name="outbox_due_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"'{self.subject}' to {self.recipient} ({self.status})"
@@ -1,3 +1,188 @@
-from django.test import TestCase
+import re
+from unittest import mock
+from uuid import uuid4
+from asgiref.sync import async_to_sync
+from django.core import mail
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from fastapi.testclient import TestClient
+from api.v1.cache import LocMemResponseBackend, response_cache
+from external import mailing
+from external.counters import ViewCounter
+from external.models import About, EmailOutbox, News, ServiceFeedback, Subscriber
+from users.models import CustomUser
 
-# Create your tests here.
+homepage = (
+    "/api/v1/about",
+    "/api/v1/galleries",
+    "/api/v1/news",
+    "/api/v1/feedbacks",
+    "/api/v1/specialities",
+    "/api/v1/departments",
+)
+"""Public content the landing page loads"""
+
+
+def queries(response) -> int:
+    return int(re.search(r'desc="(\d+) queries"', response.headers["Server-Timing"])[1])
+
+
+class LocMemResponseBackendTest(TestCase):
+    group = ("external.News",)
+
+    def test_versions_are_shared_by_processes(self):
+        # Backends of two api processes sharing the Django cache
+        first, second = LocMemResponseBackend(), LocMemResponseBackend()
+        before = async_to_sync(second.versions)(self.group)
+        first.bump(self.group[0])
+        self.assertNotEqual(async_to_sync(second.versions)(self.group), before)
+        self.assertEqual(
+            async_to_sync(first.versions)(self.group),
+            async_to_sync(second.versions)(self.group),
+        )
+
+    def test_entries_are_bounded(self):
+        backend = LocMemResponseBackend(maxsize=2)
+        for key in ("a", "b", "c"):
+            async_to_sync(backend.set)(key, ("etag", b"{}", {}))
+        self.assertIsNone(async_to_sync(backend.get)("a"))
+        self.assertIsNotNone(async_to_sync(backend.get)("c"))
+
+
+class ResponseCacheTest(TransactionTestCase):
+    def setUp(self):
+        from api import app
+
+        self.client = TestClient(app)
+        About.objects.create()
+        News.objects.create(title="Opening", content="Doors open", summary="Open")
+        response_cache.clear()
+
+    def test_homepage_is_served_without_queries_once_cached(self):
+        cold = [self.client.get(path) for path in homepage]
+        warm = [self.client.get(path) for path in homepage]
+        self.assertEqual([r.status_code for r in cold + warm], [200] * 12)
+        self.assertGreater(sum(map(queries, cold)), 0)
+        self.assertEqual(sum(map(queries, warm)), 0)
+        self.assertEqual([r.content for r in cold], [r.content for r in warm])
+
+    def test_unchanged_response_is_not_sent_again(self):
+        etag = self.client.get("/api/v1/news").headers["ETag"]
+        response = self.client.get("/api/v1/news", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+
+    def test_saving_news_invalidates_every_process(self):
+        other = LocMemResponseBackend()
+        before = async_to_sync(other.versions)(("external.News",))
+        etag = self.client.get("/api/v1/news").headers["ETag"]
+        News.objects.create(title="Clinic", content="New clinic", summary="New")
+        self.assertNotEqual(async_to_sync(other.versions)(("external.News",)), before)
+        response = self.client.get("/api/v1/news", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_feedbacks_are_invalidated_by_sender_changes_rendered(self):
+        sender = CustomUser.objects.create(username="alice", first_name="Alice")
+        ServiceFeedback.objects.create(
+            sender=sender, message="Great", rate=ServiceFeedback.FeedbackRate.GOOD.value
+        )
+        self.assertGreater(queries(self.client.get("/api/v1/feedbacks")), 0)
+        # Logging in and editing what is not rendered
+        sender.last_login = timezone.now()
+        sender.save(update_fields=["last_login"])
+        sender.location = "Meru"
+        sender.save()
+        self.assertEqual(queries(self.client.get("/api/v1/feedbacks")), 0)
+        sender.first_name = "Alicia"
+        sender.save()
+        response = self.client.get("/api/v1/feedbacks")
+        self.assertGreater(queries(response), 0)
+        self.assertEqual(response.json()[0]["user"]["first_name"], "Alicia")
+
+
+class ViewCounterTest(TestCase):
+    def setUp(self):
+        self.news = News.objects.create(title="Opening", content="Doors", summary="")
+        self.views = ViewCounter(News, "views")
+
+    def stored(self) -> int:
+        return News.objects.get(pk=self.news.pk).views
+
+    def test_views_are_written_behind_in_one_update(self):
+        for _ in range(3):
+            self.views.increment(self.news.pk)
+        self.assertEqual((self.views.pending(self.news.pk), self.stored()), (3, 0))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.views.flush(), 1)
+        self.assertEqual((self.views.pending(self.news.pk), self.stored()), (0, 3))
+        self.assertEqual(self.views.flush(), 0)
+
+    def test_failed_flush_keeps_views(self):
+        self.views.increment(self.news.pk, 2)
+        with mock.patch.object(News.objects, "filter", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.views.flush()
+        self.assertEqual(self.views.pending(self.news.pk), 2)
+        self.views.flush()
+        self.assertEqual(self.stored(), 2)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend")
+class NewsMailingTest(TestCase):
+    subscribers = 100_000
+    batch_size = 5000
+
+    @classmethod
+    def setUpTestData(cls):
+        Subscriber.objects.bulk_create(
+            [
+                Subscriber(email=f"subscriber{i}@example.com", token=uuid4())
+                for i in range(cls.subscribers)
+            ],
+            batch_size=10_000,
+        )
+        # An address as long as they get, longer than outbox keys
+        domain = ".".join(["y" * 63, "y" * 63, "y" * 48, "example.com"])
+        Subscriber.objects.create(email=f"{'x' * 64}@{domain}", token=uuid4())
+        Subscriber.objects.update(is_verified=True)
+        Subscriber.objects.create(email="unverified@example.com", token=uuid4())
+
+    def setUp(self):
+        unlimited = mailing.RateLimiter(0)
+        rate_limiter = mock.patch.object(mailing, "rate_limiter", unlimited)
+        rate_limiter.start()
+        self.addCleanup(rate_limiter.stop)
+        self.news = News.objects.create(
+            title="Opening", content="Doors open", summary="Open", is_published=True
+        )
+
+    def test_news_is_mailed_once_to_every_verified_subscriber(self):
+        verified = self.subscribers + 1
+        self.assertEqual(mailing.fan_out_pending_news(), verified)
+        # Fanning out again queues nothing new
+        self.assertEqual(mailing.fan_out_news(self.news), verified)
+        self.assertEqual(EmailOutbox.objects.count(), verified)
+        max_length = EmailOutbox._meta.get_field("key").max_length
+        self.assertTrue(
+            all(
+                len(key) <= max_length
+                for key in EmailOutbox.objects.values_list("key", flat=True)
+            )
+        )
+        connections = mock.patch.object(
+            mailing, "get_connection", wraps=mailing.get_connection
+        )
+        with connections as get_connection:
+            total = 0
+            while attempted := mailing.dispatch(self.batch_size):
+                total += attempted
+        self.assertEqual(total, verified)
+        # A connection per batch
+        self.assertEqual(get_connection.call_count, -(-verified // self.batch_size))
+        self.assertEqual(len(mail.outbox), verified)
+        self.assertEqual({email.subject for email in mail.outbox}, {self.news.title})
+        self.assertEqual(len({email.to[0] for email in mail.outbox}), verified)
+        sent = EmailOutbox.objects.filter(status=EmailOutbox.MailStatus.SENT.value)
+        self.assertEqual(sent.count(), verified)
@@ -1,10 +1,18 @@
 from django.contrib import admin
 
 # Register your models here.
-from finance.models import Account, UserAccount, Payment, ExtraFee
+from finance.models import (
+    Account,
+    UserAccount,
+    Payment,
+    ExtraFee,
+    LedgerEntry,
+    PaymentPushJob,
+)
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from hospital_ms.utils.admin import DevelopmentImportExportModelAdmin
+from hospital_ms.utils.export import export_actions
 
 
 @admin.register(Account)
@@ -46,6 +54,7 @@ class PaymentAdmin(DevelopmentImportExportModelAdmin):
     list_display = ("user", "amount", "method", "reference", "created_at")
     search_fields = ("user", "reference", "method")
     list_filter = ("user", "method", "created_at")
+    actions = export_actions("payments")
     ordering = ("-created_at",)
     list_editable = ()
 
@@ -72,3 +81,43 @@ class ExtraFeeAdmin(DevelopmentImportExportModelAdmin):
     )
     search_fields = ("name",)
     list_filter = ("updated_at", "created_at")
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ("account", "kind", "amount", "reference", "created_at")
+    search_fields = ("reference", "account__user__username")
+    list_filter = ("kind", "created_at")
+    ordering = ("-id",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=...):
+        return False
+
+    def has_delete_permission(self, request, obj=...):
+        return False
+
+
+@admin.register(PaymentPushJob)
+class PaymentPushJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "user",
+        "phone_number",
+        "amount",
+        "status",
+        "attempts",
+        "receipt_number",
+        "created_at",
+    )
+    search_fields = ("user__username", "phone_number", "receipt_number")
+    list_filter = ("status", "created_at")
+    list_select_related = ("user",)
+    ordering = ("-id",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=...):
+        return False
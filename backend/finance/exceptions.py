@@ -0,0 +1,6 @@
+class FinanceException(Exception):
+    """Base exception class for Finance app"""
+
+
+class PaymentAmountMismatchError(FinanceException):
+    """Raised when a confirmed payment differs from the amount requested"""
@@ -0,0 +1,86 @@
+"""Account ledger history and balance snapshots
+
+`UserAccount.balance` is the running balance kept by `LedgerEntry.post`.
+Snapshots checkpoint it against the ledger so that it can be audited
+without replaying the whole history.
+"""
+
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterator
+from django.db import transaction
+from django.db.models import Max, Sum
+from finance.models import UserAccount, LedgerEntry, BalanceSnapshot
+
+
+def history(
+    account_id: int, since: datetime = None, chunk_size: int = 2000
+) -> Iterator[LedgerEntry]:
+    """Streams ledger entries of an account in the order they were posted"""
+    entries = LedgerEntry.objects.filter(account_id=account_id).order_by("id")
+    if since:
+        entries = entries.filter(created_at__gte=since)
+    return entries.iterator(chunk_size=chunk_size)
+
+
+def take_snapshots(account_ids: list[int]) -> list[BalanceSnapshot]:
+    """Checkpoints current balance of the given accounts"""
+    with transaction.atomic():
+        # Locking the accounts keeps concurrent postings out of the snapshot
+        balances = dict(
+            UserAccount.objects.select_for_update()
+            .filter(pk__in=account_ids)
+            .values_list("id", "balance")
+        )
+        last_entries = dict(
+            LedgerEntry.objects.filter(account_id__in=balances)
+            .values("account_id")
+            .annotate(last_entry_id=Max("id"))
+            .values_list("account_id", "last_entry_id")
+            .order_by()
+        )
+        return BalanceSnapshot.objects.bulk_create(
+            BalanceSnapshot(
+                account_id=account_id,
+                balance=balance,
+                last_entry_id=last_entries.get(account_id, 0),
+            )
+            for account_id, balance in balances.items()
+        )
+
+
+def take_all_snapshots(batch_size: int = 500) -> int:
+    """Checkpoints every account in batches. Returns accounts snapshotted."""
+    total = 0
+    account_ids = UserAccount.objects.order_by("id").values_list("id", flat=True)
+    batch = []
+    for account_id in account_ids.iterator(chunk_size=batch_size):
+        batch.append(account_id)
+        if len(batch) == batch_size:
+            total += len(take_snapshots(batch))
+            batch = []
+    if batch:
+        total += len(take_snapshots(batch))
+    return total
+
+
+def ledger_balance(account_id: int) -> Decimal:
+    """Balance derived from the latest snapshot and the entries after it"""
+    snapshot = (
+        BalanceSnapshot.objects.filter(account_id=account_id)
+        .order_by("-last_entry_id", "-id")
+        .first()
+    )
+    balance, last_entry_id = (
+        (snapshot.balance, snapshot.last_entry_id) if snapshot else (Decimal(0), 0)
+    )
+    posted = LedgerEntry.objects.filter(
+        account_id=account_id, id__gt=last_entry_id
+    ).aggregate(total=Sum("amount"))["total"]
+    return balance + (posted or 0)
+
+
+def balance_drift(account_id: int) -> Decimal:
+    """Difference between the running balance and the ledger"""
+    balance = UserAccount.objects.values_list("balance", flat=True).get(pk=account_id)
+    return balance - ledger_balance(account_id)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from finance.models import UserAccount
+from finance.ledger import take_all_snapshots, balance_drift
+
+
+class Command(BaseCommand):
+    help = "Checkpoints accounts balances against the ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Accounts snapshotted per transaction",
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Report accounts whose balance drifts from the ledger instead",
+        )
+
+    def handle(self, *args, **options):
+        if options["check"]:
+            drifting = 0
+            for account_id in UserAccount.objects.values_list(
+                "id", flat=True
+            ).iterator(chunk_size=options["batch_size"]):
+                drift = balance_drift(account_id)
+                if drift:
+                    drifting += 1
+                    self.stdout.write(f"Account {account_id} drifts by {drift}")
+            self.stdout.write(self.style.SUCCESS(f"{drifting} account(s) drifting"))
+            return
+        total = take_all_snapshots(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Snapshotted {total} account(s)"))
@@ -1,9 +1,22 @@
-from django.db import models
+import hmac
+import logging
+import secrets
+from django.db import models, transaction
+from django.db.models import F, Case, When, Value
+from django.utils import timezone
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from typing import Iterable
+from uuid import uuid4
+from finance.exceptions import PaymentAmountMismatchError
 
 # Create your models here.
 from django.utils.translation import gettext_lazy as _
 from enum import Enum
 
+logger = logging.getLogger(__name__)
+
 
 class Account(models.Model):
     name = models.CharField(max_length=50, help_text=_("Account name e.g M-PESA"))
@@ -100,9 +113,14 @@ class Payment(models.Model):
     def save(self, *args, **kwargs):
         if self.id:
             raise Exception("Payments cannot be edited")
-        self.user.account.balance += self.amount
-        self.user.account.save()
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            LedgerEntry.post(
+                self.user.account_id,
+                self.amount,
+                LedgerEntry.EntryKind.PAYMENT,
+                reference=f"payment:{self.id}",
+            )
 
 
 class ExtraFee(models.Model):
@@ -122,3 +140,333 @@ class ExtraFee(models.Model):
 
     def __str__(self):
         return f"{self.name} (Ksh.{self.amount})"
+
+
+class LedgerEntry(models.Model):
+    """Append-only record of every change to a `UserAccount.balance`"""
+
+    class EntryKind(Enum):
+        PAYMENT = "Payment"
+        APPOINTMENT = "Appointment"
+        APPOINTMENT_REFUND = "Appointment refund"
+        TREATMENT = "Treatment"
+        MPESA = "M-PESA"
+        ADJUSTMENT = "Adjustment"
+
+        @classmethod
+        def choices(cls):
+            return [(key.value, key.name) for key in cls]
+
+    account = models.ForeignKey(
+        UserAccount,
+        on_delete=models.RESTRICT,
+        help_text=_("Account affected"),
+        related_name="ledger_entries",
+    )
+    amount = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        help_text=_("Amount in Ksh. Negative amounts are deductions."),
+    )
+    kind = models.CharField(
+        max_length=30,
+        choices=EntryKind.choices(),
+        help_text=_("What the entry is for"),
+    )
+    reference = models.CharField(
+        max_length=100, blank=True, default="", help_text=_("Source of the entry")
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_("Created At"),
+    )
+
+    class Meta:
+        verbose_name_plural = _("Ledger Entries")
+        indexes = [
+            # Finds the entry of an M-PESA receipt
+            models.Index(fields=["kind", "reference"], name="ledger_reference_idx")
+        ]
+
+    def __str__(self):
+        return f"{self.kind} Ksh.{self.amount} (Ref: {self.reference})"
+
+    def save(self, *args, **kwargs):
+        if self.id:
+            raise Exception("Ledger entries cannot be edited")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise Exception("Ledger entries cannot be deleted")
+
+    @classmethod
+    def post_many(cls, entries: Iterable["LedgerEntry"]) -> list["LedgerEntry"]:
+        """Records entries in bulk and applies them to account balances.
+
+        Balances are updated with a single `UPDATE` using `F("balance")` so
+        concurrent postings never overwrite each other. It runs ahead of the
+        inserts so that entries of an account get their ids, and commit, in
+        the order its row lock is taken; snapshots rely on no entry
+        committing after one with a higher id.
+        """
+        entries = list(entries)
+        if not entries:
+            return entries
+        totals: dict[int, Decimal] = defaultdict(Decimal)
+        for entry in entries:
+            totals[entry.account_id] += Decimal(entry.amount)
+        with transaction.atomic():
+            UserAccount.objects.filter(pk__in=totals).update(
+                balance=F("balance")
+                + Case(
+                    *(
+                        When(pk=account_id, then=Value(total))
+                        for account_id, total in totals.items()
+                    ),
+                    default=Value(Decimal(0)),
+                    output_field=models.DecimalField(max_digits=8, decimal_places=2),
+                ),
+                updated_at=timezone.now(),
+            )
+            entries = cls.objects.bulk_create(entries)
+        return entries
+
+    @classmethod
+    def post(
+        cls, account_id: int, amount, kind: EntryKind, reference: str = ""
+    ) -> "LedgerEntry":
+        """Records a single entry. Negative amount deducts from balance."""
+        return cls.post_many(
+            [
+                cls(
+                    account_id=account_id,
+                    amount=amount,
+                    kind=kind.value,
+                    reference=reference,
+                )
+            ]
+        )[0]
+
+
+class BalanceSnapshot(models.Model):
+    """Account balance as at a particular ledger entry.
+
+    The balance of an account equals the latest snapshot's balance plus the
+    sum of the ledger entries recorded after it.
+    """
+
+    account = models.ForeignKey(
+        UserAccount,
+        on_delete=models.CASCADE,
+        help_text=_("Account snapshotted"),
+        related_name="snapshots",
+    )
+    balance = models.DecimalField(
+        max_digits=8, decimal_places=2, help_text=_("Account balance")
+    )
+    last_entry_id = models.BigIntegerField(
+        default=0, help_text=_("Last ledger entry accounted for")
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_("Created At"),
+    )
+
+    def __str__(self):
+        return f"{self.account_id} - {self.balance} at {self.last_entry_id}"
+
+
+def generate_callback_token() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class PaymentPushJob(models.Model):
+    """M-PESA STK push awaiting delivery or confirmation.
+
+    Jobs are sent by `finance.mpesa.PaymentPushWorker` and the payer's account
+    is credited only once Safaricom confirms the payment through the callback.
+    """
+
+    class JobStatus(Enum):
+        PENDING = "Pending"
+        SENT = "Sent"
+        COMPLETED = "Completed"
+        FAILED = "Failed"
+
+        @classmethod
+        def choices(cls):
+            return [(key.value, key.name) for key in cls]
+
+    user = models.ForeignKey(
+        "users.CustomUser",
+        on_delete=models.CASCADE,
+        help_text=_("User account to credit"),
+        related_name="payment_push_jobs",
+    )
+    phone_number = models.CharField(
+        max_length=15, help_text=_("Phone number prompted, in 2547... format")
+    )
+    amount = models.DecimalField(
+        max_digits=10, decimal_places=2, help_text=_("Amount requested in Ksh")
+    )
+    account_reference = models.CharField(
+        max_length=100, help_text=_("Account number the payment is made to")
+    )
+    idempotency_key = models.UUIDField(
+        default=uuid4,
+        unique=True,
+        editable=False,
+        help_text=_("Identifies the job in callbacks"),
+    )
+    callback_token = models.CharField(
+        max_length=64,
+        default=generate_callback_token,
+        editable=False,
+        help_text=_("Secret the callback of the job must present"),
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=JobStatus.choices(),
+        default=JobStatus.PENDING.value,
+        help_text=_("Delivery status"),
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0, help_text=_("Times the push has been attempted")
+    )
+    next_attempt_at = models.DateTimeField(
+        default=timezone.now, help_text=_("When the push is due to be attempted")
+    )
+    checkout_request_id = models.CharField(
+        max_length=100,
+        null=True,
+        blank=True,
+        unique=True,
+        help_text=_("CheckoutRequestID assigned by M-PESA"),
+    )
+    receipt_number = models.CharField(
+        max_length=50,
+        null=True,
+        blank=True,
+        help_text=_("M-PESA receipt of the confirmed payment"),
+    )
+    last_error = models.TextField(
+        blank=True, default="", help_text=_("Last delivery or payment error")
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name=_("Updated At"),
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_("Created At"),
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status="Pending"),
+                name="push_job_due_idx",
+            )
+        ]
+
+    def __str__(self):
+        return f"Ksh.{self.amount} from {self.phone_number} ({self.status})"
+
+    @classmethod
+    def claim_due(cls, limit: int, lease: float) -> list["PaymentPushJob"]:
+        """Pending jobs that are due, each claimed by this worker for `lease`
+        seconds. A job whose worker dies is picked up again once its lease ends.
+        """
+        now = timezone.now()
+        due = cls.objects.filter(
+            status=cls.JobStatus.PENDING.value, next_attempt_at__lte=now
+        ).order_by("next_attempt_at")[:limit]
+        claimed = []
+        for job in due:
+            # Another worker claiming the job first moves next_attempt_at
+            if cls.objects.filter(
+                pk=job.pk,
+                status=cls.JobStatus.PENDING.value,
+                next_attempt_at=job.next_attempt_at,
+            ).update(
+                next_attempt_at=now + timedelta(seconds=lease),
+                attempts=F("attempts") + 1,
+                updated_at=now,
+            ):
+                job.attempts += 1
+                claimed.append(job)
+        return claimed
+
+    @classmethod
+    def authenticate(cls, idempotency_key, token: str) -> bool:
+        """Whether `token` is the callback token of the job"""
+        expected = (
+            cls.objects.filter(idempotency_key=idempotency_key)
+            .values_list("callback_token", flat=True)
+            .first()
+        )
+        # Compared even when there is no such job so that timing reveals nothing
+        matches = hmac.compare_digest(
+            (expected or generate_callback_token()).encode(), token.encode()
+        )
+        return expected is not None and matches
+
+    @classmethod
+    def confirm(
+        cls, idempotency_key, amount: Decimal = None, receipt_number: str = ""
+    ) -> "PaymentPushJob | None":
+        """Credits the job's user with a confirmed payment.
+
+        Every receipt is credited once, so a callback resent by M-PESA is
+        ignored while a second payment made to the same push is recorded.
+
+        Raises:
+            PaymentAmountMismatchError: Incase `amount` is not the amount requested
+        """
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update()
+                .select_related("user")
+                .filter(idempotency_key=idempotency_key)
+                .first()
+            )
+            if job is None:
+                return None
+            if amount is not None and amount != job.amount:
+                raise PaymentAmountMismatchError(
+                    f"Ksh.{amount} confirmed for a push of Ksh.{job.amount}"
+                )
+            reference = receipt_number or f"push:{job.idempotency_key}"
+            if LedgerEntry.objects.filter(
+                kind=LedgerEntry.EntryKind.MPESA.value, reference=reference
+            ).exists():
+                return job
+            if job.status == cls.JobStatus.COMPLETED.value:
+                logger.warning(
+                    f"Payment push {job.pk} paid again, receipt {reference}"
+                )
+            else:
+                job.status = cls.JobStatus.COMPLETED.value
+                job.receipt_number = receipt_number
+                job.save(update_fields=["status", "receipt_number", "updated_at"])
+            LedgerEntry.post(
+                job.user.account_id,
+                job.amount,
+                LedgerEntry.EntryKind.MPESA,
+                reference=reference,
+            )
+            return job
+
+    @classmethod
+    def reject(cls, idempotency_key, reason: str) -> int:
+        """Fails the job unless it has been confirmed already"""
+        return (
+            cls.objects.filter(idempotency_key=idempotency_key)
+            .exclude(status=cls.JobStatus.COMPLETED.value)
+            .update(
+                status=cls.JobStatus.FAILED.value,
+                last_error=reason,
+                updated_at=timezone.now(),
+            )
+        )
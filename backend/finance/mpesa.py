@@ -0,0 +1,218 @@
+"""M-PESA STK push delivery
+
+Pushes are queued as `PaymentPushJob` rows and sent in the background by
+`PaymentPushWorker` over one pooled `httpx.AsyncClient`. Pushes that never
+reached Safaricom are retried with exponential backoff; any other failure may
+have prompted the customer already, so it is not retried and the callback is
+left to settle the job. Accounts are credited only when Safaricom confirms
+the payment through the callback.
+"""
+
+import re
+import random
+import asyncio
+import logging
+import httpx
+from datetime import timedelta
+from decimal import Decimal
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from finance.models import PaymentPushJob
+from hospital_ms import settings
+
+logger = logging.getLogger(__name__)
+
+retryable_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+"""Errors raised before the push reaches Safaricom, the only ones retried"""
+
+ambiguous_status_codes = {408, 429, 500, 502, 503, 504}
+"""Response statuses after which the customer may have been prompted"""
+
+
+def normalize_phone_number(phone_number: str) -> str:
+    """Phone number in the 2547... format expected by M-PESA
+
+    Raises:
+        ValueError: Incase the phone number is not a Kenyan one
+    """
+    if re.match(r"(^07|^011)", phone_number):
+        phone_number = int(phone_number)
+    elif re.match(r"^\+254", phone_number):
+        phone_number = int(phone_number[4:])
+    elif re.match(r"^254", phone_number):
+        phone_number = int(phone_number[3:])
+    else:
+        raise ValueError("Invalid phone number.")
+    return f"254{phone_number}"
+
+
+def stk_payload(job: PaymentPushJob) -> dict:
+    return {
+        "token": settings.MPESA_TOKEN,
+        "authorization": settings.MPESA_AUTHORIZATION,
+        "BusinessShortCode": settings.MPESA_SHORTCODE,
+        "password": settings.MPESA_PASSWORD,
+        "timestamp": settings.MPESA_TIMESTAMP
+        or timezone.localtime().strftime("%Y%m%d%H%M%S"),
+        "TransactionType": "CustomerPayBillOnline",
+        "amount": int(job.amount),
+        "PartyA": job.phone_number,
+        "PartyB": settings.MPESA_SHORTCODE,
+        "PhoneNumber": job.phone_number,
+        # The key lets the callback find its job even if our request timed
+        # out before the CheckoutRequestID came back, the token authenticates it
+        "CallBackURL": f"{settings.MPESA_CALLBACK_URL}?"
+        + urlencode(dict(job=job.idempotency_key, token=job.callback_token)),
+        "AccountReference": job.account_reference,
+        "TransactionDesc": f"Payment of Ksh.{int(job.amount)}",
+    }
+
+
+def backoff(attempts: int) -> timedelta:
+    """Delay before the next attempt, doubling with every failed one"""
+    delay = settings.MPESA_PUSH_BACKOFF * 2 ** (attempts - 1)
+    return timedelta(seconds=delay * random.uniform(1, 1.5))
+
+
+def _record(job: PaymentPushJob, **fields) -> int:
+    # A callback may have settled the job while it was being sent
+    return PaymentPushJob.objects.filter(
+        pk=job.pk, status=PaymentPushJob.JobStatus.PENDING.value
+    ).update(updated_at=timezone.now(), **fields)
+
+
+class PaymentPushWorker:
+    """Sends due payment push jobs"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport = None):
+        self.transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"Accept": "*/*"},
+                timeout=httpx.Timeout(
+                    settings.MPESA_TIMEOUT, connect=min(5, settings.MPESA_TIMEOUT)
+                ),
+                limits=httpx.Limits(
+                    max_connections=settings.MPESA_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.MPESA_MAX_CONNECTIONS,
+                ),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def send(self, job: PaymentPushJob):
+        """Attempts the push once and records the outcome"""
+        try:
+            response = await self.client.post(
+                settings.MPESA_URL,
+                json=stk_payload(job),
+                headers={"Idempotency-Key": str(job.idempotency_key)},
+            )
+        except retryable_errors as e:
+            return await self.retry(job, f"{type(e).__name__}: {e}")
+        except httpx.TransportError as e:
+            return await self.leave_to_callback(job, f"{type(e).__name__}: {e}")
+        if response.status_code in ambiguous_status_codes:
+            return await self.leave_to_callback(job, f"HTTP {response.status_code}")
+        if response.is_error:
+            return await self.fail(
+                job, f"HTTP {response.status_code}: {response.text}"
+            )
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if str(data.get("ResponseCode", "0")) != "0":
+            return await self.fail(
+                job, data.get("ResponseDescription") or data.get("errorMessage", "")
+            )
+        await sync_to_async(_record)(
+            job,
+            status=PaymentPushJob.JobStatus.SENT.value,
+            checkout_request_id=data.get("CheckoutRequestID"),
+            last_error="",
+        )
+
+    async def retry(self, job: PaymentPushJob, error: str):
+        if job.attempts >= settings.MPESA_PUSH_MAX_ATTEMPTS:
+            return await self.fail(job, error)
+        logger.warning(
+            f"Payment push {job.pk} attempt {job.attempts} failed: {error}"
+        )
+        await sync_to_async(_record)(
+            job,
+            next_attempt_at=timezone.now() + backoff(job.attempts),
+            last_error=error,
+        )
+
+    async def leave_to_callback(self, job: PaymentPushJob, error: str):
+        """Marks the job sent without retrying it. Pushing it again could
+        prompt the customer twice."""
+        logger.warning(f"Payment push {job.pk} outcome unknown: {error}")
+        await sync_to_async(_record)(
+            job,
+            status=PaymentPushJob.JobStatus.SENT.value,
+            last_error=f"Outcome unknown: {error}",
+        )
+
+    async def fail(self, job: PaymentPushJob, error: str):
+        logger.error(f"Payment push {job.pk} failed: {error}")
+        await sync_to_async(_record)(
+            job, status=PaymentPushJob.JobStatus.FAILED.value, last_error=error
+        )
+
+    async def run_once(self) -> int:
+        """Sends the jobs due now. Returns how many were attempted."""
+        jobs = await sync_to_async(PaymentPushJob.claim_due)(
+            settings.MPESA_MAX_CONNECTIONS, settings.MPESA_PUSH_LEASE
+        )
+        await asyncio.gather(*(self.send(job) for job in jobs))
+        return len(jobs)
+
+    async def run(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                logger.exception("Failed to send payment pushes")
+            await asyncio.sleep(settings.MPESA_PUSH_INTERVAL)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+payment_push_worker = PaymentPushWorker()
+"""Worker run alongside the api"""
+
+
+def reconcile(idempotency_key, callback: dict) -> PaymentPushJob | None:
+    """Settles the job of an STK callback
+
+    Args:
+        idempotency_key: Key the job was pushed with.
+        callback (dict): `Body.stkCallback` of an authenticated callback request.
+
+    Raises:
+        PaymentAmountMismatchError: Incase the amount paid is not the one requested
+    """
+    if str(callback.get("ResultCode")) != "0":
+        PaymentPushJob.reject(idempotency_key, callback.get("ResultDesc", ""))
+        return None
+    metadata = {
+        item["Name"]: item.get("Value")
+        for item in callback.get("CallbackMetadata", {}).get("Item", [])
+    }
+    amount = metadata.get("Amount")
+    return PaymentPushJob.confirm(
+        idempotency_key,
+        amount=None if amount is None else Decimal(str(amount)),
+        receipt_number=str(metadata.get("MpesaReceiptNumber", "")),
+    )
@@ -1,3 +1,269 @@
-from django.test import TestCase
+import json
+import httpx
+from decimal import Decimal
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from fastapi.testclient import TestClient
+from finance.exceptions import PaymentAmountMismatchError
+from finance.ledger import balance_drift, ledger_balance, take_snapshots
+from finance.models import LedgerEntry, PaymentPushJob, UserAccount
+from finance.mpesa import PaymentPushWorker, reconcile
+from hospital.models import Treatment, TreatmentMedicine
+from hospital.tests import create_medicine, create_patient, run_concurrently
 
-# Create your tests here.
+
+class TreatmentSettlementTest(TestCase):
+    def setUp(self):
+        self.patient = create_patient()
+        self.medicine = create_medicine(price=10)
+        self.treatment = Treatment.objects.create(
+            patient=self.patient, diagnosis="Flu", details="Rest"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.treatment.medicines.add(
+                TreatmentMedicine.objects.create(
+                    medicine=self.medicine, quantity=1, prescription="1x1"
+                )
+            )
+
+    def balance(self) -> Decimal:
+        return UserAccount.objects.get(pk=self.patient.user.account_id).balance
+
+    def test_stale_instances_charge_price_change_once(self):
+        self.assertEqual(self.balance(), Decimal(-10))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.medicine.price = 15
+            self.medicine.save()
+        first = Treatment.objects.get(pk=self.treatment.pk)
+        second = Treatment.objects.get(pk=self.treatment.pk)
+        first.save()
+        second.save()
+        self.assertEqual(self.balance(), Decimal(-15))
+        self.assertEqual(
+            Treatment.objects.get(pk=self.treatment.pk).bill_settled, Decimal(15)
+        )
+
+
+class LedgerPostingTest(TestCase):
+    def test_balance_is_locked_before_entries_are_inserted(self):
+        account_id = create_patient().user.account_id
+        with CaptureQueriesContext(connection) as context:
+            LedgerEntry.post(account_id, 100, LedgerEntry.EntryKind.ADJUSTMENT)
+        statements = [
+            query["sql"].split()[0].upper()
+            for query in context.captured_queries
+            if query["sql"].split()[0].upper() in ("UPDATE", "INSERT")
+        ]
+        self.assertEqual(statements, ["UPDATE", "INSERT"])
+
+
+class ConcurrentPostingTest(TransactionTestCase):
+    def test_snapshots_taken_between_postings_match_balance(self):
+        account_id = create_patient().user.account_id
+
+        def post(thread: int, call: int):
+            if thread == 0:
+                return take_snapshots([account_id])
+            return LedgerEntry.post(account_id, 1, LedgerEntry.EntryKind.ADJUSTMENT)
+
+        outcomes = run_concurrently(post, threads=8, calls=10)
+        self.assertEqual(
+            [outcome for outcome in outcomes if isinstance(outcome, Exception)], []
+        )
+        self.assertEqual(
+            UserAccount.objects.get(pk=account_id).balance, Decimal(7 * 10)
+        )
+        self.assertEqual(ledger_balance(account_id), Decimal(70))
+        self.assertEqual(balance_drift(account_id), 0)
+
+
+class FakeDaraja:
+    """Daraja STK push endpoint answering with the responses scripted.
+    Exceptions scripted are raised as the transport errors they are."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests: list[httpx.Request] = []
+        self.transport = httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        outcome = self.script.pop(0)
+        if isinstance(outcome, type) and issubclass(outcome, httpx.TransportError):
+            raise outcome("Scripted failure", request=request)
+        if isinstance(outcome, int):
+            return httpx.Response(outcome)
+        return httpx.Response(200, json=outcome)
+
+    def callback_query(self, request: int = -1) -> dict:
+        url = json.loads(self.requests[request].content)["CallBackURL"]
+        return {key: value[0] for key, value in parse_qs(urlparse(url).query).items()}
+
+
+accepted = {
+    "ResponseCode": "0",
+    "CheckoutRequestID": "ws_CO_1",
+    "ResponseDescription": "Success. Request accepted for processing",
+}
+
+
+def stk_callback(amount=100, receipt="NLJ7RT61SV", result_code=0) -> dict:
+    return {
+        "ResultCode": result_code,
+        "ResultDesc": "The service request is processed successfully.",
+        "CallbackMetadata": {
+            "Item": [
+                {"Name": "Amount", "Value": amount},
+                {"Name": "MpesaReceiptNumber", "Value": receipt},
+            ]
+        },
+    }
+
+
+def create_push_job(patient) -> PaymentPushJob:
+    return PaymentPushJob.objects.create(
+        user=patient.user,
+        phone_number="254700000000",
+        amount=100,
+        account_reference=patient.user.username,
+    )
+
+
+class PaymentPushWorkerTest(TestCase):
+    def setUp(self):
+        self.job = create_push_job(create_patient())
+
+    def push(self, daraja: FakeDaraja) -> PaymentPushJob:
+        """Sends the job, at once even if it is backing off"""
+        PaymentPushJob.objects.filter(pk=self.job.pk).update(
+            next_attempt_at=timezone.now()
+        )
+        worker = PaymentPushWorker(transport=daraja.transport)
+        try:
+            async_to_sync(worker.run_once)()
+        finally:
+            async_to_sync(worker.aclose)()
+        return PaymentPushJob.objects.get(pk=self.job.pk)
+
+    def test_connect_errors_are_retried(self):
+        daraja = FakeDaraja(httpx.ConnectError, httpx.ConnectTimeout, accepted)
+        job = self.push(daraja)
+        self.assertEqual(job.status, PaymentPushJob.JobStatus.PENDING.value)
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        self.push(daraja)
+        job = self.push(daraja)
+        self.assertEqual(job.status, PaymentPushJob.JobStatus.SENT.value)
+        self.assertEqual(job.checkout_request_id, "ws_CO_1")
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(len(daraja.requests), 3)
+        # Retries are recognisable as the same push
+        self.assertEqual(
+            {request.headers["Idempotency-Key"] for request in daraja.requests},
+            {str(self.job.idempotency_key)},
+        )
+
+    def test_pushes_that_may_have_prompted_are_not_retried(self):
+        for outcome in (httpx.ReadTimeout, httpx.RemoteProtocolError, 503):
+            with self.subTest(outcome=outcome):
+                PaymentPushJob.objects.filter(pk=self.job.pk).update(
+                    status=PaymentPushJob.JobStatus.PENDING.value
+                )
+                daraja = FakeDaraja(outcome)
+                job = self.push(daraja)
+                self.assertEqual(job.status, PaymentPushJob.JobStatus.SENT.value)
+                self.assertTrue(job.last_error.startswith("Outcome unknown"))
+                self.assertEqual(len(daraja.requests), 1)
+
+    def test_rejected_push_fails(self):
+        job = self.push(FakeDaraja({"ResponseCode": "1", "ResponseDescription": "No"}))
+        self.assertEqual(job.status, PaymentPushJob.JobStatus.FAILED.value)
+        self.assertEqual(job.last_error, "No")
+
+    def test_callback_url_authenticates_job(self):
+        daraja = FakeDaraja(accepted)
+        self.push(daraja)
+        query = daraja.callback_query()
+        self.assertEqual(query["job"], str(self.job.idempotency_key))
+        self.assertTrue(PaymentPushJob.authenticate(query["job"], query["token"]))
+        self.assertFalse(PaymentPushJob.authenticate(query["job"], "guess"))
+        self.assertFalse(
+            PaymentPushJob.authenticate(str(uuid4()), self.job.callback_token)
+        )
+
+
+class PaymentConfirmationTest(TestCase):
+    def setUp(self):
+        self.patient = create_patient()
+        self.job = create_push_job(self.patient)
+
+    def balance(self) -> Decimal:
+        return UserAccount.objects.get(pk=self.patient.user.account_id).balance
+
+    def test_resent_callback_is_credited_once(self):
+        reconcile(self.job.idempotency_key, stk_callback())
+        reconcile(self.job.idempotency_key, stk_callback())
+        self.assertEqual(self.balance(), Decimal(100))
+        job = PaymentPushJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.status, PaymentPushJob.JobStatus.COMPLETED.value)
+        self.assertEqual(job.receipt_number, "NLJ7RT61SV")
+
+    def test_every_payment_of_a_push_is_credited(self):
+        reconcile(self.job.idempotency_key, stk_callback(receipt="NLJ7RT61SV"))
+        reconcile(self.job.idempotency_key, stk_callback(receipt="NLJ7RT61SW"))
+        self.assertEqual(self.balance(), Decimal(200))
+        self.assertEqual(balance_drift(self.patient.user.account_id), 0)
+
+    def test_amount_mismatch_is_rejected(self):
+        with self.assertRaises(PaymentAmountMismatchError):
+            reconcile(self.job.idempotency_key, stk_callback(amount=1000000))
+        self.assertEqual(self.balance(), 0)
+        self.assertEqual(
+            PaymentPushJob.objects.get(pk=self.job.pk).status,
+            PaymentPushJob.JobStatus.PENDING.value,
+        )
+
+    def test_cancelled_push_fails(self):
+        reconcile(self.job.idempotency_key, stk_callback(result_code=1032))
+        self.assertEqual(
+            PaymentPushJob.objects.get(pk=self.job.pk).status,
+            PaymentPushJob.JobStatus.FAILED.value,
+        )
+        self.assertEqual(self.balance(), 0)
+
+
+class MpesaCallbackRouteTest(TransactionTestCase):
+    def setUp(self):
+        from api import app
+
+        self.client = TestClient(app)
+        self.patient = create_patient()
+        self.job = create_push_job(self.patient)
+
+    def callback(self, token: str, amount=100) -> httpx.Response:
+        return self.client.post(
+            "/api/v1/mpesa/callback",
+            params=dict(job=str(self.job.idempotency_key), token=token),
+            json={"Body": {"stkCallback": stk_callback(amount=amount)}},
+        )
+
+    def balance(self) -> Decimal:
+        return UserAccount.objects.get(pk=self.patient.user.account_id).balance
+
+    def test_callback_without_job_token_is_forbidden(self):
+        self.assertEqual(self.callback("guess").status_code, 403)
+        self.assertEqual(self.balance(), 0)
+
+    def test_callback_with_other_amount_is_rejected(self):
+        self.assertEqual(self.callback(self.job.callback_token, 5000).status_code, 400)
+        self.assertEqual(self.balance(), 0)
+
+    def test_authenticated_callback_credits_account(self):
+        response = self.callback(self.job.callback_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.assertEqual(self.balance(), Decimal(100))
@@ -7,8 +7,10 @@ from hospital.models import (
     Appointment,
 )
 
+from django.db.models import Count
 from django.utils.translation import gettext_lazy as _
 from hospital_ms.utils.admin import DevelopmentImportExportModelAdmin
+from hospital_ms.utils.export import export_actions
 
 # Register your models here.
 
@@ -33,9 +35,18 @@ class MedicineAdmin(DevelopmentImportExportModelAdmin):
 class PatientAdmin(DevelopmentImportExportModelAdmin):
     search_fields = ("user__username",)
     list_filter = ("created_at",)
+    actions = export_actions("patients")
+
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("user__account")
+            .annotate(treatments_count=Count("treatments"))
+        )
 
     def active_treatments(self, obj) -> int:
-        return obj.treatments.count()
+        return obj.treatments_count
 
     def pending_bill(self, obj: Patient) -> float:
         if obj.user.account.balance < 0:
@@ -44,6 +55,8 @@ class PatientAdmin(DevelopmentImportExportModelAdmin):
             return 0
 
     active_treatments.short_description = _("Active Treatments")
+    active_treatments.admin_order_field = "treatments_count"
+    pending_bill.admin_order_field = "user__account__balance"
     list_display = ("user", "active_treatments", "pending_bill", "created_at")
 
 
@@ -54,17 +67,42 @@ class TreatmentMedicineAdmin(DevelopmentImportExportModelAdmin):
     list_filter = ("updated_at", "created_at")
 
 
+class DoctorListFilter(admin.RelatedFieldListFilter):
+    """Doctors filter loading doctors along with their users"""
+
+    def field_choices(self, field, request, model_admin):
+        ordering = self.field_admin_ordering(field, request, model_admin)
+        return [
+            (doctor.pk, str(doctor))
+            for doctor in field.related_model.objects.select_related("user").order_by(
+                *ordering
+            )
+        ]
+
+
 @admin.register(Treatment)
 class TreatmentAdmin(DevelopmentImportExportModelAdmin):
+    actions = export_actions("treatments")
+
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("patient__user")
+            .annotate(doctors_count=Count("doctors"))
+        )
+
     def active_doctors(self, obj: Treatment):
-        return obj.doctors.count()
+        return obj.doctors_count
 
     active_doctors.short_description = _("Active Doctors")
+    active_doctors.admin_order_field = "doctors_count"
 
     def total_billed(self, obj: Treatment):
-        return obj.total_bill
+        return obj.grand_total
 
     total_billed.short_description = _("Total billed")
+    total_billed.admin_order_field = "grand_total"
     list_display = (
         "patient",
         "patient_type",
@@ -77,7 +115,7 @@ class TreatmentAdmin(DevelopmentImportExportModelAdmin):
     search_fields = ("patient__user__username", "diagnosis")
     list_filter = (
         "patient_type",
-        "doctors",
+        ("doctors", DoctorListFilter),
         "treatment_status",
         "updated_at",
         "created_at",
@@ -105,3 +143,4 @@ class AppointmentAdmin(DevelopmentImportExportModelAdmin):
     search_fields = ("patient__user__username", "doctor__user__username")
     list_filter = ("status", "appointment_datetime", "updated_at", "created_at")
     list_editable = ("status",)
+    actions = export_actions("appointments")
@@ -0,0 +1,138 @@
+"""Treatment billing computations
+
+All bill components are computed in the database as correlated subqueries so
+that one or many treatments are billed in a single query. Each component is
+aggregated separately to avoid the row multiplication that joining the
+`medicines`, `doctors` and `extra_fees` relations together would cause.
+
+The results are stored on `Treatment` as its bill summary columns, which are
+refreshed through `BillRecomputeQueue` whenever a bill input changes.
+"""
+
+import threading
+import functools
+from decimal import Decimal
+from typing import NamedTuple, Callable, Iterable
+from django.db import transaction
+from django.db.models import (
+    DecimalField,
+    F,
+    Model,
+    OuterRef,
+    QuerySet,
+    Subquery,
+    Sum,
+    Value,
+)
+from django.db.models.functions import Coalesce
+
+bill_field = DecimalField(max_digits=14, decimal_places=2)
+
+bill_annotations = (
+    "medicine_bill_total",
+    "treatment_bill_total",
+    "extra_fees_bill_total",
+)
+"""Names of the attributes set by `annotate_bills`"""
+
+
+class TreatmentBill(NamedTuple):
+    medicine: Decimal = Decimal(0)
+    treatment: Decimal = Decimal(0)
+    extra_fees: Decimal = Decimal(0)
+
+    @property
+    def total(self) -> Decimal:
+        return self.medicine + self.treatment + self.extra_fees
+
+
+def _component(through: type[Model], expression) -> Coalesce:
+    total = (
+        through.objects.filter(treatment_id=OuterRef("pk"))
+        .values("treatment_id")
+        .annotate(total=Sum(expression, output_field=bill_field))
+        .values("total")
+    )
+    return Coalesce(
+        Subquery(total, output_field=bill_field),
+        Value(Decimal(0)),
+        output_field=bill_field,
+    )
+
+
+def annotate_bills(queryset: QuerySet) -> QuerySet:
+    """Annotates treatments queryset with the bill components"""
+    model = queryset.model
+    return queryset.annotate(
+        medicine_bill_total=_component(
+            model.medicines.through,
+            F("treatmentmedicine__medicine__price") * F("treatmentmedicine__quantity"),
+        ),
+        treatment_bill_total=_component(
+            model.doctors.through, F("doctor__speciality__treatment_charges")
+        ),
+        extra_fees_bill_total=_component(
+            model.extra_fees.through, F("extrafee__amount")
+        ),
+    )
+
+
+def bill_from_row(row) -> TreatmentBill:
+    """Reads bill from an annotated treatment instance or values row"""
+    if isinstance(row, dict):
+        return TreatmentBill(*(row[name] for name in bill_annotations))
+    return TreatmentBill(*(getattr(row, name) for name in bill_annotations))
+
+
+def get_bills(queryset: QuerySet) -> dict[int, TreatmentBill]:
+    """Bills of the treatments in queryset keyed by treatment id"""
+    return {
+        row["pk"]: bill_from_row(row)
+        for row in annotate_bills(queryset.order_by()).values(
+            "pk", *bill_annotations
+        )
+    }
+
+
+class BillRecomputeQueue:
+    """Treatments whose bill summary is stale.
+
+    Treatments queued in a transaction are recomputed together, in batches,
+    once it commits. Nothing is recomputed if it rolls back.
+    """
+
+    def __init__(
+        self, recompute: Callable[[list[int], bool], int], batch_size: int = 500
+    ):
+        self.recompute = recompute
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    def put(self, treatment_ids: Iterable[int], settle: bool = False):
+        """Queues treatments. `settle` charges patients for the change too."""
+        connection = transaction.get_connection()
+        pending, flush = getattr(self._local, "queued", (None, None))
+        if not any(callback is flush for _, callback, _ in connection.run_on_commit):
+            # First in this transaction, or the previous one is done with
+            pending = {}
+            flush = functools.partial(self.flush, pending)
+            self._local.queued = (pending, flush)
+            queue = True
+        else:
+            queue = False
+        for treatment_id in treatment_ids:
+            pending[treatment_id] = pending.get(treatment_id, False) or settle
+        if queue and pending:
+            transaction.on_commit(flush, robust=True)
+
+    def flush(self, pending: dict[int, bool]):
+        for settle in (True, False):
+            treatment_ids = sorted(
+                treatment_id
+                for treatment_id, settles in pending.items()
+                if settles is settle
+            )
+            for start in range(0, len(treatment_ids), self.batch_size):
+                self.recompute(
+                    treatment_ids[start : start + self.batch_size], settle
+                )
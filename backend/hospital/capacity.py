@@ -0,0 +1,78 @@
+"""Doctors appointments capacity
+
+Booked appointments, cancelled ones aside, are counted per doctor per day in
+one grouped query and compared against the doctor's
+`Speciality.appointments_limit`.
+"""
+
+from datetime import date, timedelta
+from typing import NamedTuple, Iterable
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+from hospital.models import Appointment
+from hospital.utils import local_day_range
+
+
+class DayCapacity(NamedTuple):
+    date: date
+    is_working_day: bool
+    appointments_limit: int
+    booked: int
+
+    @property
+    def available(self) -> int:
+        if not self.is_working_day:
+            return 0
+        return max(self.appointments_limit - self.booked, 0)
+
+
+def booked_counts(
+    doctor_ids: Iterable[int], start: date, end: date
+) -> dict[tuple[int, date], int]:
+    """Appointments booked keyed by (doctor id, date) for dates in range"""
+    lower, upper = local_day_range(start, end)
+    rows = (
+        Appointment.objects.filter(
+            doctor_id__in=list(doctor_ids),
+            appointment_datetime__gte=lower,
+            appointment_datetime__lt=upper,
+        )
+        .exclude(status=Appointment.AppointmentStatus.CANCELLED.value)
+        .annotate(day=TruncDate("appointment_datetime"))
+        .values("doctor_id", "day")
+        .annotate(booked=Count("id"))
+        .order_by()
+    )
+    return {(row["doctor_id"], row["day"]): row["booked"] for row in rows}
+
+
+def booked_on(doctor_id: int, day: date) -> int:
+    return booked_counts([doctor_id], day, day).get((doctor_id, day), 0)
+
+
+def capacity_calendar(doctor, start: date, end: date) -> list[DayCapacity]:
+    """Day by day appointments capacity of a doctor.
+
+    Args:
+        doctor (Doctor): Target doctor, ideally with `speciality` selected.
+        start (date): First day in range.
+        end (date): Last day in range.
+
+    Returns:
+        list[DayCapacity]: One entry per day from start to end.
+    """
+    limit = doctor.speciality.appointments_limit if doctor.speciality else 0
+    working_days = {day.name for day in doctor.working_days.all()}
+    booked = booked_counts([doctor.id], start, end)
+    calendar = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        calendar.append(
+            DayCapacity(
+                date=day,
+                is_working_day=day.strftime("%A") in working_days,
+                appointments_limit=limit,
+                booked=booked.get((doctor.id, day), 0),
+            )
+        )
+    return calendar
@@ -4,3 +4,7 @@ class HospitalException(Exception):
 
 class InsufficientMedicineStockError(HospitalException):
     """Raised when medicine amount required is more that avaialable stock"""
+
+
+class AppointmentLimitReachedError(HospitalException):
+    """Raised when doctor's daily appointments limit has been reached"""
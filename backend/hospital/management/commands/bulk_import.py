@@ -0,0 +1,45 @@
+from pathlib import Path
+from django.core.management.base import BaseCommand, CommandError
+from hospital_ms.utils.bulk_import import (
+    importers,
+    readers,
+    import_records,
+    CHUNK_SIZE,
+)
+
+
+class Command(BaseCommand):
+    help = "Imports medicines, doctors or patients from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("dataset", choices=list(importers), help="Rows imported")
+        parser.add_argument("path", type=Path, help="File to import from")
+        parser.add_argument(
+            "--format",
+            choices=list(readers),
+            help="Format of the file. Defaults to its extension",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help="Rows imported per transaction",
+        )
+
+    def handle(self, *args, **options):
+        path: Path = options["path"]
+        format = options["format"] or path.suffix.lstrip(".").replace("jsonl", "ndjson")
+        if format not in readers:
+            raise CommandError(f"Unknown format of {path}, pass --format")
+        if not path.is_file():
+            raise CommandError(f"{path} does not exist")
+        with path.open(newline="", encoding="utf-8") as file:
+            report = import_records(
+                importers[options["dataset"]],
+                readers[format](file),
+                chunk_size=options["chunk_size"],
+                progress=lambda report: self.stdout.write(str(report)),
+            )
+        for error in report.errors:
+            self.stdout.write(self.style.WARNING(error))
+        self.stdout.write(self.style.SUCCESS(str(report)))
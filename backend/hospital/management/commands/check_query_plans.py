@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from hospital.models import Treatment, Appointment
+from hospital.utils import local_day_range
+from external.models import News, Gallery, ServiceFeedback
+
+
+def hot_queries() -> list[tuple[str, object, str]]:
+    """(description, queryset, index expected to serve it) of the query
+    shapes the api relies on"""
+    now = timezone.now()
+    after = Q(created_at__lt=now) | Q(created_at=now, id__lt=1)
+    ordering = ("-created_at", "-id")
+    lower, upper = local_day_range(now.date(), now.date())
+    return [
+        (
+            "Patient treatments page",
+            Treatment.objects.filter(after, patient_id=1).order_by(*ordering)[:101],
+            "treatment_patient_recent_idx",
+        ),
+        (
+            "Patient appointments page",
+            Appointment.objects.filter(after, patient_id=1).order_by(*ordering)[:101],
+            "appointment_patient_recent_idx",
+        ),
+        (
+            "Patient appointments by status",
+            Appointment.objects.filter(patient_id=1, status="Scheduled").order_by(
+                *ordering
+            )[:101],
+            "appointment_patient_status_idx",
+        ),
+        (
+            "Doctor appointments in a day",
+            Appointment.objects.filter(
+                doctor_id=1,
+                appointment_datetime__gte=lower,
+                appointment_datetime__lt=upper,
+            ),
+            "appointment_doctor_time_idx",
+        ),
+        (
+            "Published news page",
+            News.objects.filter(after, is_published=True).order_by(*ordering)[:101],
+            "news_published_recent_idx",
+        ),
+        (
+            "Shown galleries page",
+            Gallery.objects.filter(after, show_in_index=True).order_by(*ordering)[
+                :31
+            ],
+            "gallery_shown_recent_idx",
+        ),
+        (
+            "Shown feedbacks page",
+            ServiceFeedback.objects.filter(after, show_in_index=True).order_by(
+                *ordering
+            )[:101],
+            "feedback_shown_recent_idx",
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Checks that the hot api queries are planned on their indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verbose-plans",
+            action="store_true",
+            help="Print the query plan of every query",
+        )
+
+    def handle(self, *args, **options):
+        # Planners of other databases weigh table statistics, so a small table
+        # is legitimately scanned. SQLite plans are deterministic.
+        strict = connection.vendor == "sqlite"
+        failures = []
+        for description, queryset, index in hot_queries():
+            plan = queryset.explain()
+            if options["verbose_plans"]:
+                self.stdout.write(f"{description}:\n{plan}\n")
+            if index in plan:
+                self.stdout.write(f"{description} uses {index}")
+            else:
+                failures.append(description)
+                self.stdout.write(
+                    self.style.ERROR(f"{description} does not use {index}:\n{plan}")
+                )
+        if failures and strict:
+            raise CommandError(f"{len(failures)} query plan(s) regressed")
+        self.stdout.write(self.style.SUCCESS("Query plans checked"))
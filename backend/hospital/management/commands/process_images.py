@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from hospital_ms.utils.renditions import image_fields, is_stale, process
+
+
+class Command(BaseCommand):
+    help = "Makes renditions of images yet to be processed"
+
+    def handle(self, *args, **options):
+        total = 0
+        for model, field in image_fields.items():
+            instances = model.objects.only("pk", field, "renditions").order_by("pk")
+            for instance in instances.iterator(chunk_size=500):
+                if is_stale(instance) and process(model, instance.pk):
+                    total += 1
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} image(s)"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from hospital.models import Treatment
+
+
+class Command(BaseCommand):
+    help = "Recomputes treatments bill summary from their relations"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Treatments recomputed per transaction",
+        )
+        parser.add_argument(
+            "--settle",
+            action="store_true",
+            help="Charge patients for bills found to have changed too",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        batch = []
+        treatment_ids = Treatment.objects.order_by("id").values_list("id", flat=True)
+        for treatment_id in treatment_ids.iterator(chunk_size=options["batch_size"]):
+            batch.append(treatment_id)
+            if len(batch) == options["batch_size"]:
+                total += Treatment.recompute_bills(batch, settle=options["settle"])
+                batch = []
+        if batch:
+            total += Treatment.recompute_bills(batch, settle=options["settle"])
+        self.stdout.write(self.style.SUCCESS(f"Recomputed {total} treatment(s)"))
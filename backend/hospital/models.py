@@ -1,10 +1,16 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
 from users.models import CustomUser
+from finance.models import LedgerEntry
 from django.utils.translation import gettext_lazy as _
 from enum import Enum
-from hospital.exceptions import InsufficientMedicineStockError
-from django.db.models import Sum
-from hospital.utils import generate_document_filepath
+import datetime
+from hospital.exceptions import (
+    InsufficientMedicineStockError,
+    AppointmentLimitReachedError,
+)
+from hospital.utils import generate_document_filepath, local_date, local_day_range
+from hospital.billing import TreatmentBill, get_bills
 
 # Create your models here.
 
@@ -67,6 +73,12 @@ class Medicine(models.Model):
         help_text=_("Photo of the medicine"),
         blank=True,
     )
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text=_("Resized copies of the photo"),
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name=_("Created At"),
@@ -81,6 +93,31 @@ class Medicine(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def reserve_stock(cls, medicine_id: int, quantity: int):
+        """Atomically deducts quantity from stock if enough is available
+
+        Raises:
+            InsufficientMedicineStockError: Incase stock is less than quantity
+        """
+        if quantity <= 0:
+            return
+        if not cls.objects.filter(pk=medicine_id, stock__gte=quantity).update(
+            stock=F("stock") - quantity
+        ):
+            medicine = cls.objects.only("name", "stock").get(pk=medicine_id)
+            raise InsufficientMedicineStockError(
+                f"There is only {medicine.stock} units of {medicine} remaining "
+                f"as opposed to the required {quantity} units"
+            )
+
+    @classmethod
+    def release_stock(cls, medicine_id: int, quantity: int):
+        """Atomically returns quantity to stock"""
+        if quantity <= 0:
+            return
+        cls.objects.filter(pk=medicine_id).update(stock=F("stock") + quantity)
+
 
 class Patient(models.Model):
     user = models.OneToOneField(
@@ -125,15 +162,32 @@ class TreatmentMedicine(models.Model):
         return f"{self.medicine} - {self.quantity}"
 
     def save(self, *args, **kwargs):
-        if self.medicine.stock < self.quantity:
-            raise InsufficientMedicineStockError(
-                f"There is only {self.medicine.stock} units of {self.medicine} remaining "
-                f"as opposed to the required {self.quantity} units"
-            )
-        # Consider changes etc
-        self.medicine.stock -= self.quantity
-        self.medicine.save()
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            previous = None
+            if self.id:
+                previous = (
+                    TreatmentMedicine.objects.select_for_update()
+                    .filter(pk=self.id)
+                    .values("medicine_id", "quantity")
+                    .first()
+                )
+            if previous is None:
+                Medicine.reserve_stock(self.medicine_id, self.quantity)
+            elif previous["medicine_id"] != self.medicine_id:
+                # Medicine swapped
+                Medicine.release_stock(previous["medicine_id"], previous["quantity"])
+                Medicine.reserve_stock(self.medicine_id, self.quantity)
+            else:
+                # Only the change in quantity affects stock
+                change = self.quantity - previous["quantity"]
+                Medicine.reserve_stock(self.medicine_id, change)
+                Medicine.release_stock(self.medicine_id, -change)
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            Medicine.release_stock(self.medicine_id, self.quantity)
+            return super().delete(*args, **kwargs)
 
 
 class Treatment(models.Model):
@@ -204,6 +258,34 @@ class Treatment(models.Model):
         help_text=_("Amount of bill paid so far"),
         default=0,
     )
+    medicine_total = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        help_text=_("Bill of medicines given"),
+        default=0,
+        editable=False,
+    )
+    treatment_total = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        help_text=_("Treatment charges of the doctors involved"),
+        default=0,
+        editable=False,
+    )
+    extra_fees_total = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        help_text=_("Extra fees charged"),
+        default=0,
+        editable=False,
+    )
+    grand_total = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        help_text=_("Total bill"),
+        default=0,
+        editable=False,
+    )
 
     updated_at = models.DateTimeField(
         auto_now=True,
@@ -216,57 +298,121 @@ class Treatment(models.Model):
         help_text=_("The date and time when the treatment was created"),
     )
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a patient's treatments
+            models.Index(
+                fields=["patient", "-created_at", "-id"],
+                name="treatment_patient_recent_idx",
+            ),
+        ]
+
+    bill_fields = (
+        "medicine_total",
+        "treatment_total",
+        "extra_fees_total",
+        "grand_total",
+    )
+    """Bill summary columns. Kept current by `hospital.signals`"""
+
+    @property
+    def bill(self) -> TreatmentBill:
+        return TreatmentBill(
+            self.medicine_total, self.treatment_total, self.extra_fees_total
+        )
+
     @property
     def total_medicine_bill(self) -> float:
-        treatment_bill = 0
-        for treatment_medicine in self.medicines.all():
-            treatment_bill += (
-                treatment_medicine.medicine.price * treatment_medicine.quantity
-            )
-        return treatment_bill
+        return self.bill.medicine
 
     @property
     def total_treatment_bill(self) -> float:
-        return (
-            self.doctors.aggregate(
-                total_charges=Sum("speciality__treatment_charges")
-            ).get("total_charges", 0)
-            or 0
-        )
+        return self.bill.treatment
 
     @property
     def total_extra_fees_bill(self) -> float:
-        return (
-            self.extra_fees.aggregate(total_fees=Sum("amount")).get("total_fees", 0)
-            or 0
-        )
+        return self.bill.extra_fees
 
     @property
     def total_bill(self) -> float:
-        return (
-            self.total_medicine_bill
-            + self.total_treatment_bill
-            + self.total_extra_fees_bill
+        return self.grand_total
+
+    def set_bill(self, bill: TreatmentBill):
+        self.medicine_total = bill.medicine
+        self.treatment_total = bill.treatment
+        self.extra_fees_total = bill.extra_fees
+        self.grand_total = bill.total
+
+    def settlement(self) -> LedgerEntry | None:
+        """Ledger entry charging the unsettled part of the bill if any.
+        Marks the bill as settled."""
+        if self.bill_settled == self.grand_total:
+            return None
+        # deduct from user account
+        payable_amount = self.grand_total - self.bill_settled
+        self.bill_settled = self.grand_total
+        return LedgerEntry(
+            account_id=self.patient.user.account_id,
+            amount=-payable_amount,
+            kind=LedgerEntry.EntryKind.TREATMENT.value,
+            reference=f"treatment:{self.id}",
         )
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        total_bill = self.total_bill
-        # TODO: Fix: First time entry results to total bill 0
-        """
-        print("Total medicine bill : ", self.total_medicine_bill)
-        print("Total extra-fees : ", self.total_extra_fees_bill)
-        print("Total bill :", total_bill)
-        print("Settled bill :", self.bill_settled)
-        """
-        if self.bill_settled != total_bill:
-            # deduct from user account
-            payable_amount = total_bill - self.bill_settled
-            self.patient.user.account.balance -= payable_amount
-            self.bill_settled = total_bill
-            self.patient.user.account.save()
+        with transaction.atomic():
+            stored_settled = (
+                Treatment.objects.select_for_update()
+                .filter(pk=self.pk)
+                .values_list("bill_settled", flat=True)
+                .first()
+                if self.pk
+                else None
+            )
+            if stored_settled is not None:
+                # Settled against the locked row rather than this instance,
+                # which may be stale, so that a change is charged once
+                self.bill_settled = stored_settled
+                # Relations are saved apart from the treatment, their changes
+                # are billed through `hospital.signals`
+                self.set_bill(
+                    get_bills(Treatment.objects.filter(pk=self.pk)).get(
+                        self.pk, TreatmentBill()
+                    )
+                )
+                settlement = self.settlement()
+                if settlement:
+                    LedgerEntry.post_many([settlement])
             super().save(*args, **kwargs)
 
+    @classmethod
+    def recompute_bills(cls, treatment_ids: list[int], settle: bool = False) -> int:
+        """Refreshes bill summary of the given treatments.
+
+        Args:
+            treatment_ids (list[int]): Treatments to refresh.
+            settle (bool): Charge patients for changes to their bills too.
+
+        Returns:
+            int: Treatments refreshed.
+        """
+        with transaction.atomic():
+            treatments = list(
+                cls.objects.select_for_update(of=("self",))
+                .select_related("patient__user")
+                .filter(pk__in=treatment_ids)
+            )
+            bills = get_bills(cls.objects.filter(pk__in=treatment_ids))
+            settlements = []
+            for treatment in treatments:
+                treatment.set_bill(bills.get(treatment.pk, TreatmentBill()))
+                if settle:
+                    settlement = treatment.settlement()
+                    if settlement:
+                        settlements.append(settlement)
+            LedgerEntry.post_many(settlements)
+            cls.objects.bulk_update(treatments, [*cls.bill_fields, "bill_settled"])
+        return len(treatments)
+
     def __str__(self):
         return f"{self.patient} - {self.diagnosis} on {self.created_at.strftime("%d-%b-%Y %H:%M:%S") if self.created_at else "now"}"
 
@@ -320,31 +466,173 @@ class Appointment(models.Model):
         help_text=_("The date and time when the appointment was created"),
     )
 
+    class Meta:
+        indexes = [
+            # Keyset pagination of a patient's appointments
+            models.Index(
+                fields=["patient", "-created_at", "-id"],
+                name="appointment_patient_recent_idx",
+            ),
+            models.Index(
+                fields=["patient", "status", "-created_at", "-id"],
+                name="appointment_patient_status_idx",
+            ),
+            # Appointments booked per doctor per day
+            models.Index(
+                fields=["doctor", "appointment_datetime"],
+                name="appointment_doctor_time_idx",
+            ),
+        ]
+
+    def holds_slot(self, status: str = None) -> bool:
+        """Whether an appointment of `status` takes up capacity of its day"""
+        return (status or self.status) != self.AppointmentStatus.CANCELLED.value
+
     def save(self, *args, **kwargs):
-        if not self.id:
-            # New entry
-            # Credit user account
-            self.patient.user.account.balance -= (
-                self.doctor.speciality.appointment_charges
-            )
-            self.patient.user.account.save()
-        elif self.status == self.AppointmentStatus.CANCELLED.value:
-            # Debit user account
-            self.patient.user.account.balance += (
-                self.doctor.speciality.appointment_charges
-            )
-            self.patient.user.account.save()
+        # Loaded ahead of the transaction, see `AppointmentCounter.reserve`
+        speciality = self.doctor.speciality
+        day = local_date(self.appointment_datetime)
+        with transaction.atomic():
+            previous = None
+            if self.id:
+                previous = (
+                    Appointment.objects.select_for_update()
+                    .filter(pk=self.id)
+                    .values("doctor_id", "appointment_datetime", "status")
+                    .first()
+                )
+            # The patient is charged for as long as the appointment holds a slot
+            entry = None
+            if previous is None:
+                # New entry
+                held, holds = False, self.holds_slot()
+                if holds:
+                    AppointmentCounter.reserve(self.doctor, day)
+            else:
+                previous_day = local_date(previous["appointment_datetime"])
+                moved = (previous["doctor_id"], previous_day) != (self.doctor_id, day)
+                held, holds = self.holds_slot(previous["status"]), self.holds_slot()
+                if held and (moved or not holds):
+                    # Rescheduled or cancelled
+                    AppointmentCounter.release(previous["doctor_id"], previous_day)
+                if holds and (moved or not held):
+                    AppointmentCounter.reserve(self.doctor, day)
+            if holds and not held:
+                # Debit user account
+                entry = (
+                    -speciality.appointment_charges,
+                    LedgerEntry.EntryKind.APPOINTMENT,
+                )
+            elif held and not holds:
+                # Credit user account
+                entry = (
+                    speciality.appointment_charges,
+                    LedgerEntry.EntryKind.APPOINTMENT_REFUND,
+                )
 
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
+            if entry is not None:
+                LedgerEntry.post(
+                    self.patient.user.account_id,
+                    *entry,
+                    reference=f"appointment:{self.id}",
+                )
 
     def delete(self, *args, **kwargs):
-        if self.status != self.AppointmentStatus.COMPLETED.value:
-            # Debit user account
-            self.patient.user.account.balance += (
-                self.doctor.speciality.appointment_charges
+        with transaction.atomic():
+            # Deleted as stored, unsaved changes were neither charged nor
+            # reserved. `appointment_deleted` releases the stored slot too.
+            stored = (
+                Appointment.objects.filter(pk=self.id)
+                .values("patient_id", "doctor_id", "appointment_datetime", "status")
+                .first()
             )
-            self.patient.user.account.save()
-        super().delete(*args, **kwargs)
+            for field, value in (stored or {}).items():
+                setattr(self, field, value)
+            if self.status == self.AppointmentStatus.SCHEDULED.value:
+                # Credit user account
+                LedgerEntry.post(
+                    self.patient.user.account_id,
+                    self.doctor.speciality.appointment_charges,
+                    LedgerEntry.EntryKind.APPOINTMENT_REFUND,
+                    reference=f"appointment:{self.id}",
+                )
+            # The slot is released by `hospital.signals.appointment_deleted`
+            return super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.patient} with {self.doctor} on {self.appointment_datetime.strftime("%d-%b-%Y %H:%M:%S")}"
+
+
+class AppointmentCounter(models.Model):
+    """Appointments booked per doctor per day.
+
+    Capacity is reserved with a conditional `UPDATE` so that concurrent
+    bookings cannot exceed the doctor's daily appointments limit.
+    """
+
+    doctor = models.ForeignKey(
+        "staffing.Doctor",
+        on_delete=models.CASCADE,
+        help_text=_("Doctor booked"),
+        related_name="appointment_counters",
+    )
+    date = models.DateField(help_text=_("Appointments date"))
+    booked = models.PositiveIntegerField(
+        default=0, help_text=_("Appointments booked on this date")
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["doctor", "date"], name="unique_doctor_appointment_date"
+            )
+        ]
+
+    @classmethod
+    def reserve(cls, doctor, day: datetime.date):
+        """Takes one appointment slot of doctor on a particular day.
+
+        The conditional `UPDATE` comes first so that the transaction writes
+        before it reads; SQLite fails a transaction that reads then writes
+        while others are writing instead of waiting for them.
+
+        Raises:
+            AppointmentLimitReachedError: Incase doctor is fully booked
+        """
+        limit = doctor.speciality.appointments_limit
+        counter = cls.objects.filter(doctor_id=doctor.id, date=day)
+        if counter.filter(booked__lt=limit).update(booked=F("booked") + 1):
+            return
+        if not counter.exists():
+            lower, upper = local_day_range(day, day)
+            booked = (
+                Appointment.objects.filter(
+                    doctor_id=doctor.id,
+                    appointment_datetime__gte=lower,
+                    appointment_datetime__lt=upper,
+                )
+                .exclude(status=Appointment.AppointmentStatus.CANCELLED.value)
+                .count()
+            )
+            try:
+                with transaction.atomic():
+                    cls.objects.create(doctor_id=doctor.id, date=day, booked=booked)
+            except IntegrityError:
+                # Created by a concurrent booking
+                pass
+            if counter.filter(booked__lt=limit).update(booked=F("booked") + 1):
+                return
+        raise AppointmentLimitReachedError(
+            f"{doctor} has reached the maximum number of appointments for {day}"
+        )
+
+    @classmethod
+    def release(cls, doctor_id: int, day: datetime.date):
+        """Frees one appointment slot of doctor on a particular day"""
+        cls.objects.filter(doctor_id=doctor_id, date=day, booked__gt=0).update(
+            booked=F("booked") - 1
+        )
+
+    def __str__(self):
+        return f"{self.doctor} - {self.booked} on {self.date}"
@@ -0,0 +1,127 @@
+"""Keeps treatments bill summary current
+
+Changes to what a treatment is made of (its medicines, doctors and extra
+fees) are recomputed and charged. Changes to prices only refresh the summary;
+they are charged the next time the treatment is saved, as before.
+
+Appointments deleted by any means give their slot back to the doctor's day.
+"""
+
+from django.db.models import Model
+from django.db.models.signals import (
+    m2m_changed,
+    pre_save,
+    post_save,
+    pre_delete,
+    post_delete,
+)
+from django.dispatch import receiver
+from hospital.models import (
+    Treatment,
+    TreatmentMedicine,
+    Medicine,
+    Appointment,
+    AppointmentCounter,
+)
+from hospital.billing import BillRecomputeQueue
+from staffing.models import Doctor, Speciality
+from finance.models import ExtraFee
+from hospital.utils import local_date
+
+recompute_queue = BillRecomputeQueue(Treatment.recompute_bills)
+"""Treatments awaiting bill recomputation"""
+
+relations = {
+    Treatment.medicines.through: "medicines",
+    Treatment.doctors.through: "doctors",
+    Treatment.extra_fees.through: "extra_fees",
+}
+"""Treatment relation name of each billed m2m through model"""
+
+billed_fields = {
+    Medicine: ("price", "medicines__medicine"),
+    Speciality: ("treatment_charges", "doctors__speciality"),
+    ExtraFee: ("amount", "extra_fees"),
+    Doctor: ("speciality_id", "doctors"),
+}
+"""Field billed of each model and the lookup from treatments to it"""
+
+
+def treatments_of(lookup: str, instance: Model) -> list[int]:
+    return list(
+        Treatment.objects.filter(**{lookup: instance})
+        .values_list("id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(m2m_changed, sender=Treatment.medicines.through)
+@receiver(m2m_changed, sender=Treatment.doctors.through)
+@receiver(m2m_changed, sender=Treatment.extra_fees.through)
+def treatment_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        instance._cleared_treatments = treatments_of(relations[sender], instance)
+    elif action in ("post_add", "post_remove"):
+        recompute_queue.put(pk_set if reverse else [instance.pk], settle=True)
+    elif action == "post_clear":
+        recompute_queue.put(
+            instance._cleared_treatments if reverse else [instance.pk], settle=True
+        )
+
+
+@receiver(post_save, sender=TreatmentMedicine)
+def treatment_medicine_saved(sender, instance: TreatmentMedicine, created, **kwargs):
+    if not created:
+        recompute_queue.put(treatments_of("medicines", instance), settle=True)
+
+
+@receiver(pre_delete, sender=TreatmentMedicine)
+@receiver(pre_delete, sender=ExtraFee)
+@receiver(pre_delete, sender=Doctor)
+@receiver(pre_delete, sender=Speciality)
+def billed_object_deleting(sender, instance, **kwargs):
+    # Through rows go away with the object without m2m_changed
+    lookup = "medicines" if sender is TreatmentMedicine else billed_fields[sender][1]
+    instance._billed_treatments = treatments_of(lookup, instance)
+
+
+@receiver(post_delete, sender=TreatmentMedicine)
+@receiver(post_delete, sender=ExtraFee)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Speciality)
+def billed_object_deleted(sender, instance, **kwargs):
+    recompute_queue.put(
+        instance._billed_treatments, settle=sender is TreatmentMedicine
+    )
+
+
+@receiver(pre_save, sender=Medicine)
+@receiver(pre_save, sender=Speciality)
+@receiver(pre_save, sender=ExtraFee)
+@receiver(pre_save, sender=Doctor)
+def billed_object_saving(sender, instance, **kwargs):
+    field = billed_fields[sender][0]
+    instance._billed_value = (
+        sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+        if instance.pk
+        else None
+    )
+
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_save, sender=Speciality)
+@receiver(post_save, sender=ExtraFee)
+@receiver(post_save, sender=Doctor)
+def billed_object_saved(sender, instance, created, **kwargs):
+    field, lookup = billed_fields[sender]
+    if not created and getattr(instance, field) != instance._billed_value:
+        recompute_queue.put(treatments_of(lookup, instance))
+
+
+@receiver(post_delete, sender=Appointment)
+def appointment_deleted(sender, instance: Appointment, **kwargs):
+    # Also sent for bulk and cascaded deletes which skip `Appointment.delete`
+    if instance.holds_slot():
+        AppointmentCounter.release(
+            instance.doctor_id, local_date(instance.appointment_datetime)
+        )
@@ -1,3 +1,557 @@
-from django.test import TestCase
+import datetime as dt
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from asgiref.sync import async_to_sync
+from fastapi.testclient import TestClient
+from api.v1.pagination import next_cursor_header
+from api.v1.utils import generate_token
+from external.tests import queries
+from hospital.capacity import booked_on
+from hospital.management.commands.check_query_plans import hot_queries
+from hospital.exceptions import (
+    AppointmentLimitReachedError,
+    InsufficientMedicineStockError,
+)
+from hospital.models import (
+    Appointment,
+    AppointmentCounter,
+    Medicine,
+    Patient,
+    Treatment,
+    TreatmentMedicine,
+)
+from hospital.utils import local_date
+from hospital_ms.utils import export
+from hospital_ms.utils.bulk_import import import_records, importers, read_csv
+from hospital_ms.utils.renditions import process, renditions_recorded, renditions_worker
+from staffing.models import Department, Doctor, Speciality
+from users.models import CustomUser
 
-# Create your tests here.
+
+def create_doctor(appointments_limit: int = 5, username: str = "doctor") -> Doctor:
+    department, _ = Department.objects.get_or_create(name="General")
+    speciality, _ = Speciality.objects.get_or_create(
+        name="General practice",
+        department=department,
+        defaults=dict(
+            appointment_charges=100,
+            treatment_charges=200,
+            appointments_limit=appointments_limit,
+        ),
+    )
+    return Doctor.objects.create(
+        user=CustomUser.objects.create(username=username),
+        speciality=speciality,
+        salary=1000,
+    )
+
+
+def create_patient(username: str = "patient") -> Patient:
+    return Patient.objects.create(user=CustomUser.objects.create(username=username))
+
+
+def create_medicine(**kwargs) -> Medicine:
+    return Medicine.objects.create(
+        **{
+            "name": "Paracetamol",
+            "description": "Pain relief",
+            "expiry_date": dt.date(2100, 1, 1),
+            "price": 10,
+            "stock": 1000,
+            **kwargs,
+        }
+    )
+
+
+def run_concurrently(target, threads: int, calls: int) -> list:
+    """Calls `target(thread, call)` `calls` times in each of `threads` threads
+    started together. Returns what each call returned or raised."""
+    barrier = threading.Barrier(threads)
+    outcomes = []
+    lock = threading.Lock()
+
+    def work(thread: int):
+        barrier.wait()
+        try:
+            for call in range(calls):
+                try:
+                    outcome = target(thread, call)
+                except Exception as e:
+                    outcome = e
+                with lock:
+                    outcomes.append(outcome)
+        finally:
+            connection.close()
+
+    workers = [
+        threading.Thread(target=work, args=(thread,)) for thread in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return outcomes
+
+
+def appointment_time(days: int = 1) -> datetime:
+    return (timezone.now() + timedelta(days=days)).replace(
+        hour=9, minute=0, second=0, microsecond=0
+    )
+
+
+class ConcurrentBookingTest(TransactionTestCase):
+    threads = 8
+    bookings = 5
+
+    def book_concurrently(self, appointments_limit: int) -> tuple[Doctor, list]:
+        doctor = create_doctor(appointments_limit)
+        patients = [create_patient(f"patient{i}") for i in range(self.threads)]
+        when = appointment_time()
+
+        def book(thread: int, call: int):
+            return Appointment.objects.create(
+                patient=Patient.objects.get(pk=patients[thread].pk),
+                doctor=Doctor.objects.get(pk=doctor.pk),
+                appointment_datetime=when,
+                reason="Checkup",
+            )
+
+        return doctor, run_concurrently(book, self.threads, self.bookings)
+
+    def test_bookings_within_limit_all_succeed(self):
+        doctor, outcomes = self.book_concurrently(appointments_limit=1000)
+        self.assertEqual(
+            [outcome for outcome in outcomes if isinstance(outcome, Exception)], []
+        )
+        total = self.threads * self.bookings
+        self.assertEqual(Appointment.objects.count(), total)
+        self.assertEqual(AppointmentCounter.objects.get(doctor=doctor).booked, total)
+        # No lost balance updates
+        for patient in Patient.objects.select_related("user__account"):
+            self.assertEqual(
+                patient.user.account.balance, Decimal(-100 * self.bookings)
+            )
+
+    def test_bookings_never_exceed_limit(self):
+        doctor, outcomes = self.book_concurrently(appointments_limit=10)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        self.assertTrue(
+            all(isinstance(error, AppointmentLimitReachedError) for error in errors),
+            errors,
+        )
+        self.assertEqual(len(outcomes) - len(errors), 10)
+        self.assertEqual(Appointment.objects.count(), 10)
+        self.assertEqual(AppointmentCounter.objects.get(doctor=doctor).booked, 10)
+
+
+class AppointmentSlotTest(TestCase):
+    def setUp(self):
+        self.doctor = create_doctor(appointments_limit=2)
+        self.patient = create_patient()
+        self.when = appointment_time()
+        self.day = local_date(self.when)
+
+    def book(self) -> Appointment:
+        return Appointment.objects.create(
+            patient=self.patient,
+            doctor=self.doctor,
+            appointment_datetime=self.when,
+            reason="Checkup",
+        )
+
+    def booked(self) -> int:
+        return AppointmentCounter.objects.get(doctor=self.doctor, date=self.day).booked
+
+    def test_full_day_rejects_bookings(self):
+        self.book()
+        self.book()
+        with self.assertRaises(AppointmentLimitReachedError):
+            self.book()
+
+    def test_cancelling_releases_slot(self):
+        appointment = self.book()
+        self.book()
+        appointment.status = Appointment.AppointmentStatus.CANCELLED.value
+        appointment.save()
+        self.assertEqual(self.booked(), 1)
+        self.assertEqual(booked_on(self.doctor.id, self.day), 1)
+        self.book()
+        # Taking the slot back needs room for it
+        appointment.status = Appointment.AppointmentStatus.SCHEDULED.value
+        with self.assertRaises(AppointmentLimitReachedError):
+            appointment.save()
+
+    def test_bulk_delete_releases_slots(self):
+        self.book()
+        self.book()
+        Appointment.objects.all().delete()
+        self.assertEqual(self.booked(), 0)
+        self.book()
+        self.assertEqual(self.booked(), booked_on(self.doctor.id, self.day))
+
+    def balance(self) -> Decimal:
+        return Patient.objects.get(pk=self.patient.pk).user.account.balance
+
+    def test_patient_pays_for_slot_held(self):
+        appointment = self.book()
+        self.assertEqual(self.balance(), Decimal(-100))
+        appointment.status = Appointment.AppointmentStatus.CANCELLED.value
+        appointment.save()
+        self.assertEqual(self.balance(), 0)
+        appointment.status = Appointment.AppointmentStatus.SCHEDULED.value
+        appointment.save()
+        self.assertEqual((self.balance(), self.booked()), (Decimal(-100), 1))
+        appointment.delete()
+        self.assertEqual((self.balance(), self.booked()), (0, 0))
+
+    def test_cancelled_bookings_are_not_charged(self):
+        Appointment.objects.create(
+            patient=self.patient,
+            doctor=self.doctor,
+            appointment_datetime=self.when,
+            reason="Checkup",
+            status=Appointment.AppointmentStatus.CANCELLED.value,
+        ).delete()
+        self.assertEqual(self.balance(), 0)
+
+    def test_deleting_refunds_what_was_charged(self):
+        appointment = self.book()
+        # Left unsaved, the booking is still charged
+        appointment.status = Appointment.AppointmentStatus.CANCELLED.value
+        appointment.delete()
+        self.assertEqual((self.balance(), self.booked()), (0, 0))
+
+    def test_deleting_cancelled_appointment_keeps_count(self):
+        appointment = self.book()
+        self.book()
+        appointment.status = Appointment.AppointmentStatus.CANCELLED.value
+        appointment.save()
+        appointment.delete()
+        self.assertEqual(self.booked(), 1)
+
+
+class ConcurrentDispensingTest(TransactionTestCase):
+    def test_stock_is_never_oversold(self):
+        medicine = create_medicine(stock=30)
+
+        def dispense(thread: int, call: int):
+            return TreatmentMedicine.objects.create(
+                medicine=Medicine.objects.get(pk=medicine.pk),
+                quantity=1,
+                prescription="1x1",
+            )
+
+        outcomes = run_concurrently(dispense, threads=8, calls=5)
+        errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        self.assertTrue(
+            all(isinstance(error, InsufficientMedicineStockError) for error in errors),
+            errors,
+        )
+        self.assertEqual(len(errors), 10)
+        self.assertEqual(Medicine.objects.get(pk=medicine.pk).stock, 0)
+        self.assertEqual(TreatmentMedicine.objects.count(), 30)
+
+
+class DispensingTest(TestCase):
+    def setUp(self):
+        self.medicine = create_medicine(stock=10)
+
+    def stock(self, medicine: Medicine = None) -> int:
+        return Medicine.objects.get(pk=(medicine or self.medicine).pk).stock
+
+    def dispense(self, quantity: int, medicine: Medicine = None) -> TreatmentMedicine:
+        return TreatmentMedicine.objects.create(
+            medicine=medicine or self.medicine, quantity=quantity, prescription="1x1"
+        )
+
+    def test_edits_reserve_only_the_change(self):
+        treatment_medicine = self.dispense(4)
+        treatment_medicine.quantity = 6
+        treatment_medicine.save()
+        self.assertEqual(self.stock(), 4)
+        treatment_medicine.quantity = 1
+        treatment_medicine.save()
+        self.assertEqual(self.stock(), 9)
+        with self.assertRaises(InsufficientMedicineStockError):
+            treatment_medicine.quantity = 11
+            treatment_medicine.save()
+        self.assertEqual(self.stock(), 9)
+
+    def test_swapping_medicine_moves_stock(self):
+        other = create_medicine(name="Ibuprofen", stock=10)
+        treatment_medicine = self.dispense(3)
+        treatment_medicine.medicine = other
+        treatment_medicine.save()
+        self.assertEqual((self.stock(), self.stock(other)), (10, 7))
+
+    def test_deleting_returns_stock(self):
+        self.dispense(4).delete()
+        self.assertEqual(self.stock(), 10)
+
+    def test_dispensing_together_is_all_or_nothing(self):
+        other = create_medicine(name="Ibuprofen", stock=1)
+        with self.assertRaises(InsufficientMedicineStockError):
+            with transaction.atomic():
+                self.dispense(5)
+                self.dispense(2, other)
+        self.assertEqual((self.stock(), self.stock(other)), (10, 1))
+        self.assertFalse(TreatmentMedicine.objects.exists())
+
+
+class RenditionsTest(TestCase):
+    def setUp(self):
+        put = mock.patch.object(renditions_worker, "put")
+        self.put = put.start()
+        self.addCleanup(put.stop)
+
+    def create_medicine(self, **kwargs) -> Medicine:
+        with self.captureOnCommitCallbacks(execute=True):
+            return create_medicine(**kwargs)
+
+    def test_only_image_changes_are_queued(self):
+        medicine = self.create_medicine()
+        with self.captureOnCommitCallbacks(execute=True):
+            medicine.price = 15
+            medicine.save()
+        self.put.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            medicine.picture = "medicine/paracetamol.png"
+            medicine.save()
+        self.put.assert_called_once_with(Medicine, medicine.pk)
+
+    def test_new_uploads_are_queued(self):
+        medicine = self.create_medicine(picture="medicine/paracetamol.png")
+        self.put.assert_called_once_with(Medicine, medicine.pk)
+
+    def test_renditions_are_recorded_without_saving(self):
+        medicine = self.create_medicine(picture="medicine/paracetamol.png")
+        saved, recorded = mock.Mock(), mock.Mock()
+        post_save.connect(saved, sender=Medicine)
+        self.addCleanup(post_save.disconnect, saved, sender=Medicine)
+        renditions_recorded.connect(recorded, sender=Medicine)
+        self.addCleanup(renditions_recorded.disconnect, recorded, sender=Medicine)
+        self.assertTrue(process(Medicine, medicine.pk))
+        saved.assert_not_called()
+        recorded.assert_called_once()
+        medicine.refresh_from_db()
+        self.assertEqual(medicine.renditions["source"], "medicine/paracetamol.png")
+        # Nothing left to make
+        self.assertFalse(process(Medicine, medicine.pk))
+
+
+class ExportTest(TransactionTestCase):
+    dataset = export.datasets["patients"]
+    format = export.formats["csv"]
+
+    def setUp(self):
+        self.patients = [create_patient(f"patient{i}") for i in range(5)]
+        chunk_size = mock.patch.object(export, "CHUNK_SIZE", 2)
+        chunk_size.start()
+        self.addCleanup(chunk_size.stop)
+
+    def test_rows_are_paged_by_id(self):
+        with CaptureQueriesContext(connection) as context:
+            lines = list(
+                export.stream(self.dataset, self.format, export.rows(self.dataset))
+            )
+        self.assertEqual(len(lines), 1 + len(self.patients))
+        self.assertEqual(
+            [int(line.split(",")[0]) for line in lines[1:]],
+            [patient.id for patient in self.patients],
+        )
+        queries = [query["sql"] for query in context.captured_queries]
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all("LIMIT 2" in sql for sql in queries), queries)
+        self.assertTrue(all('"id" >' in sql for sql in queries[1:]), queries)
+
+    def test_async_stream_matches_stream(self):
+        async def collect() -> str:
+            chunks = export.astream(
+                self.dataset, self.format, export.rows(self.dataset)
+            )
+            return "".join([chunk async for chunk in chunks])
+
+        self.assertEqual(
+            async_to_sync(collect)(),
+            "".join(
+                export.stream(self.dataset, self.format, export.rows(self.dataset))
+            ),
+        )
+
+
+class TreatmentListTest(TransactionTestCase):
+    treatments = 60
+
+    def setUp(self):
+        from api import app
+
+        self.client = TestClient(app)
+        patient = create_patient()
+        patient.user.token = generate_token()
+        patient.user.save()
+        self.headers = {"Authorization": f"Bearer {patient.user.token}"}
+        medicine = create_medicine(price=10)
+        for i in range(self.treatments):
+            treatment = Treatment.objects.create(
+                patient=patient, diagnosis="Flu", details="Rest"
+            )
+            treatment.medicines.add(
+                TreatmentMedicine.objects.create(
+                    medicine=medicine, quantity=i % 3 + 1, prescription="1x1"
+                )
+            )
+        # Leaves the token cached
+        self.list(limit=1)
+
+    def list(self, **params):
+        response = self.client.get(
+            "/api/v1/treatments", params=params, headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_pages_cost_one_query_whatever_their_size(self):
+        for limit in (5, 55, 100):
+            with self.subTest(limit=limit):
+                response = self.list(limit=limit)
+                self.assertEqual(len(response.json()), min(limit, self.treatments))
+                self.assertEqual(queries(response), 1)
+        cursor = self.list(limit=5).headers[next_cursor_header]
+        self.assertEqual(queries(self.list(limit=5, cursor=cursor)), 1)
+
+    def test_bills_are_listed(self):
+        self.assertEqual(
+            {row["id"]: row["total_bill"] for row in self.list().json()},
+            {
+                treatment.id: float(treatment.bill.total)
+                for treatment in Treatment.objects.all()
+            },
+        )
+
+
+@skipUnless(connection.vendor == "sqlite", "Plans of other databases vary")
+class QueryPlanTest(TestCase):
+    def test_hot_queries_use_their_indexes(self):
+        for description, queryset, index in hot_queries():
+            with self.subTest(description):
+                plan = queryset.explain()
+                self.assertIn(index, plan)
+                self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", plan)
+
+    def test_check_query_plans_passes(self):
+        stdout = StringIO()
+        call_command("check_query_plans", stdout=stdout)
+        self.assertIn("Query plans checked", stdout.getvalue())
+
+
+class AdminTestCase(TestCase):
+    """Signed in to the admin site as a superuser"""
+
+    def setUp(self):
+        admin = CustomUser.objects.create(
+            username="admin", is_staff=True, is_superuser=True
+        )
+        self.client.force_login(admin)
+
+    def assert_changelist_queries_bounded(
+        self, model: type, add_row, few: int = 2, many: int = 30
+    ):
+        """Asserts that the changelist of `model` takes as many queries with
+        `many` rows as with `few`. `add_row(i)` adds the i-th row."""
+        meta = model._meta
+        url = reverse(f"admin:{meta.app_label}_{meta.model_name}_changelist")
+        for i in range(few):
+            add_row(i)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        for i in range(few, many):
+            add_row(i)
+        with self.assertNumQueries(len(context)):
+            response = self.client.get(url)
+        self.assertEqual(response.context["cl"].result_count, many)
+
+
+class HospitalAdminTest(AdminTestCase):
+    def test_patient_changelist(self):
+        def add_patient(i: int):
+            Treatment.objects.create(
+                patient=create_patient(f"patient{i}"), diagnosis="Flu", details="Rest"
+            )
+
+        self.assert_changelist_queries_bounded(Patient, add_patient)
+
+    def test_treatment_changelist(self):
+        patient = create_patient()
+        doctor = create_doctor()
+
+        def add_treatment(i: int):
+            Treatment.objects.create(
+                patient=patient, diagnosis="Flu", details="Rest"
+            ).doctors.add(doctor)
+
+        self.assert_changelist_queries_bounded(Treatment, add_treatment)
+
+
+class BulkImportTest(TestCase):
+    def import_csv(self, dataset: str, text: str):
+        return import_records(importers[dataset], read_csv(StringIO(text)))
+
+    def test_patients_are_created_with_accounts(self):
+        report = self.import_csv("patients", "username,gender\nalice,F\nbob,\n")
+        self.assertEqual((report.created, report.errors), (2, []))
+        patients = Patient.objects.select_related("user__account").order_by("id")
+        self.assertEqual(
+            [patient.user.username for patient in patients], ["alice", "bob"]
+        )
+        self.assertEqual(
+            len({patient.user.account.pk for patient in patients}), len(patients)
+        )
+
+    def test_taken_usernames_are_skipped(self):
+        create_patient("alice")
+        report = self.import_csv("patients", "username\nalice\nbob\nbob\n")
+        self.assertEqual((report.created, report.skipped), (1, 2))
+        self.assertEqual(
+            sorted(Patient.objects.values_list("user__username", flat=True)),
+            ["alice", "bob"],
+        )
+
+    def test_medicines_are_upserted_by_name(self):
+        create_medicine(name="Paracetamol", price=10, stock=5)
+        report = self.import_csv(
+            "medicines",
+            "name,description,expiry_date,price,stock\n"
+            "Paracetamol,Pain relief,2100-01-01,12,50\n"
+            "Ibuprofen,Pain relief,2100-01-01,20,30\n",
+        )
+        self.assertEqual((report.created, report.updated), (1, 1))
+        self.assertEqual(
+            dict(Medicine.objects.values_list("name", "price")),
+            {"Paracetamol": Decimal(12), "Ibuprofen": Decimal(20)},
+        )
+        self.assertEqual(Medicine.objects.get(name="Paracetamol").stock, 50)
+
+    def test_taken_short_names_are_invalid(self):
+        create_medicine(name="Paracetamol", short_name="PCM")
+        report = self.import_csv(
+            "medicines",
+            "name,short_name,description,expiry_date,price,stock\n"
+            "Ibuprofen,PCM,Pain relief,2100-01-01,20,30\n"
+            "Aspirin,ASP,Pain relief,2100-01-01,5,30\n"
+            "Diclofenac,ASP,Pain relief,2100-01-01,5,30\n",
+        )
+        self.assertEqual((report.created, len(report.errors)), (1, 2))
+        self.assertEqual(
+            sorted(Medicine.objects.values_list("name", flat=True)),
+            ["Aspirin", "Paracetamol"],
+        )
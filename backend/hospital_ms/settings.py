@@ -104,6 +104,35 @@ DATABASES = {
         "PASSWORD": os.getenv("DATABASE_PASSWORD", "development"),
         "HOST": os.getenv("DATABASE_HOST", "localhost"),
         "PORT": os.getenv("DATABASE_PORT", "3306"),
+        # Seconds connections are kept open for reuse, 0 closes them after
+        # each request. Worth raising for the api, whose threadpool workers
+        # would otherwise reconnect for every request.
+        "CONN_MAX_AGE": int(os.getenv("DATABASE_CONN_MAX_AGE", 0)),
+        "CONN_HEALTH_CHECKS": True,
+    }
+}
+
+if DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+    # Transactions take the write lock as they begin and so wait for other
+    # writers, rather than failing when they go on to write after reading
+    DATABASES["default"]["OPTIONS"] = {"transaction_mode": "IMMEDIATE"}
+    # Concurrency tests need the connections of their threads to share it,
+    # which an in-memory database does not allow
+    DATABASES["default"]["TEST"] = {"NAME": BASE_DIR / "test_db.sqlite3"}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/ref/settings/#caches
+
+CACHES = {
+    "default": {
+        # Running several api processes needs one they share e.g
+        # django.core.cache.backends.redis.RedisCache, it carries the
+        # invalidations of their in-memory caches
+        "BACKEND": os.getenv(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
     }
 }
 
@@ -165,6 +194,40 @@ FRONTEND_DIR = (
 
 SITE_NAME = os.getenv("SITE_NAME", "Hospital MS")
 
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", 3600))
+"""Seconds browsers may reuse static and media files that are not fingerprinted"""
+
+THUMBNAIL_ROOT = Path(os.getenv("THUMBNAIL_ROOT", files_root / "thumbnails"))
+"""Where generated image thumbnails are cached"""
+
+THUMBNAIL_SIZES = tuple(
+    int(size)
+    for size in os.getenv("THUMBNAIL_SIZES", "160,320,480,640,960,1280").split(",")
+)
+"""Widths and heights thumbnails may be requested in"""
+
+SRCSET_WIDTHS = tuple(
+    int(width) for width in os.getenv("SRCSET_WIDTHS", "320,640,960").split(",")
+)
+"""Widths of the thumbnails listed in api images `srcset`"""
+
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+"""JPEG and WebP quality of thumbnails"""
+
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+"""Processes generating thumbnails"""
+
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1920))
+"""Uploaded images are scaled down to fit this many pixels a side"""
+
+IMMUTABLE_ASSETS_PATTERN = os.getenv(
+    "IMMUTABLE_ASSETS_PATTERN",
+    r"(^|/)assets/.+-[\w-]{8}\.\w+$|\.[0-9a-f]{12}\.\w+$|^renditions/",
+)
+"""Paths of fingerprinted files i.e Vite's `assets/name-hash.ext`, Django's
+`name.hash.ext` and image renditions. They are cached by browsers for a
+year."""
+
 JAZZMIN_SETTINGS = {
     "show_ui_builder": True,
     "site_title": SITE_NAME,
@@ -200,6 +263,7 @@ JAZZMIN_SETTINGS = {
         "finance.UserAccount": "fas fa-wallet",
         "finance.ExtraFee": "fas fa-dollar-sign",
         "finance.Account": "fas fa-file-invoice-dollar",
+        "finance.LedgerEntry": "fas fa-book",
         "staffing.WorkingDay": "fas fa-calendar-day",
         "staffing.Department": "fas fa-building",
         "staffing.Speciality": "fas fa-stethoscope",
@@ -261,3 +325,117 @@ MPESA_PASSWORD = os.getenv("MPESA_PASSWORD", "")
 """Just for simulation"""
 
 MPESA_TIMESTAMP = os.getenv("MPESA_TIMESTAMP", "")
+
+MPESA_URL = os.getenv(
+    "MPESA_URL",
+    "https://developer.safaricom.co.ke/api/v1/APIs/API/Simulate/MpesaExpressSimulate/",
+)
+"""STK push endpoint"""
+
+MPESA_SHORTCODE = os.getenv("MPESA_SHORTCODE", "174379")
+"""Paybill number payments are made to"""
+
+MPESA_CALLBACK_URL = os.getenv(
+    "MPESA_CALLBACK_URL", "https://mydomain.com/api/v1/mpesa/callback"
+)
+"""Public url of the `/v1/mpesa/callback` endpoint"""
+
+MPESA_TIMEOUT = float(os.getenv("MPESA_TIMEOUT", 15))
+"""Seconds to wait for M-PESA to respond to a push"""
+
+MPESA_MAX_CONNECTIONS = int(os.getenv("MPESA_MAX_CONNECTIONS", 10))
+"""Pooled connections to M-PESA and pushes sent at a time"""
+
+MPESA_PUSH_MAX_ATTEMPTS = int(os.getenv("MPESA_PUSH_MAX_ATTEMPTS", 5))
+"""Times a push is attempted before it is failed"""
+
+MPESA_PUSH_BACKOFF = float(os.getenv("MPESA_PUSH_BACKOFF", 2))
+"""Seconds before the first retry of a push, doubled for every other one"""
+
+MPESA_PUSH_INTERVAL = float(os.getenv("MPESA_PUSH_INTERVAL", 1))
+"""Seconds between checks for due pushes"""
+
+MPESA_PUSH_LEASE = float(os.getenv("MPESA_PUSH_LEASE", 60))
+"""Seconds a worker holds a push it is sending before others may retry it"""
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+"""Maximum api tokens resolved in memory"""
+
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 300))
+"""Seconds a resolved api token stays cached"""
+
+TOKEN_CACHE_ALIAS = os.getenv("TOKEN_CACHE_ALIAS", "default")
+"""Django cache alias keeping the versions that invalidate cached api tokens"""
+
+AVAILABILITY_INDEX_TTL = float(os.getenv("AVAILABILITY_INDEX_TTL", 600))
+"""Seconds before the doctors availability index is fully rebuilt"""
+
+AVAILABILITY_INDEX_ALIAS = os.getenv("AVAILABILITY_INDEX_ALIAS", "default")
+"""Django cache alias through which processes are told to rebuild the doctors
+availability index"""
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "locmem")
+"""Public api responses cache backend - `locmem` or `django`"""
+
+RESPONSE_CACHE_ALIAS = os.getenv("RESPONSE_CACHE_ALIAS", "default")
+"""Django cache alias keeping response versions, and the responses themselves
+with the `django` backend"""
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+"""Maximum public api responses kept by the `locmem` backend"""
+
+NEWS_VIEWS_FLUSH_INTERVAL = float(os.getenv("NEWS_VIEWS_FLUSH_INTERVAL", 10))
+"""Seconds between writes of buffered news views"""
+
+REQUEST_QUERIES_THRESHOLD = int(os.getenv("REQUEST_QUERIES_THRESHOLD", 20))
+"""Api requests making more database queries than this are logged as warnings,
+usually a sign of N+1 queries"""
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+"""Report queries, database and serialization time of api requests in
+`Server-Timing` headers"""
+
+SITE_URL = os.getenv("SITE_URL", "http://localhost:8000")
+"""Public url of the site, used in links sent out"""
+
+EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
+
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", 587))
+
+EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
+
+EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
+
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "1") == "1"
+
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", 30))
+
+EMAIL_BACKEND = os.getenv(
+    "EMAIL_BACKEND",
+    (
+        "django.core.mail.backends.smtp.EmailBackend"
+        if EMAIL_HOST_PASSWORD is not None
+        else "django.core.mail.backends.dummy.EmailBackend"
+    ),
+)
+"""Emails are discarded unless an smtp password is set"""
+
+DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", EMAIL_HOST_USER or SITE_NAME)
+
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 100))
+"""Emails sent over one connection of the email backend"""
+
+EMAIL_RATE_LIMIT = float(os.getenv("EMAIL_RATE_LIMIT", 10))
+"""Maximum emails sent a second by a process, 0 for no limit"""
+
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", 5))
+"""Times delivery of an email is attempted before it is failed"""
+
+EMAIL_BACKOFF = float(os.getenv("EMAIL_BACKOFF", 60))
+"""Seconds before an email is first retried, doubled for every other retry"""
+
+EMAIL_LEASE = float(os.getenv("EMAIL_LEASE", 600))
+"""Seconds a worker holds emails it is sending before others may retry them"""
+
+EMAIL_DISPATCH_INTERVAL = float(os.getenv("EMAIL_DISPATCH_INTERVAL", 5))
+"""Seconds between checks for due emails"""
@@ -0,0 +1,367 @@
+"""Bulk imports of medicines, doctors and patients
+
+Rows are read from CSV or NDJSON, validated with pydantic and written a chunk
+at a time, each chunk in its own transaction. Users are created together with
+their finance accounts using `bulk_create`, bypassing `CustomUser.save` which
+would otherwise create the account one row at a time.
+"""
+
+import csv
+import json
+import time
+from datetime import date
+from decimal import Decimal
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional, TextIO
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, connection, transaction
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+from finance.models import UserAccount
+from users.models import CustomUser
+from hospital.models import Medicine, Patient, Treatment
+from staffing.models import Doctor, Speciality, WorkingDay
+from staffing.availability import availability_index
+from hospital.signals import recompute_queue
+
+CHUNK_SIZE = 1000
+"""Rows written per transaction"""
+
+
+class Row(BaseModel):
+    @model_validator(mode="before")
+    @classmethod
+    def drop_blanks(cls, values: Any) -> Any:
+        # Empty CSV cells stand for missing values
+        if isinstance(values, dict):
+            return {key: value for key, value in values.items() if value != ""}
+        return values
+
+
+class MedicineRow(Row):
+    name: str = Field(max_length=255)
+    short_name: Optional[str] = Field(None, max_length=20)
+    category: Medicine.MedicineCategory = Medicine.MedicineCategory.OTHER
+    description: str
+    expiry_date: date
+    price: Decimal = Field(ge=0, max_digits=10, decimal_places=2)
+    stock: int = Field(ge=0)
+
+
+class UserRow(Row):
+    username: str = Field(max_length=150)
+    first_name: str = Field("", max_length=150)
+    last_name: str = Field("", max_length=150)
+    email: str = ""
+    phone_number: Optional[str] = Field(None, pattern=r"^\+?1?\d{9,15}$")
+    gender: CustomUser.UserGender = CustomUser.UserGender.OTHER
+    date_of_birth: Optional[date] = None
+    location: Optional[str] = Field(None, max_length=50)
+    password: Optional[str] = None
+
+    @field_validator("first_name", "last_name", "email", mode="before")
+    @classmethod
+    def none_to_blank(cls, value):
+        return "" if value is None else value
+
+
+class PatientRow(UserRow):
+    pass
+
+
+class DoctorRow(UserRow):
+    speciality: Optional[str] = None
+    working_days: list[str] = []
+    shift: Doctor.WorkShift = Doctor.WorkShift.DAY
+    salary: Decimal = Field(ge=0, max_digits=8, decimal_places=2)
+
+    @field_validator("working_days", mode="before")
+    @classmethod
+    def split_working_days(cls, value):
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [name.strip() for name in value.split(",") if name.strip()]
+        return value
+
+
+class ImportReport:
+    """Outcome of an import"""
+
+    def __init__(self, dataset: str):
+        self.dataset = dataset
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors: list[str] = []
+        """Why rows were not imported"""
+        self._started = time.perf_counter()
+        self.seconds = 0.0
+
+    @property
+    def rows(self) -> int:
+        return self.created + self.updated + self.skipped + len(self.errors)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._started
+
+    def __str__(self):
+        return (
+            f"{self.dataset}: {self.created} created, {self.updated} updated, "
+            f"{self.skipped} skipped, {len(self.errors)} invalid in "
+            f"{self.seconds:.2f}s ({self.rows_per_second:.0f} rows/sec)"
+        )
+
+
+def read_csv(file: TextIO) -> Iterator[dict]:
+    return iter(csv.DictReader(file))
+
+
+def read_ndjson(file: TextIO) -> Iterator[dict]:
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+readers: dict[str, Callable[[TextIO], Iterator[dict]]] = {
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+}
+"""Row readers by format name"""
+
+
+def validate(
+    schema: type[Row], records: Iterable[dict], report: ImportReport
+) -> Iterator[Row]:
+    """Valid rows of `records`. Invalid ones are recorded in `report`"""
+    for line, record in enumerate(records, start=1):
+        try:
+            yield schema.model_validate(record)
+        except ValidationError as e:
+            report.errors.append(
+                f"Row {line}: "
+                + "; ".join(
+                    f"{'.'.join(map(str, error['loc']))} {error['msg']}"
+                    for error in e.errors()
+                )
+            )
+
+
+def create_accounts(count: int) -> list[UserAccount]:
+    if connection.features.can_return_rows_from_bulk_insert:
+        return UserAccount.objects.bulk_create(UserAccount() for _ in range(count))
+    # Primary keys are needed to link users to their accounts
+    return [UserAccount.objects.create() for _ in range(count)]
+
+
+def create_users(
+    rows: list[UserRow], role: CustomUser.UserRole, report: ImportReport
+) -> list[tuple[UserRow, CustomUser]]:
+    """Creates users of `rows` whose username is not taken, with their accounts"""
+    taken = set(
+        CustomUser.objects.filter(
+            username__in=[row.username for row in rows]
+        ).values_list("username", flat=True)
+    )
+    new_rows = []
+    for row in rows:
+        if row.username in taken:
+            report.skipped += 1
+        else:
+            taken.add(row.username)
+            new_rows.append(row)
+    accounts = create_accounts(len(new_rows))
+    users = CustomUser.objects.bulk_create(
+        CustomUser(
+            username=row.username,
+            first_name=row.first_name,
+            last_name=row.last_name,
+            email=row.email,
+            phone_number=row.phone_number,
+            gender=row.gender.value,
+            location=row.location,
+            role=role.value,
+            # Hashing is deliberately slow, rows without one cannot log in
+            password=make_password(row.password),
+            account=account,
+            **({"date_of_birth": row.date_of_birth} if row.date_of_birth else {}),
+        )
+        for row, account in zip(new_rows, accounts)
+    )
+    if not connection.features.can_return_rows_from_bulk_insert:
+        ids = dict(
+            CustomUser.objects.filter(
+                username__in=[user.username for user in users]
+            ).values_list("username", "id")
+        )
+        for user in users:
+            user.pk = ids[user.username]
+    return list(zip(new_rows, users))
+
+
+def import_medicines(rows: list[MedicineRow], report: ImportReport):
+    """Upserts medicines by name"""
+    # A row cannot be upserted twice in one statement, the last one wins
+    unique_rows = list({row.name: row for row in rows}.values())
+    report.skipped += len(rows) - len(unique_rows)
+    rows = unique_rows
+    prices = dict(
+        Medicine.objects.filter(name__in=[row.name for row in rows]).values_list(
+            "name", "price"
+        )
+    )
+    # Short names are unique too, rows taking that of another medicine are
+    # invalid rather than failing the whole chunk
+    owners = dict(
+        Medicine.objects.filter(
+            short_name__in=[row.short_name for row in rows if row.short_name]
+        ).values_list("short_name", "name")
+    )
+    valid_rows = []
+    for row in rows:
+        if row.short_name and owners.setdefault(row.short_name, row.name) != row.name:
+            report.errors.append(
+                f"{row.name}: short_name {row.short_name} is taken by "
+                f"{owners[row.short_name]}"
+            )
+        else:
+            valid_rows.append(row)
+    fields = list(MedicineRow.model_fields)
+    options = dict(
+        update_conflicts=True,
+        update_fields=[field for field in fields if field != "name"],
+    )
+    if connection.features.supports_update_conflicts_with_target:
+        options["unique_fields"] = ["name"]
+
+    def upsert(rows: list[MedicineRow]):
+        with transaction.atomic():
+            Medicine.objects.bulk_create(
+                [
+                    Medicine(**{**row.model_dump(), "category": row.category.value})
+                    for row in rows
+                ],
+                **options,
+            )
+
+    rows = valid_rows
+    try:
+        upsert(rows)
+    except IntegrityError:
+        # e.g short names swapped between medicines, retried a row at a time
+        rows = []
+        for row in valid_rows:
+            try:
+                upsert([row])
+            except IntegrityError as e:
+                report.errors.append(f"{row.name}: {e}")
+            else:
+                rows.append(row)
+    updated = sum(row.name in prices for row in rows)
+    report.updated += updated
+    report.created += len(rows) - updated
+    # bulk_create skips the signals refreshing bills of repriced medicines
+    repriced = [
+        row.name
+        for row in rows
+        if row.name in prices and prices[row.name] != row.price
+    ]
+    if repriced:
+        recompute_queue.put(
+            Treatment.objects.filter(medicines__medicine__name__in=repriced)
+            .values_list("id", flat=True)
+            .distinct()
+        )
+
+
+def import_patients(rows: list[PatientRow], report: ImportReport):
+    users = create_users(rows, CustomUser.UserRole.PATIENT, report)
+    Patient.objects.bulk_create(Patient(user=user) for row, user in users)
+    report.created += len(users)
+
+
+def import_doctors(rows: list[DoctorRow], report: ImportReport):
+    specialities = dict(
+        Speciality.objects.filter(
+            name__in={row.speciality for row in rows if row.speciality}
+        ).values_list("name", "id")
+    )
+    working_days = dict(WorkingDay.objects.values_list("name", "id"))
+    valid_rows = []
+    for row in rows:
+        unknown = [name for name in row.working_days if name not in working_days]
+        if row.speciality and row.speciality not in specialities:
+            unknown.append(row.speciality)
+        if unknown:
+            report.errors.append(f"{row.username}: unknown {', '.join(unknown)}")
+        else:
+            valid_rows.append(row)
+    users = create_users(valid_rows, CustomUser.UserRole.DOCTOR, report)
+    doctors = Doctor.objects.bulk_create(
+        Doctor(
+            user=user,
+            speciality_id=specialities.get(row.speciality),
+            shift=row.shift.value,
+            salary=row.salary,
+        )
+        for row, user in users
+    )
+    if not connection.features.can_return_rows_from_bulk_insert:
+        doctors = list(Doctor.objects.filter(user__in=[user for row, user in users]))
+    Doctor.working_days.through.objects.bulk_create(
+        Doctor.working_days.through(
+            doctor_id=doctor.pk, workingday_id=working_days[name]
+        )
+        for (row, user), doctor in zip(users, doctors)
+        for name in row.working_days
+    )
+    report.created += len(users)
+    # bulk_create skips the signals keeping the availability index current
+    doctor_ids = [doctor.pk for doctor in doctors]
+    transaction.on_commit(lambda: availability_index.refresh_doctors(doctor_ids))
+
+
+class Importer(NamedTuple):
+    name: str
+    schema: type[Row]
+    load: Callable[[list, ImportReport], None]
+
+
+importers: dict[str, Importer] = {
+    importer.name: importer
+    for importer in (
+        Importer("medicines", MedicineRow, import_medicines),
+        Importer("doctors", DoctorRow, import_doctors),
+        Importer("patients", PatientRow, import_patients),
+    )
+}
+"""Importable datasets by name"""
+
+
+def import_records(
+    importer: Importer,
+    records: Iterable[dict],
+    chunk_size: int = CHUNK_SIZE,
+    progress: Callable[[ImportReport], None] = None,
+) -> ImportReport:
+    """Validates and imports `records`, a transaction per chunk.
+
+    Args:
+        importer (Importer): Dataset imported.
+        records (Iterable[dict]): Raw rows e.g from `readers`.
+        chunk_size (int, optional): Rows per transaction. Defaults to CHUNK_SIZE.
+        progress (Callable, optional): Called with the report after every chunk.
+    """
+    report = ImportReport(importer.name)
+    rows = validate(importer.schema, records, report)
+    while chunk := list(islice(rows, chunk_size)):
+        with transaction.atomic():
+            importer.load(chunk, report)
+        if progress:
+            report.finish()
+            progress(report)
+    report.finish()
+    return report
@@ -0,0 +1,108 @@
+"""Precompressed variants of static assets
+
+`compress_directory` writes `.gz` (and `.br` when the optional `brotli`
+package is installed) siblings of compressible files so that they can be
+served as is by `api.static.PrecompressedStaticFiles`.
+"""
+
+import os
+import gzip
+from pathlib import Path
+from typing import Callable, Iterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compressible_extensions = {
+    ".css",
+    ".html",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".webmanifest",
+    ".xml",
+    ".ico",
+    ".ttf",
+    ".otf",
+    ".eot",
+}
+"""Extensions of files worth compressing. Images and fonts such as woff2 are
+compressed already."""
+
+MIN_SIZE = 512
+"""Files smaller than this in bytes gain little from compression"""
+
+encoders: dict[str, Callable[[bytes], bytes]] = {
+    ".gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+}
+"""Compressor of each variant extension"""
+
+if brotli is not None:
+    encoders[".br"] = lambda data: brotli.compress(data, quality=11)
+
+
+def is_compressible(path: Path) -> bool:
+    return path.suffix.lower() in compressible_extensions
+
+
+def is_fresh(variant: Path, source_stat: os.stat_result) -> bool:
+    """Whether `variant` was compressed from the current version of its source"""
+    try:
+        return variant.stat().st_mtime >= source_stat.st_mtime
+    except OSError:
+        return False
+
+
+def compress_file(path: Path, force: bool = False) -> int:
+    """Writes the compressed variants of `path`. Returns bytes saved.
+
+    A variant is only kept if it is smaller than the file itself.
+    """
+    source_stat = path.stat()
+    if source_stat.st_size < MIN_SIZE or not is_compressible(path):
+        return 0
+    data = None
+    saved = 0
+    for extension, encode in encoders.items():
+        variant = path.with_name(path.name + extension)
+        if not force and is_fresh(variant, source_stat):
+            continue
+        if data is None:
+            data = path.read_bytes()
+        compressed = encode(data)
+        if len(compressed) >= len(data):
+            variant.unlink(missing_ok=True)
+            continue
+        temporary = variant.with_name(variant.name + ".tmp")
+        temporary.write_bytes(compressed)
+        # Same mtime as the source, see `is_fresh`
+        os.utime(temporary, (source_stat.st_atime, source_stat.st_mtime))
+        temporary.replace(variant)
+        saved += len(data) - len(compressed)
+    return saved
+
+
+def walk(root: Path) -> Iterator[Path]:
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(directory) / filename
+            if path.suffix not in encoders:
+                yield path
+
+
+def compress_directory(root: Path, force: bool = False) -> tuple[int, int]:
+    """Compresses every file under `root`. Returns files compressed and
+    bytes saved."""
+    files = 0
+    saved = 0
+    for path in walk(root):
+        file_saved = compress_file(path, force)
+        if file_saved:
+            files += 1
+            saved += file_saved
+    return files, saved
@@ -0,0 +1,234 @@
+"""Streaming exports of large datasets
+
+Rows are read a page at a time with keyset queries, `id > last_id ORDER BY id
+LIMIT n`, and encoded one at a time so that memory use does not grow with the
+size of the export. Unlike a server side cursor this holds on every database,
+the MySQL driver buffers whole result sets. The same datasets are served by
+admin actions and the staff api route.
+"""
+
+import io
+import csv
+import json
+import asyncio
+from itertools import islice
+from datetime import date
+from typing import Callable, Iterable, Iterator, AsyncIterator, NamedTuple
+from django.db import close_old_connections
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from hospital.models import Treatment, Appointment, Patient
+from hospital.utils import local_day_range
+from finance.models import Payment
+
+CHUNK_SIZE = 2000
+"""Rows fetched from the database at a time"""
+
+ID_COLUMN = "id"
+"""Column every dataset is paged by"""
+
+
+class Dataset(NamedTuple):
+    name: str
+    queryset: Callable[[], QuerySet]
+    columns: dict[str, str]
+    """Exported column name mapped to the field lookup it is read from, with
+    `ID_COLUMN` among them"""
+
+
+datasets: dict[str, Dataset] = {
+    dataset.name: dataset
+    for dataset in (
+        Dataset(
+            "treatments",
+            lambda: Treatment.objects.all(),
+            {
+                "id": "id",
+                "patient": "patient__user__username",
+                "patient_type": "patient_type",
+                "diagnosis": "diagnosis",
+                "treatment_status": "treatment_status",
+                "medicine_total": "medicine_total",
+                "treatment_total": "treatment_total",
+                "extra_fees_total": "extra_fees_total",
+                "grand_total": "grand_total",
+                "bill_settled": "bill_settled",
+                "created_at": "created_at",
+                "updated_at": "updated_at",
+            },
+        ),
+        Dataset(
+            "appointments",
+            lambda: Appointment.objects.all(),
+            {
+                "id": "id",
+                "patient": "patient__user__username",
+                "doctor": "doctor__user__username",
+                "appointment_datetime": "appointment_datetime",
+                "status": "status",
+                "reason": "reason",
+                "created_at": "created_at",
+                "updated_at": "updated_at",
+            },
+        ),
+        Dataset(
+            "payments",
+            lambda: Payment.objects.all(),
+            {
+                "id": "id",
+                "user": "user__username",
+                "amount": "amount",
+                "method": "method",
+                "reference": "reference",
+                "created_at": "created_at",
+            },
+        ),
+        Dataset(
+            "patients",
+            lambda: Patient.objects.all(),
+            {
+                "id": "id",
+                "username": "user__username",
+                "first_name": "user__first_name",
+                "last_name": "user__last_name",
+                "email": "user__email",
+                "phone_number": "user__phone_number",
+                "balance": "user__account__balance",
+                "created_at": "created_at",
+            },
+        ),
+    )
+}
+"""Exportable datasets by name"""
+
+
+class Format(NamedTuple):
+    extension: str
+    content_type: str
+    header: Callable[[list[str]], str]
+    row: Callable[[list[str], tuple], str]
+
+
+def _csv_line(values: Iterable) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+
+formats: dict[str, Format] = {
+    "csv": Format(
+        "csv",
+        "text/csv",
+        header=_csv_line,
+        row=lambda columns, values: _csv_line(values),
+    ),
+    "ndjson": Format(
+        "ndjson",
+        "application/x-ndjson",
+        header=lambda columns: "",
+        row=lambda columns, values: json.dumps(dict(zip(columns, values)), default=str)
+        + "\n",
+    ),
+}
+"""Export formats by name"""
+
+
+def rows(
+    dataset: Dataset,
+    queryset: QuerySet = None,
+    since: date = None,
+    until: date = None,
+) -> QuerySet:
+    """Values of `dataset` columns ordered by id.
+
+    Args:
+        dataset (Dataset): Dataset exported.
+        queryset (QuerySet, optional): Rows to export. Defaults to the whole dataset.
+        since (date, optional): Rows created on or after this date.
+        until (date, optional): Rows created on or before this date.
+    """
+    values = dataset.queryset()
+    if queryset is not None:
+        # Selected rows, without the annotations their admin may add
+        values = values.filter(pk__in=queryset.order_by().values("pk"))
+    if since:
+        values = values.filter(created_at__gte=local_day_range(since, since)[0])
+    if until:
+        values = values.filter(created_at__lt=local_day_range(until, until)[1])
+    return values.order_by("id").values_list(*dataset.columns.values())
+
+
+def pages(dataset: Dataset, values: QuerySet) -> Iterator[list[tuple]]:
+    """`rows` of the dataset, `CHUNK_SIZE` at a time, each page a query of
+    its own starting after the last id of the page before"""
+    position = list(dataset.columns.values()).index(ID_COLUMN)
+    page = list(values[:CHUNK_SIZE])
+    while page:
+        yield page
+        if len(page) < CHUNK_SIZE:
+            return
+        page = list(values.filter(id__gt=page[-1][position])[:CHUNK_SIZE])
+
+
+def stream(dataset: Dataset, format: Format, values: QuerySet) -> Iterator[str]:
+    columns = list(dataset.columns)
+    yield format.header(columns)
+    for page in pages(dataset, values):
+        for row in page:
+            yield format.row(columns, row)
+
+
+async def astream(
+    dataset: Dataset, format: Format, values: QuerySet
+) -> AsyncIterator[str]:
+    """`stream` for async consumers, a chunk of rows at a time.
+
+    No cursor is held between pages, so each chunk is read and encoded in a
+    thread of the default executor, not on the one thread the async ORM
+    shares. Connections past `CONN_MAX_AGE` are closed as around requests.
+    """
+    lines = stream(dataset, format, values)
+
+    def next_chunk() -> str:
+        close_old_connections()
+        try:
+            return "".join(islice(lines, CHUNK_SIZE))
+        finally:
+            close_old_connections()
+
+    while chunk := await asyncio.to_thread(next_chunk):
+        yield chunk
+
+
+def filename(dataset: Dataset, format: Format) -> str:
+    return f"{dataset.name}-{timezone.localdate():%Y-%m-%d}.{format.extension}"
+
+
+def export_response(
+    dataset: Dataset, format: Format, queryset: QuerySet = None, **filters
+) -> StreamingHttpResponse:
+    """Django response streaming the dataset"""
+    return StreamingHttpResponse(
+        stream(dataset, format, rows(dataset, queryset, **filters)),
+        content_type=format.content_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename(dataset, format)}"'
+        },
+    )
+
+
+def export_actions(dataset_name: str) -> list[Callable]:
+    """Admin actions exporting the selected rows of a dataset"""
+    dataset = datasets[dataset_name]
+    actions = []
+    for format in formats.values():
+
+        def export(modeladmin, request, queryset, format=format):
+            return export_response(dataset, format, queryset)
+
+        export.__name__ = f"export_as_{format.extension}"
+        export.short_description = _("Export selected as ") + format.extension.upper()
+        actions.append(export)
+    return actions
@@ -0,0 +1,212 @@
+"""Resized variants of uploaded images
+
+Thumbnails are generated by `make_thumbnail` and cached on disk under
+`THUMBNAIL_ROOT`, named after the hash of the source image's content and the
+size requested so that a changed upload never serves a stale thumbnail.
+
+Renditions are made ahead of time of uploaded images, see
+`hospital_ms.utils.renditions`, and served as media files.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from PIL import Image, ImageOps
+from hospital_ms.settings import (
+    MEDIA_URL,
+    MEDIA_ROOT,
+    THUMBNAIL_ROOT,
+    THUMBNAIL_SIZES,
+    THUMBNAIL_QUALITY,
+    SRCSET_WIDTHS,
+    IMAGE_MAX_DIMENSION,
+)
+
+image_extensions = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
+"""Extensions of media files thumbnails can be made of"""
+
+formats = {"webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg"), "png": ("PNG", ".png")}
+"""Pillow format and extension of each thumbnail format"""
+
+thumbnail_prefix = f"{MEDIA_URL}thumb/"
+
+renditions_root = MEDIA_ROOT / "renditions"
+
+ORIGINAL_QUALITY = 90
+"""JPEG quality of uploads rewritten by `normalize_original`"""
+
+
+def thumbnail_url(url: str, width: int, height: int = 0) -> str:
+    """Url of the `width`x`height` thumbnail of the media file at `url`"""
+    return f"{thumbnail_prefix}{width}x{height}/{url.removeprefix(MEDIA_URL)}"
+
+
+def srcset(url: str | None, renditions: dict | None = None) -> str | None:
+    """`srcset` of the media image at `url` in `SRCSET_WIDTHS` widths.
+
+    The `renditions` recorded of the image are used if they are of it, else
+    the thumbnails are generated on request.
+    """
+    name = url.removeprefix(MEDIA_URL) if url else None
+    if renditions and renditions.get("source") == name:
+        widths = renditions.get("webp")
+        if not widths:
+            return None
+        return ", ".join(
+            f"{MEDIA_URL}{widths[width]} {width}w"
+            for width in sorted(widths, key=int)
+        )
+    if (
+        not url
+        or not url.startswith(MEDIA_URL)
+        or Path(url).suffix.lower() not in image_extensions
+    ):
+        return None
+    return ", ".join(
+        f"{thumbnail_url(url, width)} {width}w" for width in SRCSET_WIDTHS
+    )
+
+
+def is_allowed_size(width: int, height: int) -> bool:
+    """Sizes are limited so that the cache cannot be filled with arbitrary
+    ones. 0 leaves a dimension to the aspect ratio."""
+    return bool(width or height) and all(
+        value == 0 or value in THUMBNAIL_SIZES for value in (width, height)
+    )
+
+
+def media_path(relative_path: str) -> Path | None:
+    """Path of the media image at `relative_path` if there is one"""
+    path = (MEDIA_ROOT / relative_path).resolve()
+    if (
+        not path.is_relative_to(MEDIA_ROOT.resolve())
+        or path.suffix.lower() not in image_extensions
+        or not path.is_file()
+    ):
+        return None
+    return path
+
+
+class ContentHashes:
+    """Content hash of files, kept per (path, mtime, size) so that a file is
+    read to hash it once per version"""
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._hashes: OrderedDict[tuple, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> str:
+        stat = path.stat()
+        key = (str(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._hashes:
+                self._hashes.move_to_end(key)
+                return self._hashes[key]
+        digest = hashlib.blake2b(digest_size=16)
+        with path.open("rb") as file:
+            while chunk := file.read(1 << 20):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        with self._lock:
+            self._hashes[key] = content_hash
+            while len(self._hashes) > self.maxsize:
+                self._hashes.popitem(last=False)
+        return content_hash
+
+
+content_hashes = ContentHashes()
+
+
+def thumbnail_path(source: Path, width: int, height: int, format: str) -> Path:
+    content_hash = content_hashes.get(source)
+    return (
+        THUMBNAIL_ROOT
+        / content_hash[:2]
+        / f"{content_hash}-{width}x{height}{formats[format][1]}"
+    )
+
+
+def thumbnail_format(source: Path, accept: str) -> str:
+    """WebP for clients accepting it, otherwise PNG for images with
+    transparency and JPEG for the rest"""
+    if "image/webp" in accept:
+        return "webp"
+    return "png" if source.suffix.lower() in (".png", ".gif") else "jpeg"
+
+
+def make_thumbnail(
+    source: str, destination: str, width: int, height: int, format: str
+) -> str:
+    """Writes `source` resized to fit `width`x`height` to `destination`.
+
+    Images are never enlarged. Runs in a worker process, so it takes and
+    returns plain paths.
+    """
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(
+            (width or image.width, height or image.height), Image.Resampling.LANCZOS
+        )
+        pillow_format = formats[format][0]
+        options = dict(optimize=True)
+        if pillow_format == "JPEG":
+            image = image.convert("RGB")
+            options.update(quality=THUMBNAIL_QUALITY, progressive=True)
+        elif pillow_format == "WEBP":
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            options = dict(quality=THUMBNAIL_QUALITY, method=4)
+        elif image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            image = image.convert("RGBA")
+        destination = Path(destination)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        temporary = destination.with_name(f"{destination.name}.{os.getpid()}.tmp")
+        image.save(temporary, pillow_format, **options)
+        temporary.replace(destination)
+    return str(destination)
+
+
+def normalize_original(path: Path) -> tuple[int, int]:
+    """Rewrites the image at `path` without its EXIF metadata, upright and
+    within `IMAGE_MAX_DIMENSION` if it is not already. Returns its size."""
+    with Image.open(path) as image:
+        if getattr(image, "is_animated", False) or not (
+            image.getexif() or max(image.size) > IMAGE_MAX_DIMENSION
+        ):
+            return image.size
+        pillow_format = image.format
+        options = dict(icc_profile=image.info.get("icc_profile"))
+        if pillow_format == "JPEG":
+            options.update(quality=ORIGINAL_QUALITY, optimize=True)
+        elif pillow_format == "PNG":
+            options.update(optimize=True)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((IMAGE_MAX_DIMENSION,) * 2, Image.Resampling.LANCZOS)
+        for metadata in ("exif", "xmp"):
+            image.info.pop(metadata, None)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        image.save(temporary, pillow_format, **options)
+        temporary.replace(path)
+        return image.size
+
+
+def make_renditions(path: Path, width: int) -> dict[str, str]:
+    """Writes WebP renditions of the image at `path`, `width` pixels wide, in
+    the `SRCSET_WIDTHS` narrower than it and in its own width capped to
+    `IMAGE_MAX_DIMENSION`. Returns their paths relative to `MEDIA_ROOT` keyed
+    by width."""
+    content_hash = content_hashes.get(path)
+    widths = {size for size in SRCSET_WIDTHS if size < width}
+    widths.add(min(width, IMAGE_MAX_DIMENSION))
+    renditions = {}
+    for size in sorted(widths):
+        destination = (
+            renditions_root / content_hash[:2] / f"{content_hash}-{size}.webp"
+        )
+        if not destination.exists():
+            make_thumbnail(str(path), str(destination), size, 0, "webp")
+        renditions[str(size)] = destination.relative_to(MEDIA_ROOT).as_posix()
+    return renditions
@@ -0,0 +1,146 @@
+"""Renditions of uploaded images
+
+Once a model in `image_fields` is saved with a new image, `RenditionsWorker`
+processes it off the request path: uploads are rewritten without their EXIF
+metadata and within `IMAGE_MAX_DIMENSION`, then WebP renditions are written
+under `MEDIA_ROOT/renditions` and recorded in the model's `renditions` field
+for the API to pick from. Caches of the model listen to `renditions_recorded`
+as recording them is not a save. Images missed e.g by a restart, and default
+images left as they are, are processed by `manage.py process_images`.
+"""
+
+import queue
+import logging
+import threading
+from PIL import Image
+from django.db import close_old_connections, transaction
+from django.db.models import Model
+from django.db.models.signals import pre_save, post_save
+from django.dispatch import Signal
+from external.models import Gallery, News
+from hospital.models import Medicine
+from staffing.models import Department
+from users.models import CustomUser
+from hospital_ms.utils import images
+
+logger = logging.getLogger(__name__)
+
+image_fields: dict[type[Model], str] = {
+    Gallery: "picture",
+    News: "cover_photo",
+    Department: "profile",
+    Medicine: "picture",
+    CustomUser: "profile",
+}
+"""Image field of each model with renditions"""
+
+renditions_recorded = Signal()
+"""Sent with the `instance` whose renditions have been recorded"""
+
+
+def is_stale(instance: Model) -> bool:
+    """Whether the image of `instance` is yet to be processed"""
+    name = getattr(instance, image_fields[type(instance)]).name
+    return bool(name) and instance.renditions.get("source") != name
+
+
+def make_renditions(model: type[Model], name: str) -> dict:
+    """Renditions of the image `name` of a `model` instance"""
+    path = images.media_path(name)
+    if path is None:
+        return {"source": name}
+    try:
+        if name != model._meta.get_field(image_fields[model]).default:
+            # Defaults are shipped with the code and shared by instances
+            width, height = images.normalize_original(path)
+        else:
+            with Image.open(path) as image:
+                width, height = image.size
+        return {
+            "source": name,
+            "width": width,
+            "height": height,
+            "webp": images.make_renditions(path, width),
+        }
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.warning(f"Failed to make renditions of {path}: {e}")
+        return {"source": name}
+
+
+def process(model: type[Model], pk) -> bool:
+    """Makes and records renditions of the image of a `model` instance.
+    Returns whether there were any to make."""
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not is_stale(instance):
+        return False
+    name = getattr(instance, image_fields[model]).name
+    renditions = make_renditions(model, name)
+    # Matches nothing if the image changed while it was being processed, it
+    # has been queued again
+    if not model.objects.filter(pk=pk, **{image_fields[model]: name}).update(
+        renditions=renditions
+    ):
+        return False
+    instance.renditions = renditions
+    renditions_recorded.send(sender=model, instance=instance)
+    return True
+
+
+class RenditionsWorker:
+    """Processes queued images one at a time in a background thread"""
+
+    def __init__(self):
+        self._queue: queue.Queue[tuple[type[Model], object]] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def put(self, model: type[Model], pk):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self.run, name="renditions", daemon=True
+                )
+                self._thread.start()
+        self._queue.put((model, pk))
+
+    def run(self):
+        while True:
+            model, pk = self._queue.get()
+            try:
+                process(model, pk)
+            except Exception:
+                logger.exception(f"Failed to process image of {model.__name__} {pk}")
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def join(self):
+        """Waits for the images queued to be processed"""
+        self._queue.join()
+
+
+renditions_worker = RenditionsWorker()
+
+
+def image_saving(sender, instance: Model, update_fields=None, **kwargs):
+    field = image_fields[sender]
+    if update_fields is not None and field not in update_fields:
+        instance._image_changed = False
+        return
+    stored = (
+        sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+        if instance.pk
+        else sender._meta.get_field(field).get_default()
+    )
+    instance._image_changed = getattr(instance, field).name != stored
+
+
+def image_saved(sender, instance: Model, **kwargs):
+    if getattr(instance, "_image_changed", False) and is_stale(instance):
+        pk = instance.pk
+        transaction.on_commit(lambda: renditions_worker.put(sender, pk))
+
+
+for model in image_fields:
+    pre_save.connect(image_saving, sender=model)
+    post_save.connect(image_saved, sender=model)
@@ -0,0 +1,40 @@
+"""Version counters shared by processes"""
+
+from django.core.cache import caches
+
+
+class SharedVersions:
+    """Version counters kept in a Django cache.
+
+    In-memory caches record the versions their entries were built at and
+    drop them once those move on, so that a change seen by one process
+    invalidates what every process holds. This takes a cache shared by the
+    processes, see `CACHES`.
+    """
+
+    def __init__(self, key_prefix: str, alias: str = "default"):
+        self.key_prefix = key_prefix
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _key(self, name: str) -> str:
+        return f"{self.key_prefix}:version:{name}"
+
+    def get(self, name: str) -> int:
+        return self.cache.get(self._key(name), 0)
+
+    def get_many(self, names: tuple[str, ...]) -> tuple[int, ...]:
+        keys = [self._key(name) for name in names]
+        found = self.cache.get_many(keys)
+        return tuple(found.get(key, 0) for key in keys)
+
+    def bump(self, name: str):
+        key = self._key(name)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            if not self.cache.add(key, 1, timeout=None):
+                self.cache.incr(key)
@@ -1,22 +1,54 @@
 from django.contrib import admin
 from staffing.models import Department, WorkingDay, Speciality, Doctor
-from hospital.models import Appointment
+from hospital.models import Appointment, Treatment
+from django.db.models import Count, OuterRef, QuerySet, Subquery, Value
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from hospital_ms.utils.admin import DevelopmentImportExportModelAdmin
 
 # Register your models here.
 
 
+def doctor_count(queryset: QuerySet) -> Coalesce:
+    """Rows of `queryset` of each doctor, counted by a correlated subquery
+    so that several counts do not multiply each other's rows"""
+    count = (
+        queryset.filter(doctor_id=OuterRef("pk"))
+        .values("doctor_id")
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    return Coalesce(Subquery(count), Value(0))
+
+
 @admin.register(Department)
 class DepartmentAdmin(DevelopmentImportExportModelAdmin):
     search_fields = ("name", "lead__username")
     list_filter = ("created_at",)
     list_editable = ("lead",)
 
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("lead")
+            .annotate(specialities_count=Count("specialities"))
+        )
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == "lead":
+            # One lead choices query for all the changelist rows
+            if not hasattr(request, "_lead_choices"):
+                request._lead_choices = list(formfield.choices)
+            formfield.choices = request._lead_choices
+        return formfield
+
     def total_specialities(self, obj):
-        return obj.specialities.count()
+        return obj.specialities_count
 
     total_specialities.short_description = _("Total Specialities")
+    total_specialities.admin_order_field = "specialities_count"
 
     list_display = ("name", "lead", "total_specialities", "created_at")
 
@@ -26,10 +58,16 @@ class WorkingDayAdmin(DevelopmentImportExportModelAdmin):
     search_fields = ("name",)
     list_filter = ("created_at",)
 
+    def get_queryset(self, request):
+        return (
+            super().get_queryset(request).annotate(doctors_count=Count("doctors"))
+        )
+
     def total_doctors(self, obj: WorkingDay):
-        return obj.doctors.count()
+        return obj.doctors_count
 
     total_doctors.short_description = _("Total Doctors")
+    total_doctors.admin_order_field = "doctors_count"
 
     list_display = ("name", "total_doctors", "created_at")
 
@@ -53,17 +91,31 @@ class DoctorAdmin(DevelopmentImportExportModelAdmin):
     list_filter = ("shift", "speciality", "speciality__department", "created_at")
     list_editable = ("shift",)
 
+    def get_queryset(self, request):
+        scheduled = Appointment.AppointmentStatus.SCHEDULED.value
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("user", "speciality")
+            .annotate(
+                treatments_count=doctor_count(Treatment.doctors.through.objects),
+                active_appointments_count=doctor_count(
+                    Appointment.objects.filter(status=scheduled)
+                ),
+            )
+        )
+
     def active_treatments(self, obj):
-        return obj.treatments.count()
+        return obj.treatments_count
 
     active_treatments.short_description = _("Active Treatments")
+    active_treatments.admin_order_field = "treatments_count"
 
     def active_appointments(self, obj):
-        return obj.appointments.filter(
-            status=Appointment.AppointmentStatus.SCHEDULED.value,
-        ).count()
+        return obj.active_appointments_count
 
     active_appointments.short_description = _("Active Appointments")
+    active_appointments.admin_order_field = "active_appointments_count"
     list_display = (
         "user",
         "speciality",
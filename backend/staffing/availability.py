@@ -0,0 +1,187 @@
+"""In-memory index of doctors availability
+
+Doctors are grouped by (weekday, shift, speciality) so that the booking flow
+can list available doctors without touching the database. The index is
+built once, kept current through model signals (see `staffing.signals`) and
+fully rebuilt after `AVAILABILITY_INDEX_TTL` seconds to pick up changes made
+by other processes. `manage.py rebuild_availability_index` has every process
+rebuild it at once e.g after a bulk change made outside the api.
+"""
+
+import time
+import threading
+from datetime import datetime
+from typing import NamedTuple, Iterable
+from django.db.models import Prefetch
+from staffing.models import Doctor, WorkingDay
+from hospital_ms import settings
+from hospital_ms.utils.versions import SharedVersions
+
+
+class DoctorSummary(NamedTuple):
+    id: int
+    user_id: int
+    fullname: str
+    speciality: str
+    profile: str | None
+    renditions: dict
+    working_days: tuple[str, ...]
+    department_name: str
+    shift: str
+    created_at: datetime
+
+
+def get_day_and_shift(time: datetime) -> tuple[str, str]:
+    day_of_week: str = time.strftime("%A")
+    work_shift: str = (
+        Doctor.WorkShift.DAY.value
+        if 6 <= time.hour < 18
+        else Doctor.WorkShift.NIGHT.value
+    )
+    return day_of_week, work_shift
+
+
+class AvailabilityIndex:
+    """Doctors summaries keyed by (weekday, shift, speciality)"""
+
+    def __init__(self, ttl: float = 600, alias: str = "default"):
+        self.ttl = ttl
+        self.versions = SharedVersions("availability-index", alias)
+        self._built_version: int | None = None
+        self._doctors: dict[int, DoctorSummary] = {}
+        self._slots: dict[tuple[str, str], dict[str, set[int]]] = {}
+        self._doctors_by_user: dict[int, int] = {}
+        self._built_at: float | None = None
+        self._lock = threading.RLock()
+
+    @property
+    def is_built(self) -> bool:
+        return self._built_at is not None
+
+    @staticmethod
+    def _queryset():
+        return Doctor.objects.filter(speciality__isnull=False).select_related(
+            "user", "speciality__department"
+        ).prefetch_related(
+            Prefetch(
+                "working_days", queryset=WorkingDay.objects.order_by("-created_at")
+            )
+        )
+
+    @staticmethod
+    def _summarize(doctor: Doctor) -> DoctorSummary:
+        return DoctorSummary(
+            id=doctor.id,
+            user_id=doctor.user_id,
+            fullname=doctor.user.get_full_name(),
+            speciality=doctor.speciality.name,
+            profile=doctor.user.profile.name,
+            renditions=doctor.user.renditions,
+            working_days=tuple(day.name for day in doctor.working_days.all()),
+            department_name=doctor.speciality.department.name,
+            shift=doctor.shift,
+            created_at=doctor.created_at,
+        )
+
+    def _add(self, summary: DoctorSummary):
+        self._doctors[summary.id] = summary
+        self._doctors_by_user[summary.user_id] = summary.id
+        for day in summary.working_days:
+            self._slots.setdefault((day, summary.shift), {}).setdefault(
+                summary.speciality, set()
+            ).add(summary.id)
+
+    def _remove(self, doctor_id: int):
+        summary = self._doctors.pop(doctor_id, None)
+        if summary is None:
+            return
+        self._doctors_by_user.pop(summary.user_id, None)
+        for day in summary.working_days:
+            specialities = self._slots.get((day, summary.shift), {})
+            doctor_ids = specialities.get(summary.speciality, set())
+            doctor_ids.discard(doctor_id)
+            if not doctor_ids:
+                specialities.pop(summary.speciality, None)
+
+    def rebuild(self) -> int:
+        """Loads every doctor afresh. Returns how many were loaded."""
+        # Read first so that a rebuild requested meanwhile is not missed
+        version = self.versions.get("built")
+        summaries = [self._summarize(doctor) for doctor in self._queryset()]
+        with self._lock:
+            self._doctors.clear()
+            self._slots.clear()
+            self._doctors_by_user.clear()
+            for summary in summaries:
+                self._add(summary)
+            self._built_at = time.monotonic()
+            self._built_version = version
+        return len(summaries)
+
+    def rebuild_everywhere(self) -> int:
+        """Rebuilds the index here and has every other process rebuild its own
+        on next use. Returns how many doctors were loaded."""
+        self.versions.bump("built")
+        return self.rebuild()
+
+    def refresh_doctors(self, doctor_ids: Iterable[int]):
+        """Reloads the given doctors only"""
+        if not self.is_built:
+            return
+        doctor_ids = set(doctor_ids)
+        if not doctor_ids:
+            return
+        summaries = [
+            self._summarize(doctor)
+            for doctor in self._queryset().filter(id__in=doctor_ids)
+        ]
+        with self._lock:
+            for doctor_id in doctor_ids:
+                self._remove(doctor_id)
+            for summary in summaries:
+                self._add(summary)
+
+    def remove_doctors(self, doctor_ids: Iterable[int]):
+        with self._lock:
+            for doctor_id in doctor_ids:
+                self._remove(doctor_id)
+
+    def doctor_for_user(self, user_id: int) -> int | None:
+        return self._doctors_by_user.get(user_id)
+
+    def ensure_built(self):
+        if (
+            self._built_at is None
+            or time.monotonic() - self._built_at > self.ttl
+            or self.versions.get("built") != self._built_version
+        ):
+            self.rebuild()
+
+    def find(
+        self,
+        at: datetime = None,
+        speciality_name: str = None,
+    ) -> list[DoctorSummary]:
+        """Doctors available at a given time and/or of a given speciality
+        ordered by id. Call `ensure_built` beforehand."""
+        with self._lock:
+            if at:
+                specialities = self._slots.get(get_day_and_shift(at), {})
+                if speciality_name:
+                    doctor_ids = specialities.get(speciality_name, set())
+                else:
+                    doctor_ids = set().union(*specialities.values())
+                summaries = [self._doctors[doctor_id] for doctor_id in doctor_ids]
+            else:
+                summaries = [
+                    summary
+                    for summary in self._doctors.values()
+                    if not speciality_name or summary.speciality == speciality_name
+                ]
+        return sorted(summaries, key=lambda summary: summary.id)
+
+
+availability_index = AvailabilityIndex(
+    ttl=settings.AVAILABILITY_INDEX_TTL, alias=settings.AVAILABILITY_INDEX_ALIAS
+)
+"""Process wide doctors availability index"""
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from staffing.availability import availability_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the doctors availability index of every api process"
+
+    def handle(self, *args, **options):
+        total = availability_index.rebuild_everywhere()
+        self.stdout.write(
+            self.style.SUCCESS(f"Indexed {total} doctor(s), api processes to follow")
+        )
@@ -27,6 +27,12 @@ class Department(models.Model):
         help_text=_("Department's profile picture"),
         blank=True,
     )
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text=_("Resized copies of the profile picture"),
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name=_("Created At"),
@@ -177,11 +183,5 @@ class Doctor(models.Model):
     def is_working_now(self) -> bool:
         return self.is_working_time(timezone.now())
 
-    def accepts_appointment_on(self, time: datetime) -> bool:
-        return (
-            self.appointments.filter(appointment_datetime__date=time.date()).count()
-            < self.speciality.appointments_limit
-        )
-
     def __str__(self):
         return str(self.user)
@@ -0,0 +1,74 @@
+"""Keeps `staffing.availability.availability_index` in sync with the database"""
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from staffing.models import Department, WorkingDay, Speciality, Doctor
+from staffing.availability import availability_index
+from users.models import CustomUser
+from hospital_ms.utils.renditions import renditions_recorded
+
+
+def refresh_doctors_on_commit(doctor_ids):
+    doctor_ids = list(doctor_ids)
+    transaction.on_commit(lambda: availability_index.refresh_doctors(doctor_ids))
+
+
+def rebuild_on_commit():
+    if availability_index.is_built:
+        transaction.on_commit(availability_index.rebuild)
+
+
+@receiver(post_save, sender=Doctor)
+def doctor_saved(sender, instance: Doctor, **kwargs):
+    refresh_doctors_on_commit([instance.id])
+
+
+@receiver(post_delete, sender=Doctor)
+def doctor_deleted(sender, instance: Doctor, **kwargs):
+    doctor_id = instance.id
+    transaction.on_commit(lambda: availability_index.remove_doctors([doctor_id]))
+
+
+@receiver(m2m_changed, sender=Doctor.working_days.through)
+def doctor_working_days_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        refresh_doctors_on_commit([instance.id])
+    elif pk_set:
+        refresh_doctors_on_commit(pk_set)
+    else:
+        rebuild_on_commit()
+
+
+@receiver(post_save, sender=Speciality)
+def speciality_saved(sender, instance: Speciality, **kwargs):
+    if availability_index.is_built:
+        refresh_doctors_on_commit(instance.doctors.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Department)
+def department_saved(sender, instance: Department, **kwargs):
+    if availability_index.is_built:
+        refresh_doctors_on_commit(
+            Doctor.objects.filter(speciality__department=instance).values_list(
+                "id", flat=True
+            )
+        )
+
+
+@receiver(post_delete, sender=Speciality)
+@receiver(post_delete, sender=Department)
+@receiver(post_save, sender=WorkingDay)
+@receiver(post_delete, sender=WorkingDay)
+def staffing_structure_changed(sender, **kwargs):
+    rebuild_on_commit()
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(renditions_recorded, sender=CustomUser)
+def user_saved(sender, instance: CustomUser, **kwargs):
+    doctor_id = availability_index.doctor_for_user(instance.pk)
+    if doctor_id is not None:
+        refresh_doctors_on_commit([doctor_id])
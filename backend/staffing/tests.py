@@ -1,3 +1,95 @@
-from django.test import TestCase
+from io import StringIO
+from django.core.management import call_command
+from django.contrib import admin
+from django.test import RequestFactory, TestCase
+from hospital.models import Appointment, Treatment
+from hospital.tests import (
+    AdminTestCase,
+    appointment_time,
+    create_doctor,
+    create_patient,
+)
+from staffing.admin import DoctorAdmin
+from staffing.availability import AvailabilityIndex
+from staffing.models import Department, Doctor, Speciality, WorkingDay
+from users.models import CustomUser
 
-# Create your tests here.
+
+class RebuildAvailabilityIndexTest(TestCase):
+    def test_every_process_rebuilds_after_bulk_change(self):
+        # Index of another api process
+        other = AvailabilityIndex()
+        other.ensure_built()
+        self.assertEqual(other.find(), [])
+        # Made outside the api, e.g by a script of another process
+        doctor = create_doctor()
+        other.ensure_built()
+        self.assertEqual(other.find(), [])
+        out = StringIO()
+        call_command("rebuild_availability_index", stdout=out)
+        self.assertIn("Indexed 1 doctor(s)", out.getvalue())
+        other.ensure_built()
+        self.assertEqual([summary.id for summary in other.find()], [doctor.id])
+
+
+class StaffingAdminTest(AdminTestCase):
+    def test_doctor_changelist(self):
+        patient = create_patient()
+
+        def add_doctor(i: int):
+            Appointment.objects.create(
+                patient=patient,
+                doctor=create_doctor(username=f"doctor{i}"),
+                appointment_datetime=appointment_time(),
+                reason="Checkup",
+            )
+
+        self.assert_changelist_queries_bounded(Doctor, add_doctor)
+
+    def test_doctor_counts_do_not_multiply_rows(self):
+        doctor = create_doctor()
+        patient = create_patient()
+        for _ in range(3):
+            Treatment.objects.create(
+                patient=patient, diagnosis="Flu", details="Rest"
+            ).doctors.add(doctor)
+        for status in Appointment.AppointmentStatus:
+            Appointment.objects.create(
+                patient=patient,
+                doctor=doctor,
+                appointment_datetime=appointment_time(),
+                reason="Checkup",
+                status=status.value,
+            )
+        request = RequestFactory().get("/")
+        request.user = CustomUser.objects.get(username="admin")
+        doctors = DoctorAdmin(Doctor, admin.site).get_queryset(request)
+        # Counted apart rather than over joined treatments and appointments
+        self.assertIsNone(doctors.query.group_by)
+        doctor = doctors.get(pk=doctor.pk)
+        self.assertEqual(
+            (doctor.treatments_count, doctor.active_appointments_count), (3, 1)
+        )
+
+    def test_department_changelist(self):
+        def add_department(i: int):
+            department = Department.objects.create(
+                name=f"Department {i}",
+                lead=CustomUser.objects.create(username=f"lead{i}"),
+            )
+            Speciality.objects.create(
+                name=f"Speciality {i}", department=department, appointments_limit=5
+            )
+
+        self.assert_changelist_queries_bounded(Department, add_department)
+
+    def test_working_day_changelist(self):
+        doctor = create_doctor()
+        days = list(WorkingDay.DaysOfWeek)
+
+        def add_working_day(i: int):
+            doctor.working_days.add(WorkingDay.objects.create(name=days[i].value))
+
+        self.assert_changelist_queries_bounded(
+            WorkingDay, add_working_day, many=len(days)
+        )
@@ -77,6 +77,12 @@ class CustomUser(AbstractUser):
         blank=True,
         null=True,
     )
+    renditions = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text=_("Resized copies of the profile picture"),
+    )
 
     role = models.CharField(
         max_length=10,
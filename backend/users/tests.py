@@ -1,3 +1,70 @@
+import threading
+from unittest import mock
+from asgiref.sync import async_to_sync
 from django.test import TestCase
+from api.v1.cache import TokenCache, token_cache
+from api.v1.utils import generate_token
+from hospital.models import Patient
+from hospital.tests import create_patient
 
-# Create your tests here.
+
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        self.patient = create_patient()
+        self.patient.user.token = generate_token()
+        self.patient.user.save()
+        self.token = self.patient.user.token
+        # Cache of another api process
+        self.other = TokenCache()
+
+    def test_counts_hits_and_misses(self):
+        self.assertIsNone(self.other.get(self.token))
+        self.other.set(self.token, Patient.objects.get(pk=self.patient.pk))
+        self.assertEqual(self.other.get(self.token).pk, self.patient.pk)
+        self.assertEqual(self.other.stats(), dict(hits=1, misses=1, size=1))
+
+    def test_async_lookups_read_versions_off_the_event_loop(self):
+        threads = []
+
+        def get_version(name: str) -> int:
+            threads.append(threading.current_thread())
+            return 0
+
+        async def lookup():
+            return threading.current_thread(), await self.other.aget(self.token)
+
+        with mock.patch.object(self.other.versions, "get", side_effect=get_version):
+            loop_thread, patient = async_to_sync(lookup)()
+            # Tokens not cached here are missed without a version read
+            self.assertEqual((patient, threads), (None, []))
+            self.other.set(self.token, self.patient)
+            threads.clear()
+            loop_thread, patient = async_to_sync(lookup)()
+        self.assertEqual(patient.pk, self.patient.pk)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], loop_thread)
+        self.assertEqual(self.other.stats(), dict(hits=1, misses=1, size=1))
+
+    def test_rotated_token_is_dropped_by_every_process(self):
+        self.other.set(self.token, self.patient)
+        token_cache.set(self.token, self.patient)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patient.user.token = generate_token()
+            self.patient.user.save()
+        self.assertIsNone(token_cache.get(self.token))
+        self.assertIsNone(self.other.get(self.token))
+
+    def test_deleted_patient_is_dropped_by_every_process(self):
+        self.other.set(self.token, self.patient)
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.get(pk=self.patient.pk).delete()
+        self.assertIsNone(self.other.get(self.token))
+
+    def test_changes_are_seen_once_committed(self):
+        self.other.set(self.token, self.patient)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.patient.user.save()
+            self.assertIsNotNone(self.other.get(self.token))
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(self.other.get(self.token))